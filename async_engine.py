@@ -0,0 +1,459 @@
+import asyncio
+import socket
+import time
+
+from deadlines import AsyncDeadlineStream, Deadline
+from http_framing import (
+    HTTPFramingError,
+    RequestBodyError,
+    async_read_head,
+    async_relay_body,
+    buffered_body_length,
+    parse_request_head,
+    parse_response_head,
+    request_body_framer,
+    response_body_framer,
+    set_connection_header,
+)
+from response_cache import BodyCapture
+from schedulers import server_state
+from upstream_pool import AsyncUpstreamPool
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+# Enough queued connections for bursts of several thousand clients
+ASYNC_BACKLOG = 4096
+
+
+class AsyncioEngine:
+    def __init__(self, lb):
+        """
+        Serve the load balancer's listening socket from a single asyncio event loop
+
+        Routing, statistics and health state are shared with the HTTPLoadBalancer,
+        only the connection handling is replaced.
+
+        :param lb: The HTTPLoadBalancer whose socket and upstream groups are used
+        """
+        self.lb = lb
+        self.server = None
+        self.connections = 0
+
+        # Pooled streams belong to this event loop, so they replace the socket pool
+        pool = lb.connection_pool
+        self.pool = AsyncUpstreamPool(
+            max_idle=pool.max_idle, idle_timeout=pool.idle_timeout, max_lifetime=pool.max_lifetime, dns=pool.dns
+        )
+        lb.connection_pool = self.pool
+
+    def run(self):
+        """
+        Run the event loop until the load balancer stops
+        """
+        raise_open_file_limit()
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        """
+        Accept client connections on the load balancer socket
+        """
+        self.pool.loop = asyncio.get_running_loop()
+        self.lb.lb_socket.setblocking(False)
+        self.lb.lb_socket.listen(self.lb.backlog or ASYNC_BACKLOG)
+        self.server = await asyncio.start_server(
+            self.handle_client, sock=self.lb.lb_socket
+        )
+        async with self.server:
+            while self.lb.running:
+                await asyncio.sleep(1.0)
+            self.server.close()
+
+            # Let requests in flight finish before the loop shuts down
+            deadline = time.time() + self.lb.drain_timeout
+            while self.connections and time.time() < deadline:
+                await asyncio.sleep(0.1)
+        self.pool.close_all()
+
+    async def handle_client(self, reader, writer):
+        """
+        Handle HTTP requests from client, keeping the connection open between requests
+        like HTTPLoadBalancer.handle_http_request
+        """
+        client_address = writer.get_extra_info("peername")
+        # asyncio only sets TCP_NODELAY itself on sockets created with IPPROTO_TCP, not on lb_socket's
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connections += 1
+        client_buffer = bytearray()
+        served = 0
+        try:
+            while self.lb.running:
+                try:
+                    request_head = await async_read_head(
+                        reader, client_buffer, read_timeout=self.lb.client_idle_timeout
+                    )
+                    if not request_head:
+                        return
+                    request = parse_request_head(request_head)
+                    request_framer = request_body_framer(request)
+                except asyncio.TimeoutError:
+                    return
+                except HTTPFramingError as e:
+                    await self.send_error_response(writer, e.status, f"{e.reason}: {e}")
+                    return
+
+                served += 1
+                keep_alive = request.keep_alive() and served < self.lb.max_keepalive_requests and self.lb.running
+                if not await self.route_http_request(reader, writer, request, request_framer, client_buffer,
+                                                     keep_alive, client_address):
+                    return
+
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            print(f"Error handling request from {client_address}: {e}")
+            try:
+                await self.send_error_response(writer, 500, "Internal Server Error: " + str(e))
+            except Exception:
+                pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def route_http_request(self, reader, writer, request, request_framer, client_buffer, keep_alive,
+                                 client_address=None):
+        """
+        Route one request by its own Host header and forward it
+
+        :return: Whether the client connection can serve another request
+        """
+        host_header = request.host
+
+        if not host_header:
+            await self.send_error_response(writer, 400, "Bad Request: Missing Host header")
+            return False
+
+        # An error answered without reading the request body cannot leave the connection reusable
+        keep_alive_on_error = keep_alive and request_framer.done
+
+        routing = self.lb.routing
+        domain = routing.table.lookup(host_header, request.target)
+        if domain is None:
+            await self.send_error_response(writer, 404, "Domain Not Found", keep_alive_on_error)
+            return keep_alive_on_error
+
+        cache = self.lb.response_cache
+        cache_key = cache.key(request, routing.upstream_groups[domain])
+        if cache_key is None:
+            return await self.proxy_request(reader, writer, request, request_framer, client_buffer, keep_alive,
+                                            domain, routing, client_address)
+        entry, fill = await cache.async_lookup(cache_key)
+        if entry is not None:
+            return await self.send_cached_response(writer, domain, entry, keep_alive)
+        try:
+            return await self.proxy_request(reader, writer, request, request_framer, client_buffer, keep_alive,
+                                            domain, routing, client_address, cache_key)
+        finally:
+            if fill is not None:
+                cache.release(cache_key, fill)
+
+    async def proxy_request(self, reader, writer, request, request_framer, client_buffer, keep_alive, domain,
+                            routing, client_address=None, cache_key=None):
+        """
+        Forward a routed request like HTTPLoadBalancer.proxy_request
+
+        :return: Whether the client connection can serve another request
+        """
+        keep_alive_on_error = keep_alive and request_framer.done
+        key = routing.schedulers[domain].request_key(request, client_address)
+        upstream_server = self.lb.select_upstream_server(domain, routing=routing, key=key)
+        if upstream_server is None:
+            self.lb.stats.record_request(domain, None, 503, 0.0, failed=True)
+            await self.send_error_response(writer, 503, "No Healthy Upstream", keep_alive_on_error)
+            return keep_alive_on_error
+
+        self.lb.retry_budget(domain).record_request()
+        tried = []
+        hedge = self.lb.hedge_for(domain, request, tried, routing, key)
+        while upstream_server is not None:
+            tried.append(upstream_server)
+            attempt = len(tried)
+            server_state(upstream_server).begin_request()
+            try:
+                result = await self.forward_http_request(reader, writer, upstream_server, request, request_framer,
+                                                         client_buffer, keep_alive, hedge,
+                                                         capture=cache_key is not None)
+            finally:
+                for server in tried[attempt - 1:]:
+                    server_state(server).end_request()
+                    self.lb.outliers.release(server)
+            hedge = None
+            upstream_server = self.lb.select_retry_server(domain, request, result, tried, routing, key)
+            self.lb.record_forward_result(domain if upstream_server is None else None, result)
+
+        if cache_key is not None and result["success"]:
+            self.lb.response_cache.store(cache_key, result["response"], result["body"],
+                                         routing.upstream_groups[domain])
+        if not result["success"] and result["status_code"]:
+            await self.send_error_response(writer, result["status_code"], self.lb.upstream_error_message(result))
+        return result.get("keep_alive", False)
+
+    async def send_cached_response(self, writer, domain, entry, keep_alive):
+        start_time = time.time()
+        data = entry.to_bytes(b"keep-alive" if keep_alive else b"close")
+        writer.write(data)
+        await writer.drain()
+        self.lb.stats.record_request(domain, None, entry.status_code, time.time() - start_time, 0, len(data))
+        return keep_alive
+
+    async def forward_http_request(self, client_reader, client_writer, upstream_server, request, request_framer,
+                                   client_buffer, keep_alive=False, hedge=None, capture=False):
+        """
+        Forward HTTP request to upstream server without blocking the event loop
+
+        :return: The same result dictionary as HTTPLoadBalancer.forward_http_request
+        """
+        primary = upstream_server
+        server_id = self.pool.server_id(upstream_server)
+        deadline = Deadline(upstream_server)
+        pooled = None
+        reusable = False
+        response_started = False
+        sent = False
+        replay = None
+        start_time = time.time()
+
+        try:
+            upstream_head = set_connection_header(request.raw, b"keep-alive")
+
+            # A request whose body is already buffered can be replayed on a fresh connection
+            body_length = buffered_body_length(request_framer, client_buffer)
+            replay = None if body_length is None else upstream_head + bytes(client_buffer[:body_length])
+
+            if hedge is not None and replay is not None:
+                sent = True
+                upstream_server, pooled, upstream, upstream_buffer, response, header_time = await self._hedged_exchange(
+                    upstream_server, replay, hedge
+                )
+                server_id = self.pool.server_id(upstream_server)
+                bytes_in = len(replay)
+            else:
+                pooled = await self.pool.acquire(upstream_server, deadline=deadline)
+                sent = True
+                upstream = AsyncDeadlineStream(pooled.conn, deadline)
+                try:
+                    upstream_buffer, response, bytes_in = await self._send_request(
+                        upstream, upstream_head, replay, client_reader, client_writer, client_buffer, request_framer
+                    )
+                except (ConnectionError, EOFError):
+                    if not pooled.reused or replay is None:
+                        raise
+                    # The upstream closed the idle connection just as we reused it
+                    self.pool.release(pooled, False)
+                    pooled = await self.pool.acquire(upstream_server, fresh=True, deadline=deadline)
+                    upstream = AsyncDeadlineStream(pooled.conn, deadline)
+                    upstream_buffer, response, bytes_in = await self._send_request(
+                        upstream, upstream_head, replay, client_reader, client_writer, client_buffer, request_framer
+                    )
+                header_time = time.time() - start_time
+            if replay is not None:
+                del client_buffer[:body_length]
+
+            response_framer = response_body_framer(response, request.method)
+            # A body delimited by the upstream closing can only be delimited the same way for the client
+            keep_alive = keep_alive and not response_framer.until_close
+            client_head = set_connection_header(response.raw, b"keep-alive" if keep_alive else b"close")
+            response_started = True
+            client = client_writer
+            if capture:
+                client = BodyCapture(client_writer, self.lb.response_cache.max_object, skip=len(client_head))
+            bytes_out = len(client_head) + await async_relay_body(upstream, client, upstream_buffer,
+                                                                  response_framer, head=client_head)
+            reusable = response.keep_alive() and not response_framer.until_close and not upstream_buffer
+
+            response_time = time.time() - start_time
+
+            return {
+                "success": True,
+                "response_time": response_time,
+                "header_time": header_time,
+                "hedge_won": upstream_server is not primary,
+                "status_code": response.status_code,
+                "bytes_in": bytes_in,
+                "bytes_out": bytes_out,
+                "keep_alive": keep_alive,
+                "server_id": server_id,
+                "upstream_server": upstream_server,
+                "response": response,
+                "body": client.data if capture else None,
+            }
+
+        except RequestBodyError as e:
+            print(f"Bad request body for upstream {server_id}: {e}")
+            return {
+                "success": False,
+                "error": str(e),
+                "client_error": True,
+                "status_code": e.status,
+                "reason": e.reason,
+                "sent": sent,
+                "retryable": False,
+                "server_id": server_id,
+                "upstream_server": upstream_server
+            }
+        except (asyncio.TimeoutError, socket.timeout) as e:
+            kind = getattr(e, "kind", None)
+            print(f"Timeout ({kind or 'client'}) on upstream {server_id}")
+            if kind is None:
+                return {
+                    "success": False,
+                    "error": f"Client stalled for {self.lb.client_idle_timeout:g}s",
+                    "client_error": True,
+                    "status_code": None if response_started else 408,
+                    "reason": "Request Timeout",
+                    "sent": sent,
+                    "retryable": False,
+                    "server_id": server_id,
+                    "upstream_server": upstream_server
+                }
+            return {
+                "success": False,
+                "error": str(e) or "timeout",
+                "timeout": kind,
+                "status_code": None if response_started else 504,
+                "sent": sent,
+                "retryable": not response_started and (replay is not None or not sent),
+                "server_id": server_id,
+                "upstream_server": upstream_server
+            }
+        except Exception as e:
+            print(f"Error connecting to upstream {server_id}: {e}")
+            return {
+                "success": False,
+                "error": str(e),
+                "status_code": None if response_started else 502,
+                "sent": sent,
+                "retryable": not response_started and (replay is not None or not sent),
+                "server_id": server_id,
+                "upstream_server": upstream_server
+            }
+        finally:
+            if pooled:
+                self.pool.release(pooled, reusable)
+
+    async def _send_request(self, upstream, upstream_head, replay,
+                            client_reader, client_writer, client_buffer, request_framer):
+        """
+        Send one request on an upstream connection, wrapped in an AsyncDeadlineStream,
+        and read the response head
+        """
+        if replay is not None:
+            upstream.write(replay)
+            await upstream.drain()
+            bytes_in = len(replay)
+        else:
+            upstream.write(upstream_head)
+            bytes_in = len(upstream_head)
+            try:
+                # The client gets as long for each read of the body as for its next request
+                bytes_in += await async_relay_body(client_reader, upstream, client_buffer, request_framer,
+                                                   self.lb.client_idle_timeout)
+            except HTTPFramingError as e:
+                raise RequestBodyError(str(e)) from None
+
+        upstream_buffer = bytearray()
+        response = await self._read_response_head(upstream, upstream_buffer, client_writer)
+        return upstream_buffer, response, bytes_in
+
+    async def _read_response_head(self, upstream, upstream_buffer, client_writer=None):
+        """
+        Read the final response head, passing interim responses on to the client, or
+        dropping them if client_writer is None
+        """
+        while True:
+            response_head = await async_read_head(upstream, upstream_buffer)
+            if not response_head:
+                raise EOFError("Upstream closed the connection")
+            response = parse_response_head(response_head)
+            # Interim responses such as 100 Continue precede the final one
+            if response.status_code >= 200 or response.status_code == 101:
+                return response
+            if client_writer is not None:
+                client_writer.write(response_head)
+
+    async def _hedged_exchange(self, primary, replay, hedge):
+        """
+        Send a buffered request to the primary server and, if no response has arrived
+        after the hedge delay, a copy to a second server; the first response head wins
+        and the other attempt is cancelled
+
+        :return: The same as HTTPLoadBalancer._hedged_exchange
+        """
+        delay, select_hedge = hedge
+        attempts = {asyncio.ensure_future(self._attempt(primary, replay)): primary}
+        done, pending = await asyncio.wait(set(attempts), timeout=delay)
+        if not done:
+            secondary = select_hedge()
+            if secondary is not None:
+                attempts[asyncio.ensure_future(self._attempt(secondary, replay))] = secondary
+                pending = set(attempts)
+        winner = None
+        try:
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        pooled, upstream, upstream_buffer, response, header_time = task.result()
+                        return attempts[task], pooled, upstream, upstream_buffer, response, header_time
+                    last_error = task.exception()
+                if not pending:
+                    raise last_error
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in attempts:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    # Both answered at once
+                    self.pool.release(task.result()[0], False)
+
+    async def _attempt(self, server, replay):
+        started = time.monotonic()
+        deadline = Deadline(server, started)
+        pooled = await self.pool.acquire(server, deadline=deadline)
+        upstream = AsyncDeadlineStream(pooled.conn, deadline)
+        try:
+            upstream.write(replay)
+            await upstream.drain()
+            upstream_buffer = bytearray()
+            response = await self._read_response_head(upstream, upstream_buffer)
+        except BaseException:
+            # Also when cancelled because the other attempt won
+            self.pool.release(pooled, False)
+            raise
+        return pooled, upstream, upstream_buffer, response, time.monotonic() - started
+
+    async def send_error_response(self, writer, status: int, message: str = "", keep_alive: bool = False):
+        """Send HTTP error response to client"""
+        writer.write(self.lb.build_error_response(status, message, keep_alive))
+        await writer.drain()
+
+
+def raise_open_file_limit():
+    """
+    Raise the soft open file limit to the hard limit so that one process can
+    hold tens of thousands of client and upstream sockets
+    """
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError) as e:
+        print(f"Could not raise open file limit: {e}")
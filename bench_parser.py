@@ -0,0 +1,92 @@
+import argparse
+import time
+
+from http_framing import parse_request_head, request_body_framer
+
+
+def extract_host_header(request_str):
+    """
+    The Host lookup of the load balancer before parse_request_head, unchanged
+    """
+    host_header: str = ""
+    lines = request_str.split("\r\n")
+    for line in lines:
+        if line.lower().startswith("host:"):
+            host_header = line.split(":", 1)[1].strip().split(":")[0]
+            break
+    return host_header
+
+
+def baseline(raw):
+    """
+    All the load balancer did with a request head before: decode it and find Host.
+    It did not validate the head, keep connections alive or frame request bodies.
+    """
+    request_str = raw.decode("utf-8")
+    return extract_host_header(request_str)
+
+
+def parse_host(raw):
+    """
+    The same lookup through parse_request_head, which also validates the head
+    """
+    return parse_request_head(raw).host
+
+
+def parse_request(raw):
+    """
+    Everything the load balancer now looks up in every request head: Host, keep-alive
+    and the body framer, which is built once per request
+    """
+    request = parse_request_head(raw)
+    request_body_framer(request)
+    return request.host, request.keep_alive()
+
+
+def build_head(extra_headers):
+    lines = [
+        "GET /static/app.js?v=123 HTTP/1.1",
+        "Host: round_robin.cn.edu:8000",
+        "User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 Firefox/120.0",
+        "Accept: */*",
+        "Accept-Encoding: gzip, deflate, br",
+        "Connection: keep-alive",
+    ]
+    lines += [f"X-Extra-{i}: {'v' * 40}" for i in range(extra_headers)]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def measure(funcs, raw, rounds, calls):
+    """
+    Time the functions on the same head in interleaved rounds, so that load on the
+    machine affects them alike, and keep each one's best round
+
+    :return: Parsed heads per second of each function
+    """
+    best = [float("inf")] * len(funcs)
+    for _ in range(rounds):
+        for i, func in enumerate(funcs):
+            start = time.perf_counter()
+            for _ in range(calls):
+                func(raw)
+            best[i] = min(best[i], time.perf_counter() - start)
+    return [calls / elapsed for elapsed in best]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the request head parser with the former Host lookup")
+    parser.add_argument("--rounds", type=int, default=10, help="Interleaved rounds per head size")
+    parser.add_argument("--calls", type=int, default=5000, help="Heads parsed per round")
+    args = parser.parse_args()
+
+    print(f"{'head':>16} {'baseline/s':>12} {'host/s':>12} {'ratio':>6} {'request/s':>12} {'ratio':>6}")
+    for name, extra in (("small", 0), ("typical", 10), ("large", 60)):
+        raw = build_head(extra)
+        base, host, request = measure((baseline, parse_host, parse_request), raw, args.rounds, args.calls)
+        label = f"{name} ({len(raw)}B)"
+        print(f"{label:>16} {base:>12,.0f} {host:>12,.0f} {host / base:>5.2f}x {request:>12,.0f} {request / base:>5.2f}x")
+    print("A ratio below 1 means slower than the baseline, which found Host and nothing else.")
+
+
+if __name__ == "__main__":
+    main()
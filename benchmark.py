@@ -0,0 +1,407 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+import urllib.parse
+import urllib.request
+
+
+# The scenarios, run against the default upstream groups and the default start_servers.py fleet
+SCENARIOS = {
+    "round_robin": {"host": "round_robin.cn.edu", "keep_alive": True},
+    "least_time": {"host": "least_time.cn.edu", "keep_alive": True},
+    "round_robin_no_keepalive": {"host": "round_robin.cn.edu", "keep_alive": False},
+    # 8081 carries 3/4 of the round robin traffic (weights 1, 3 and 2, and 8082's host does not resolve);
+    # it fails its health checks and answers requests after its 2s timeout, so the balancer has to
+    # retry, eject and route around it
+    "failing_backend": {"host": "round_robin.cn.edu", "keep_alive": True,
+                        "fault": (8081, {"error_rate": 1.0, "timeout_rate": 1.0, "latency": "fixed:3000"})},
+}
+CLOSED_LOOP = "closed"
+OPEN_LOOP = "open"
+MODES = [CLOSED_LOOP, OPEN_LOOP]
+PERCENTILES = (("p50", 50.0), ("p99", 99.0), ("p999", 99.9))
+REQUEST_TIMEOUT = 10.0
+# Requests of an open-loop run that may be outstanding at once; later arrivals are dropped
+MAX_OUTSTANDING = 10000
+
+
+class Recorder:
+    def __init__(self, measure_from):
+        """
+        Collects the outcome of the requests of one run
+
+        :param measure_from: The time.monotonic() measuring starts at; requests started
+            earlier are the warm-up and are not recorded
+        """
+        self.measure_from = measure_from
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.dropped = 0
+
+    def record(self, started, status):
+        if started < self.measure_from:
+            return
+        self.latencies.append(time.monotonic() - started)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if not isinstance(status, int) or status >= 500:
+            self.errors += 1
+
+    def summary(self, duration):
+        latencies = sorted(self.latencies)
+        requests = len(latencies)
+        result = {
+            "requests": requests,
+            "rps": round(requests / duration, 1),
+            "errors": self.errors,
+            "error_rate": round(self.errors / requests, 4) if requests else 0.0,
+            "dropped": self.dropped,
+            "statuses": {str(status): count for status, count in sorted(self.statuses.items(), key=str)},
+            "latency_ms": {},
+        }
+        for name, percent in PERCENTILES:
+            result["latency_ms"][name] = round(percentile(latencies, percent) * 1000, 3)
+        result["latency_ms"]["mean"] = round(sum(latencies) / requests * 1000, 3) if requests else 0.0
+        result["latency_ms"]["max"] = round(latencies[-1] * 1000, 3) if requests else 0.0
+        return result
+
+
+def percentile(ordered, percent):
+    """
+    Return the nearest-rank percentile of sorted values, 0.0 if there are none
+    """
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(len(ordered) * percent / 100.0) - 1))]
+
+
+class Client:
+    def __init__(self, host, port, virtual_host, keep_alive):
+        """
+        A minimal HTTP/1.1 client on asyncio streams that keeps idle connections for reuse
+
+        :param virtual_host: The Host header of the requests, selecting the upstream group
+        :param keep_alive: Reuse connections; otherwise every request opens its own
+        """
+        self.host = host
+        self.port = port
+        self.keep_alive = keep_alive
+        connection = b"keep-alive" if keep_alive else b"close"
+        self.request = b"GET / HTTP/1.1\r\nHost: %s\r\nConnection: %s\r\n\r\n" % (virtual_host.encode(), connection)
+        self._idle = []
+
+    async def fetch(self, timeout=REQUEST_TIMEOUT):
+        """
+        Send one request and read its response
+
+        :return: The status code, or the name of the error that ended the request
+        """
+        conn = self._idle.pop() if self._idle else None
+        try:
+            if conn is None:
+                conn = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), timeout)
+            status, reusable = await asyncio.wait_for(self._exchange(*conn), timeout)
+        except (OSError, EOFError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            if conn is not None:
+                conn[1].close()
+            return type(e).__name__
+        if reusable and self.keep_alive:
+            self._idle.append(conn)
+        else:
+            conn[1].close()
+        return status
+
+    async def _exchange(self, reader, writer):
+        writer.write(self.request)
+        await writer.drain()
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        status = int(lines[0].split()[1])
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip().lower()
+        reusable = headers.get("connection") != "close"
+        if headers.get("transfer-encoding") == "chunked":
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        elif "content-length" in headers:
+            await reader.readexactly(int(headers["content-length"]))
+        elif status not in (204, 304):
+            await reader.read()
+            reusable = False
+        return status, reusable
+
+    def close(self):
+        for reader, writer in self._idle:
+            writer.close()
+        self._idle = []
+
+
+async def closed_loop(client, recorder, concurrency, end):
+    """
+    Run concurrency workers that each send their next request when the last one is answered
+    """
+    async def worker():
+        while time.monotonic() < end:
+            started = time.monotonic()
+            recorder.record(started, await client.fetch())
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def open_loop(client, recorder, rate, end):
+    """
+    Send requests at a constant rate whether or not earlier ones were answered
+
+    Latency is measured from the time a request was due rather than when it was sent,
+    so a stalled balancer shows in the percentiles instead of slowing the load down.
+    """
+    outstanding = set()
+
+    async def request(due):
+        recorder.record(due, await client.fetch())
+
+    start = time.monotonic()
+    sent = 0
+    while True:
+        due = start + sent / rate
+        if due >= end:
+            break
+        delay = due - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        sent += 1
+        if len(outstanding) >= MAX_OUTSTANDING:
+            if due >= recorder.measure_from:
+                recorder.dropped += 1
+            continue
+        task = asyncio.ensure_future(request(due))
+        outstanding.add(task)
+        task.add_done_callback(outstanding.discard)
+    if outstanding:
+        await asyncio.wait(outstanding)
+
+
+async def run_load(scenario, args, on_measure=None):
+    """
+    Warm up, then measure the load of a scenario
+
+    :param on_measure: Called in a thread when measuring starts, e.g. to inject a fault
+    """
+    client = Client(args.lb_host, args.lb_port, scenario["host"], scenario["keep_alive"])
+    measure_from = time.monotonic() + args.warmup
+    recorder = Recorder(measure_from)
+    end = measure_from + args.duration
+
+    async def start_measuring():
+        await asyncio.sleep(args.warmup)
+        await asyncio.get_running_loop().run_in_executor(None, on_measure)
+
+    measuring = asyncio.ensure_future(start_measuring()) if on_measure else None
+    try:
+        if args.mode == CLOSED_LOOP:
+            await closed_loop(client, recorder, args.concurrency, end)
+        else:
+            await open_loop(client, recorder, args.rate, end)
+    finally:
+        client.close()
+        if measuring is not None:
+            await measuring
+    return recorder.summary(args.duration)
+
+
+def control(args, method, path):
+    """
+    Call the control channel of the start_servers.py fleet and return its JSON answer
+    """
+    request = urllib.request.Request(f"http://localhost:{args.control_port}{path}", method=method)
+    with urllib.request.urlopen(request, timeout=5.0) as response:
+        return json.loads(response.read())
+
+
+def set_backend(args, port, settings):
+    query = urllib.parse.urlencode(settings)
+    return control(args, "POST", f"/servers/{port}?{query}")
+
+
+def run_scenario(name, args):
+    """
+    Run one scenario, injecting its fault when the warm-up ends and undoing it afterwards,
+    so the measurement includes how the balancer reacts to the fault
+
+    :return: The summary of the run with the scenario and load settings
+    """
+    scenario = SCENARIOS[name]
+    fault = scenario.get("fault")
+    inject = restore = None
+    if fault:
+        port, settings = fault
+        restore = control(args, "GET", "/servers")[str(port)]
+        inject = lambda: set_backend(args, port, settings)
+    try:
+        result = asyncio.run(run_load(scenario, args, inject))
+    finally:
+        if restore is not None:
+            set_backend(args, port, restore)
+    result.update(scenario=name, mode=args.mode, keep_alive=scenario["keep_alive"], duration=args.duration)
+    if args.mode == CLOSED_LOOP:
+        result["concurrency"] = args.concurrency
+    else:
+        result["rate"] = args.rate
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results with a baseline of the same scenarios and mode
+
+    A run regresses when its throughput drops, or its p99 latency or error rate grows,
+    by more than tolerance (a fraction) against the baseline.
+
+    :return: The names of the regressed runs
+    """
+    regressions = []
+    print(f"{'run':>34} {'base rps':>10} {'rps':>10} {'change':>8} {'base p99':>10} {'p99':>10} {'change':>8}")
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            print(f"{key:>34} {'(not in baseline)':>20}")
+            continue
+        rps_change = result["rps"] / base["rps"] - 1 if base["rps"] else 0.0
+        p99, base_p99 = result["latency_ms"]["p99"], base["latency_ms"]["p99"]
+        p99_change = p99 / base_p99 - 1 if base_p99 else 0.0
+        regressed = (rps_change < -tolerance or p99_change > tolerance
+                     or result["error_rate"] > base["error_rate"] + tolerance * max(base["error_rate"], 0.01))
+        print(f"{key:>34} {base['rps']:>10,.1f} {result['rps']:>10,.1f} {rps_change:>+8.1%} "
+              f"{base_p99:>10.2f} {p99:>10.2f} {p99_change:>+8.1%}{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(key)
+    return regressions
+
+
+def wait_for_port(port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("localhost", port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def launch(args):
+    """
+    Start the start_servers.py fleet and the load balancer for the run
+
+    :return: The started processes
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    fleet = subprocess.Popen([sys.executable, os.path.join(here, "start_servers.py"), "--engine", "asyncio", "--quiet",
+                              "--control-port", str(args.control_port)],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # The load balancer quits when its command input ends, so it gets a pipe that stays open
+    lb = subprocess.Popen([sys.executable, os.path.join(here, "http_load_balancer.py"), "--engine", args.engine,
+                           "--port", str(args.lb_port)],
+                          stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if not wait_for_port(args.control_port, 30.0) or not wait_for_port(args.lb_port, 30.0):
+        stop([fleet, lb])
+        raise RuntimeError("The fleet or the load balancer did not start")
+    # Let the first health checks settle
+    time.sleep(2.0)
+    return [fleet, lb]
+
+
+def stop(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(5.0)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the load balancer against the start_servers.py fleet")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="Scenario to run, may be repeated (default: all)")
+    parser.add_argument("--mode", choices=MODES, default=CLOSED_LOOP,
+                        help="closed: a fixed number of concurrent clients; open: a constant arrival rate")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent clients of a closed-loop run")
+    parser.add_argument("--rate", type=float, default=500.0, help="Requests per second of an open-loop run")
+    parser.add_argument("--duration", type=float, default=10.0, help="Measured seconds per scenario")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Unmeasured seconds before each scenario")
+    parser.add_argument("--lb-host", default="localhost")
+    parser.add_argument("--lb-port", type=int, default=8000)
+    parser.add_argument("--control-port", type=int, default=8079, help="Control port of the start_servers.py fleet")
+    parser.add_argument("--launch", action="store_true",
+                        help="Start the fleet and the load balancer instead of using running ones")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads",
+                        help="Engine of the launched load balancer")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare with the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="Change against the baseline that counts as a regression (default 0.10)")
+    args = parser.parse_args()
+    if args.concurrency < 1 or args.rate <= 0 or args.duration <= 0 or args.warmup < 0:
+        parser.error("--concurrency, --rate and --duration must be positive")
+
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+    processes = launch(args) if args.launch else []
+    results = {}
+    try:
+        print(f"{'run':>34} {'requests':>9} {'rps':>10} {'p50 ms':>9} {'p99 ms':>9} {'p999 ms':>9} {'errors':>7}")
+        for name in args.scenario or list(SCENARIOS):
+            result = run_scenario(name, args)
+            key = f"{name}/{args.mode}"
+            results[key] = result
+            latency = result["latency_ms"]
+            print(f"{key:>34} {result['requests']:>9} {result['rps']:>10,.1f} {latency['p50']:>9.2f} "
+                  f"{latency['p99']:>9.2f} {latency['p999']:>9.2f} {result['errors']:>7}")
+    finally:
+        stop(processes)
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "engine": args.engine if args.launch else None,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        print()
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
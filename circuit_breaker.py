@@ -0,0 +1,259 @@
+import collections
+import math
+import threading
+import time
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+BREAKER_STATES = (CLOSED, OPEN, HALF_OPEN)
+
+# Defaults for servers and groups that do not set their own breaker options
+BREAKER_CONSECUTIVE_FAILURES = 5
+BREAKER_ERROR_RATE = 0.5
+BREAKER_WINDOW = 10.0
+BREAKER_MIN_REQUESTS = 20
+BREAKER_EJECTION_TIME = 5.0
+BREAKER_MAX_EJECTION_TIME = 300.0
+BREAKER_HALF_OPEN_REQUESTS = 1
+MAX_EJECTION_PERCENT = 50
+
+
+class CircuitBreaker:
+    def __init__(self):
+        """
+        Passive outlier detection state of one upstream server
+
+        The breaker is closed while the server answers normally. It opens, ejecting
+        the server, after "breaker_consecutive_failures" failures in a row, or when at
+        least "breaker_min_requests" requests in the last "breaker_window" seconds
+        failed at a rate of "breaker_error_rate" or more. The ejection lasts
+        "breaker_ejection_time" seconds, doubled for every ejection since the server
+        last stayed closed for "breaker_max_ejection_time", which also caps it. Then the
+        breaker is half-open: up to "breaker_half_open_requests" trial requests at a
+        time reach the server, and that many successes close the breaker while a
+        failure opens it again. Each option can be set per server.
+        """
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.trial_successes = 0
+        # Trial requests in flight while half-open
+        self.trials = 0
+        self.ejections = 0
+        self.open_until = 0.0
+        self.closed_since = time.monotonic()
+        # [second, requests, failures] per second of the sliding window
+        self._window = collections.deque()
+        self._lock = threading.Lock()
+
+    def _count(self, failed, now, window):
+        second = math.floor(now)
+        if self._window and self._window[-1][0] == second:
+            bucket = self._window[-1]
+        else:
+            bucket = [second, 0, 0]
+            self._window.append(bucket)
+        bucket[1] += 1
+        bucket[2] += failed
+        while self._window and self._window[0][0] <= now - window:
+            self._window.popleft()
+
+    def error_rate(self):
+        """
+        Return the failed fraction and number of requests in the sliding window
+        """
+        requests = sum(bucket[1] for bucket in self._window)
+        failures = sum(bucket[2] for bucket in self._window)
+        return (failures / requests if requests else 0.0), requests
+
+    def record(self, server, failed, now):
+        """
+        Count one request result
+
+        :return: True if the breaker should open now; the caller decides whether the
+            server may be ejected and then calls trip
+        """
+        with self._lock:
+            if self.state == OPEN:
+                return False
+            if self.state == HALF_OPEN:
+                if failed:
+                    return True
+                self.trial_successes += 1
+                if self.trial_successes >= server.get("breaker_half_open_requests", BREAKER_HALF_OPEN_REQUESTS):
+                    self.state = CLOSED
+                    self.closed_since = now
+                    self.consecutive_failures = 0
+                    self._window.clear()
+                return False
+
+            if self.ejections and now - self.closed_since >= server.get(
+                    "breaker_max_ejection_time", BREAKER_MAX_EJECTION_TIME):
+                self.ejections = 0
+            self._count(failed, now, server.get("breaker_window", BREAKER_WINDOW))
+            if not failed:
+                self.consecutive_failures = 0
+                return False
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= server.get("breaker_consecutive_failures", BREAKER_CONSECUTIVE_FAILURES):
+                return True
+            rate, requests = self.error_rate()
+            return (requests >= server.get("breaker_min_requests", BREAKER_MIN_REQUESTS)
+                    and rate >= server.get("breaker_error_rate", BREAKER_ERROR_RATE))
+
+    def trip(self, server, now):
+        """
+        Open the breaker for the server's current ejection time
+
+        :return: The ejection time in seconds
+        """
+        with self._lock:
+            base = server.get("breaker_ejection_time", BREAKER_EJECTION_TIME)
+            duration = min(base * 2 ** self.ejections, server.get("breaker_max_ejection_time", BREAKER_MAX_EJECTION_TIME))
+            self.ejections += 1
+            self.state = OPEN
+            self.open_until = now + duration
+            self.trial_successes = 0
+            self.trials = 0
+            self.consecutive_failures = 0
+            self._window.clear()
+            return duration
+
+    def stay_closed(self):
+        """
+        Handle a trip that the ejection limit refused: a closed breaker keeps counting,
+        so the next failure asks again, and a half-open one closes
+        """
+        with self._lock:
+            if self.state == HALF_OPEN:
+                # A failed trial that may not eject the server closes the breaker instead
+                self.state = CLOSED
+                self.closed_since = time.monotonic()
+
+    def half_open(self):
+        with self._lock:
+            self.state = HALF_OPEN
+            self.trial_successes = 0
+            self.trials = 0
+
+    def start_trial(self, limit):
+        """
+        Let a request through: always while closed, never while open, and while half-open
+        only if fewer than limit trial requests are in flight, reserving a trial for it
+
+        The check and the reservation are one step under the lock, so concurrent
+        selections cannot both take the last trial.
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN or self.trials >= limit:
+                return False
+            self.trials += 1
+            return True
+
+    def end_trial(self):
+        """
+        Give back the trial a finished or abandoned request reserved
+        """
+        with self._lock:
+            if self.trials:
+                self.trials -= 1
+
+
+def server_breaker(server):
+    """
+    Return the CircuitBreaker of an upstream server entry, creating it on first use
+    """
+    breaker = server.get("breaker")
+    if breaker is None:
+        breaker = server.setdefault("breaker", CircuitBreaker())
+    return breaker
+
+
+def is_ejected(server):
+    breaker = server.get("breaker")
+    return breaker is not None and breaker.state == OPEN
+
+
+class OutlierDetector:
+    def __init__(self):
+        """
+        Feeds proxied request results into the servers' circuit breakers
+
+        A server is only ejected while fewer than "max_ejection_percent" percent of
+        every group it belongs to would be ejected with it, so a group-wide failure
+        does not empty the group. Ejected servers are expected to be left out of
+        their groups' schedulers; poll puts them back half-open once their ejection
+        time has passed.
+        """
+        self.wakeup = math.inf
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def record(self, server, failed, groups):
+        """
+        Count one request result, ejecting the server if its breaker trips
+
+        :param groups: The upstream groups the server belongs to
+        :return: The ejection time in seconds if the server was ejected, otherwise None
+        """
+        breaker = server_breaker(server)
+        now = time.monotonic()
+        if not breaker.record(server, failed, now):
+            return None
+        with self._lock:
+            if not self._may_eject(server, groups):
+                breaker.stay_closed()
+                return None
+            duration = breaker.trip(server, now)
+            self._open[id(server)] = server
+            self.wakeup = min(self.wakeup, breaker.open_until)
+        return duration
+
+    @staticmethod
+    def _may_eject(server, groups):
+        for group in groups:
+            servers = group["servers"]
+            ejected = sum(1 for s in servers if s is not server and is_ejected(s))
+            if (ejected + 1) * 100 > group.get("max_ejection_percent", MAX_EJECTION_PERCENT) * len(servers):
+                return False
+        return True
+
+    @staticmethod
+    def allow(server):
+        """
+        Whether a selected server may take the request: always while closed, and while
+        half-open only if one of its "breaker_half_open_requests" trials is free, which
+        is then reserved until release is called for the request
+        """
+        breaker = server.get("breaker")
+        if breaker is None:
+            return True
+        return breaker.start_trial(server.get("breaker_half_open_requests", BREAKER_HALF_OPEN_REQUESTS))
+
+    @staticmethod
+    def release(server):
+        """
+        End a request to a server that allow let through, freeing its trial if it had one
+        """
+        breaker = server.get("breaker")
+        if breaker is not None:
+            breaker.end_trial()
+
+    def poll(self, now):
+        """
+        Put the servers whose ejection time has passed back as half-open
+
+        :return: The servers that became half-open
+        """
+        if now < self.wakeup:
+            return []
+        with self._lock:
+            expired = [s for s in self._open.values() if server_breaker(s).open_until <= now]
+            for server in expired:
+                del self._open[id(server)]
+                server_breaker(server).half_open()
+            self.wakeup = min((server_breaker(s).open_until for s in self._open.values()), default=math.inf)
+        return expired
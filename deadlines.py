@@ -0,0 +1,145 @@
+import asyncio
+import math
+import socket
+import time
+
+
+# The timeouts of an upstream request, as counted in the statistics
+CONNECT = "connect"
+FIRST_BYTE = "first_byte"
+IDLE = "idle"
+TOTAL = "total"
+TIMEOUT_KINDS = (CONNECT, FIRST_BYTE, IDLE, TOTAL)
+
+# Server options that may also be set per group; the server's value wins
+TIMEOUT_OPTIONS = ("timeout", "connect_timeout", "first_byte_timeout", "read_timeout", "request_timeout")
+UPSTREAM_TIMEOUT = 2.0
+
+
+class UpstreamTimeout(socket.timeout):
+    def __init__(self, kind):
+        """
+        Raised when an upstream request runs out of one of its timeouts
+
+        :param kind: Which timeout ran out, one of TIMEOUT_KINDS
+        """
+        super().__init__(f"{kind.replace('_', ' ')} timeout")
+        self.kind = kind
+
+
+class Deadline:
+    def __init__(self, server, start=None):
+        """
+        The timeouts of one request to an upstream server
+
+        "connect_timeout" bounds opening the connection, "first_byte_timeout" the wait
+        for the first response byte once the request is sent, and "read_timeout" every
+        other wait for the upstream, i.e. how long the exchange may stall. Each falls
+        back to the server's "timeout". "request_timeout", if set, bounds the whole
+        exchange from connecting to the last response byte, and every wait is cut
+        down to what is left of it.
+
+        :param server: The upstream server entry
+        :param start: The time.monotonic() the request started at, defaults to now
+        """
+        timeout = server.get("timeout", UPSTREAM_TIMEOUT)
+        self.timeouts = {
+            CONNECT: server.get("connect_timeout", timeout),
+            FIRST_BYTE: server.get("first_byte_timeout", timeout),
+            IDLE: server.get("read_timeout", timeout),
+        }
+        total = server.get("request_timeout")
+        self.expires = math.inf if total is None else (time.monotonic() if start is None else start) + total
+
+    def timeout(self, kind):
+        """
+        Return how long the next wait may take
+
+        :param kind: CONNECT, FIRST_BYTE or IDLE
+        :return: (seconds, kind), where kind is TOTAL if the request deadline is nearer
+        :raises UpstreamTimeout: If the request deadline has already passed
+        """
+        left = self.expires - time.monotonic()
+        if left <= 0:
+            raise UpstreamTimeout(TOTAL)
+        seconds = self.timeouts[kind]
+        if left < seconds:
+            return left, TOTAL
+        return seconds, kind
+
+
+class DeadlineSocket:
+    def __init__(self, sock, deadline):
+        """
+        An upstream socket whose every wait follows a Deadline
+
+        Reads wait for the first byte timeout until the first response bytes arrive and
+        for the read timeout after that; sends wait for the read timeout. A timeout
+        raises UpstreamTimeout naming the timeout that ran out. Pass it wherever a
+        socket is read or written, e.g. to read_head and relay_body.
+        """
+        self.sock = sock
+        self.deadline = deadline
+        self.kind = FIRST_BYTE
+
+    def _wait(self, kind, operation, *args):
+        seconds, kind = self.deadline.timeout(kind)
+        self.sock.settimeout(seconds)
+        try:
+            return operation(*args)
+        except socket.timeout:
+            raise UpstreamTimeout(kind) from None
+
+    def recv(self, size):
+        data = self._wait(self.kind, self.sock.recv, size)
+        if data:
+            self.kind = IDLE
+        return data
+
+    def recv_into(self, buffer, size=0):
+        received = self._wait(self.kind, self.sock.recv_into, buffer, size)
+        if received:
+            self.kind = IDLE
+        return received
+
+    def sendall(self, data):
+        self._wait(IDLE, self.sock.sendall, data)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+class AsyncDeadlineStream:
+    def __init__(self, conn, deadline):
+        """
+        The asyncio counterpart of DeadlineSocket for a (reader, writer) pair
+
+        It has the read, write and drain methods of both, so it can be passed as the
+        reader or the writer to async_read_head and async_relay_body.
+        """
+        self.reader, self.writer = conn
+        self.deadline = deadline
+        self.kind = FIRST_BYTE
+
+    async def _wait(self, kind, awaitable):
+        try:
+            seconds, kind = self.deadline.timeout(kind)
+        except UpstreamTimeout:
+            awaitable.close()
+            raise
+        try:
+            return await asyncio.wait_for(awaitable, seconds)
+        except asyncio.TimeoutError:
+            raise UpstreamTimeout(kind) from None
+
+    async def read(self, size=-1):
+        data = await self._wait(self.kind, self.reader.read(size))
+        if data:
+            self.kind = IDLE
+        return data
+
+    def write(self, data):
+        self.writer.write(data)
+
+    async def drain(self):
+        await self._wait(IDLE, self.writer.drain())
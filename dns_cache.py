@@ -0,0 +1,222 @@
+import ipaddress
+import socket
+import threading
+import time
+
+
+# Seconds an answer is cached when the resolver does not report a TTL
+DNS_TTL = 30.0
+# Seconds before a failed lookup is tried again
+DNS_NEGATIVE_TTL = 5.0
+# Lower bound on any TTL, so a zero TTL does not turn into a lookup per second
+DNS_MIN_TTL = 1.0
+# Fraction of the TTL after which an answer is refreshed in the background
+DNS_REFRESH_AHEAD = 0.8
+DNS_REFRESH_INTERVAL = 1.0
+
+
+def is_ip_address(host):
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+def system_resolver(host):
+    """
+    Resolve the IPv4 addresses of a host
+
+    dnspython, if installed, is asked first because it reports the answer's TTL;
+    otherwise, or if it finds nothing, getaddrinfo is used, which also reads
+    /etc/hosts but cannot tell the TTL.
+
+    :return: The addresses and their TTL in seconds, or None if it is not known
+    :raises OSError: If the host cannot be resolved
+    """
+    try:
+        import dns.exception
+        import dns.resolver
+    except ImportError:
+        pass
+    else:
+        try:
+            answer = dns.resolver.resolve(host, "A")
+            return [record.address for record in answer], answer.rrset.ttl
+        except dns.exception.DNSException:
+            pass
+    infos = socket.getaddrinfo(host, None, socket.AF_INET, socket.SOCK_STREAM)
+    return [info[4][0] for info in infos], None
+
+
+class DNSRecord:
+    def __init__(self, addresses, ttl, error=""):
+        """
+        A cached answer: the sorted addresses of a host and when to refresh them
+
+        :param addresses: The resolved addresses, empty if the host never resolved
+        :param ttl: Seconds the answer is valid
+        :param error: Why the latest lookup failed, if it did
+        """
+        now = time.monotonic()
+        self.addresses = addresses
+        self.ttl = ttl
+        self.expires = now + ttl
+        self.refresh_at = now + ttl * DNS_REFRESH_AHEAD
+        self.error = error
+
+
+class DNSCache:
+    def __init__(self, resolver=system_resolver, default_ttl=DNS_TTL, negative_ttl=DNS_NEGATIVE_TTL,
+                 min_ttl=DNS_MIN_TTL):
+        """
+        Cache of upstream host addresses that is refreshed in the background
+
+        Only the first lookup of a host blocks. After that, lookup returns the cached
+        addresses, and refresh_due resolves every host again shortly before its TTL
+        runs out, so proxied requests and health checks never wait for the resolver.
+        When a refresh fails, the last good answer is kept and retried every
+        negative_ttl seconds.
+
+        :param resolver: A function returning (addresses, ttl or None) of a host
+        :param default_ttl: Seconds an answer without a TTL is cached
+        :param negative_ttl: Seconds before a failed lookup is retried
+        :param min_ttl: Lower bound on the TTL of any answer
+        """
+        self.resolver = resolver
+        self.default_ttl = default_ttl
+        self.negative_ttl = negative_ttl
+        self.min_ttl = min_ttl
+        self.counters = {"hits": 0, "misses": 0, "refreshes": 0, "failures": 0}
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, host):
+        """
+        Return the addresses of a host, resolving it only if it has never been looked up
+
+        IP addresses are returned as they are.
+
+        :return: A sorted list of addresses, empty if the host cannot be resolved
+        """
+        if is_ip_address(host):
+            return [host]
+        with self._lock:
+            record = self._records.get(host)
+            self.counters["hits" if record is not None else "misses"] += 1
+        if record is None:
+            record = self._resolve(host)
+        return list(record.addresses)
+
+    def _resolve(self, host):
+        try:
+            addresses, ttl = self.resolver(host)
+            addresses = sorted(set(addresses))
+            if not addresses:
+                raise OSError(f"No addresses for {host}")
+            record = DNSRecord(addresses, max(self.min_ttl, self.default_ttl if ttl is None else ttl))
+        except (OSError, UnicodeError) as e:
+            with self._lock:
+                old = self._records.get(host)
+                self.counters["failures"] += 1
+            record = DNSRecord(old.addresses if old else [], self.negative_ttl, str(e))
+        with self._lock:
+            self._records[host] = record
+        return record
+
+    def refresh_due(self):
+        """
+        Resolve again every host whose answer is close to expiring
+
+        :return: The hosts whose addresses changed
+        """
+        now = time.monotonic()
+        with self._lock:
+            due = [(host, record) for host, record in self._records.items() if now >= record.refresh_at]
+        changed = set()
+        for host, old in due:
+            record = self._resolve(host)
+            with self._lock:
+                self.counters["refreshes"] += 1
+            if record.addresses != old.addresses:
+                changed.add(host)
+        return changed
+
+    def retain(self, hosts):
+        """
+        Forget the hosts that are no longer configured, so they are not refreshed
+        """
+        with self._lock:
+            for host in [host for host in self._records if host not in hosts]:
+                del self._records[host]
+
+    def records(self):
+        with self._lock:
+            return dict(self._records)
+
+    def preload(self, records):
+        """
+        Start with answers looked up by another cache, e.g. the one of a worker's master
+
+        :param records: DNSRecords keyed by host, as returned by records
+        """
+        with self._lock:
+            self._records.update(records)
+
+    def run(self, is_running, on_change, interval=DNS_REFRESH_INTERVAL):
+        """
+        Refresh answers until is_running returns False
+
+        :param on_change: Called with the set of hosts whose addresses changed
+        """
+        while is_running():
+            changed = self.refresh_due()
+            if changed:
+                on_change(changed)
+            time.sleep(interval)
+
+
+def target_address(server, cache=None):
+    """
+    Return the address to connect to for an upstream server entry
+
+    A target expanded by expand_upstream_groups has its own "address". For any other
+    entry the host is looked up in the cache, never in the system resolver directly.
+
+    :raises OSError: If the host has no known address
+    """
+    address = server.get("address")
+    if address:
+        return address
+    if cache is None:
+        return server["host"]
+    addresses = cache.lookup(server["host"])
+    if not addresses:
+        raise OSError(f"Cannot resolve {server['host']}")
+    return addresses[0]
+
+
+def expand_upstream_groups(upstream_groups, cache):
+    """
+    Turn every configured server into one balancing target per resolved address
+
+    Each target is a copy of the configured entry with an "address" key, so it keeps
+    the configured host (sent as Host in health checks), port, weight and options.
+    A server given by IP address, or whose host does not resolve yet, stays a single
+    entry without an address.
+
+    :param upstream_groups: Upstream groups as configured, which are not modified
+    :param cache: The DNSCache to look hosts up in
+    :return: New upstream group dicts keyed by group name
+    """
+    expanded = {}
+    for name, group in upstream_groups.items():
+        servers = []
+        for server in group["servers"]:
+            addresses = [] if is_ip_address(server["host"]) else cache.lookup(server["host"])
+            if addresses:
+                servers.extend(dict(server, address=address) for address in addresses)
+            else:
+                servers.append(dict(server))
+        expanded[name] = dict(group, servers=servers)
+    return expanded
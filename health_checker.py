@@ -0,0 +1,154 @@
+import asyncio
+import random
+import time
+
+from dns_cache import target_address
+from upstream_pool import server_id
+
+
+# Defaults for servers that do not set their own health check options
+HEALTH_INTERVAL = 5.0
+HEALTH_FAST_INTERVAL = 1.0
+HEALTH_JITTER = 0.2
+HEALTH_RISE = 2
+HEALTH_FALL = 2
+HEALTH_MAX_CONCURRENT = 64
+
+
+class ServerHealth:
+    def __init__(self):
+        """
+        Health check history of one upstream server
+        """
+        self.successes = 0
+        self.failures = 0
+        self.checks = 0
+        self.failed_checks = 0
+        self.last_duration = None
+        self.total_duration = 0.0
+        self.last_error = ""
+
+
+class HealthChecker:
+    def __init__(self, lb, max_concurrent=HEALTH_MAX_CONCURRENT):
+        """
+        Concurrent active health checker running on its own asyncio event loop
+
+        Every upstream server is probed by its own task on its own schedule:
+        "health_interval" seconds between checks with +/- "health_jitter" randomization,
+        and "health_fast_interval" while the server is unhealthy or failing. A healthy
+        server is marked unhealthy after "health_fall" consecutive failed checks and
+        an unhealthy one healthy again after "health_rise" consecutive passed checks,
+        so a single failure does not flap a node. Each option can be set per server.
+
+        :param lb: The HTTPLoadBalancer whose upstream servers are checked
+        :param max_concurrent: The most checks in flight at the same time
+        """
+        self.lb = lb
+        self.max_concurrent = max_concurrent
+        self.history = {}
+        self._tasks = {}
+        self._semaphore = None
+
+    def run(self):
+        """
+        Run the checker until the load balancer stops
+        """
+        asyncio.run(self._run())
+
+    async def _run(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        while self.lb.running:
+            self._reconcile()
+            await asyncio.sleep(1.0)
+        for task in self._tasks.values():
+            task.cancel()
+
+    def _reconcile(self):
+        """
+        Start a task for every configured server and stop the tasks of removed ones
+        """
+        servers = {id(srv): srv for grp in self.lb.upstream_groups.values() for srv in grp["servers"]}
+        for key in list(self._tasks):
+            if key not in servers:
+                self._tasks.pop(key).cancel()
+                self.history.pop(key, None)
+        for key, server in servers.items():
+            if key not in self._tasks:
+                self._tasks[key] = asyncio.ensure_future(self._watch(server))
+
+    async def _watch(self, server):
+        # Spread the first checks out instead of probing every server at once
+        await asyncio.sleep(random.uniform(0, min(1.0, server.get("health_interval", HEALTH_INTERVAL))))
+        while self.lb.running:
+            async with self._semaphore:
+                healthy, duration, error = await self.probe(server)
+            state = self.record(server, healthy, duration, error)
+
+            if not server.get("healthy", True) or state.failures:
+                interval = server.get("health_fast_interval", HEALTH_FAST_INTERVAL)
+            else:
+                interval = server.get("health_interval", HEALTH_INTERVAL)
+            jitter = server.get("health_jitter", HEALTH_JITTER)
+            await asyncio.sleep(interval * random.uniform(1 - jitter, 1 + jitter))
+
+    async def probe(self, server):
+        """
+        Make one health check request to the server's /healthz endpoint
+
+        :return: Whether it answered 200, how long the check took and the error if any
+        """
+        health_request = (
+            "GET /healthz HTTP/1.1\r\n"
+            f"Host: {server['host']}\r\n"
+            "Connection: close\r\n"
+            "\r\n"
+        )
+        writer = None
+        start_time = time.monotonic()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(target_address(server, self.lb.dns), server["port"]), server["timeout"]
+            )
+            writer.write(health_request.encode('utf-8'))
+            status_line = await asyncio.wait_for(reader.readline(), server["timeout"])
+            parts = status_line.split()
+            if len(parts) >= 2 and parts[1] == b"200":
+                return True, time.monotonic() - start_time, ""
+            return False, time.monotonic() - start_time, status_line.decode('latin-1').strip() or "empty response"
+        except asyncio.TimeoutError:
+            return False, time.monotonic() - start_time, "timeout"
+        except Exception as e:
+            return False, time.monotonic() - start_time, str(e)
+        finally:
+            if writer:
+                writer.close()
+
+    def record(self, server, healthy, duration, error=""):
+        """
+        Apply one check result with rise/fall thresholds
+
+        :return: The updated ServerHealth of the server
+        """
+        state = self.history.setdefault(id(server), ServerHealth())
+        state.checks += 1
+        state.last_duration = duration
+        state.total_duration += duration
+
+        if healthy:
+            state.successes += 1
+            state.failures = 0
+            # Check latency stands in for the response time of a server without recent requests
+            self.lb.observe_probe_time(server, duration)
+            if not server.get("healthy", True) and state.successes >= server.get("health_rise", HEALTH_RISE):
+                print(f"Health check: {server_id(server)} is healthy again")
+                self.lb.set_server_health(server, True)
+        else:
+            state.failures += 1
+            state.successes = 0
+            state.failed_checks += 1
+            state.last_error = error
+            if server.get("healthy", True) and state.failures >= server.get("health_fall", HEALTH_FALL):
+                print(f"Health check failed for {server_id(server)}: {error}")
+                self.lb.set_server_health(server, False)
+        return state
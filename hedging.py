@@ -0,0 +1,57 @@
+import threading
+
+
+# Methods whose requests may be hedged: idempotent and without a body
+HEDGE_METHODS = ("GET", "HEAD")
+# Defaults for groups that do not set their own hedging options
+HEDGE_BUDGET_PERCENT = 10
+HEDGE_BUDGET_MIN = 1
+# Recent response head latencies kept per group, and how many are needed before hedging
+HEDGE_WINDOW = 512
+HEDGE_MIN_SAMPLES = 20
+# New samples after which the cached percentile is computed again
+HEDGE_RECOMPUTE = 32
+
+
+class LatencyWindow:
+    def __init__(self, size=HEDGE_WINDOW):
+        """
+        The most recent response head latencies of an upstream group, in a ring buffer
+
+        Percentiles are computed by sorting the window, at most once per HEDGE_RECOMPUTE
+        new samples, so asking for the hedge delay on every request stays cheap.
+
+        :param size: The number of latencies kept
+        """
+        self.size = size
+        self._samples = []
+        self._next = 0
+        self._added = 0
+        self._sorted = None
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            if len(self._samples) < self.size:
+                self._samples.append(seconds)
+            else:
+                self._samples[self._next] = seconds
+            self._next = (self._next + 1) % self.size
+            self._added += 1
+            if self._added >= HEDGE_RECOMPUTE:
+                self._sorted = None
+
+    def percentile(self, percent):
+        """
+        Return the latency below which the given percent of recent samples fall,
+        or None while there are fewer than HEDGE_MIN_SAMPLES
+        """
+        with self._lock:
+            if len(self._samples) < HEDGE_MIN_SAMPLES:
+                return None
+            if self._sorted is None:
+                self._sorted = sorted(self._samples)
+                self._added = 0
+            ordered = self._sorted
+        index = min(len(ordered) - 1, int(len(ordered) * percent / 100.0))
+        return ordered[index]
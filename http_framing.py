@@ -0,0 +1,658 @@
+import asyncio
+import re
+
+
+# Largest request or response head accepted, and the most header lines in one head
+MAX_HEAD_SIZE = 65536
+MAX_HEADERS = 100
+# Size of the fixed buffer used to move bodies, which bounds the memory per transfer
+BUFFER_SIZE = 65536
+# Methods whose effect is the same however often a request is repeated (RFC 9110, 9.2.2)
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "TRACE", "PUT", "DELETE"))
+# Longest chunk-size or trailer line accepted in a chunked body
+MAX_CHUNK_LINE = 4096
+# Most hex digits in a chunk size, enough for any 64-bit size
+MAX_CHUNK_SIZE_DIGITS = 16
+
+HEAD_END = b"\r\n\r\n"
+# Body framings other than a Content-Length, see _body_framing
+CHUNKED = "chunked"
+OTHER_CODING = "other"
+
+
+class HTTPFramingError(Exception):
+    """
+    Raised when a message cannot be framed: malformed head, bad lengths or a truncated body
+    """
+    status = 400
+    reason = "Bad Request"
+
+
+class RequestBodyError(HTTPFramingError):
+    """
+    Raised when the client's request body cannot be framed or read, which is the
+    client's fault and not the upstream server's it was being sent to
+    """
+
+
+class HeadTooLarge(HTTPFramingError):
+    """
+    Raised when a head is larger than the size limit or has too many header lines
+    """
+    status = 431
+    reason = "Request Header Fields Too Large"
+
+
+# Header names and methods are RFC 9110 tokens
+_TOKEN = rb"[!#$%&'*+\-.^_`|~0-9A-Za-z]"
+# The rest of a header line after the colon: the value ends at its first CR, which must
+# be followed by LF, and the lookahead checks that no LF comes before that CR. Together
+# they reject a bare CR or LF in one pass each of "." and [^\r], the two sets sre scans
+# fastest; a set excluding both is several times slower
+_LINE_REST = rb"(?=.*+(?<=\r))[^\r]*+\r\n"
+_HEADER_LINE = _TOKEN + rb"++:" + _LINE_REST
+_HEADER_LINES = rb"(?:%s){0,%d}+\r\n" % (_HEADER_LINE, MAX_HEADERS)
+# A request line: token method, target without whitespace or controls, HTTP/1.x
+_REQUEST_LINE = rb"(%s+) ([^\x00-\x20\x7f]+) (HTTP/1\.[0-9])\r\n" % _TOKEN
+_REQUEST_HEAD = re.compile(_REQUEST_LINE + _HEADER_LINES)
+# The usual request head, with Host as its first header: group 4 marks where the Host
+# value starts and no later line may be a Host header, so the head needs no lookup
+# for Host or for a second one. Every other head takes _REQUEST_HEAD
+_REQUEST_HEAD_HOST_FIRST = re.compile(
+    _REQUEST_LINE + rb"(?i:host):()%s(?:(?!(?i:host):)%s){0,%d}+\r\n" % (_LINE_REST, _HEADER_LINE, MAX_HEADERS - 1)
+)
+# A whole response head: HTTP/1.x, three digit status code and an optional reason phrase
+_RESPONSE_HEAD = re.compile(rb"(HTTP/1\.[0-9]) ([0-9]{3})(?: (?=.*+(?<=\r))([^\r]*+))?\r\n" + _HEADER_LINES)
+# A chunk-size line without its CRLF: hex digits only, then optional extensions.
+# int(size, 16) alone would also take a sign, 0x, underscores and surrounding whitespace
+_CHUNK_SIZE_LINE = re.compile(rb"([0-9A-Fa-f]{1,%d})(?:[ \t]*;.*)?" % MAX_CHUNK_SIZE_DIGITS)
+
+
+_header_patterns = {}
+
+
+def _header_pattern(name):
+    """
+    Return the pattern that finds a header line by name, case-insensitively, e.g. for
+    "host" one matching b"\\r\\nHost:"
+    """
+    pattern = _header_patterns.get(name)
+    if pattern is None:
+        pattern = _header_patterns[name] = re.compile(rb"\r\n(?i:%s):" % re.escape(name.encode("latin-1")))
+    return pattern
+
+
+class HTTPHead:
+    def __init__(self, raw, match, host_start=None):
+        """
+        The parsed head of an HTTP request or response
+
+        Headers are not split out when parsing. A lookup searches the head for the header
+        name case-insensitively and decodes only the values it finds, so a request costs a
+        few C-level scans of its head however many headers it carries.
+
+        :param raw: The head bytes including the terminating empty line
+        :param match: The match of the head's regular expression, whose first three groups
+            are the parts of the request line or status line
+        :param host_start: Where the value of the only Host header starts, -1 if there is
+            none, or None to look it up
+        """
+        self.raw = raw
+        self._match = match
+        self._start_line = None
+        self._host_start = host_start
+        self._index = None
+        # (framing,) once _body_framing has looked it up
+        self._framing = None
+
+    def _starts(self, name):
+        """
+        Return where the value of every occurrence of a header starts in raw
+        """
+        return [found.end() for found in _header_pattern(name).finditer(self.raw)]
+
+    def _value(self, start):
+        return self.raw[start:self.raw.find(b"\r\n", start)].strip(b" \t")
+
+    def get(self, name, default=None):
+        """
+        Return the first value of a header, looked up case-insensitively
+        """
+        starts = self._starts(name)
+        if not starts:
+            return default
+        return self._value(starts[0]).decode("latin-1")
+
+    def count(self, name):
+        """
+        Return how many times a header occurs
+        """
+        return len(self._starts(name))
+
+    @property
+    def index(self):
+        """
+        A list of (lowercase name bytes, value start, value end) for every header line,
+        built on first use
+        """
+        if self._index is None:
+            index = []
+            pos = self.raw.find(b"\r\n") + 2
+            end = len(self.raw) - len(HEAD_END)
+            while pos < end:
+                line_end = self.raw.find(b"\r\n", pos)
+                colon = self.raw.find(b":", pos, line_end)
+                index.append((self.raw[pos:colon].lower(), colon + 1, line_end))
+                pos = line_end + 2
+            self._index = index
+        return self._index
+
+    @property
+    def headers(self):
+        """
+        All headers as (lowercase name, value) string pairs in order
+        """
+        return [(header.decode("latin-1"), self.raw[start:end].strip(b" \t").decode("latin-1"))
+                for header, start, end in self.index]
+
+    def tokens(self, name):
+        """
+        Return the lowercased tokens of every occurrence of a comma separated header
+        """
+        tokens = []
+        for start in self._starts(name):
+            # Tokens cannot contain whitespace, so dropping it all strips every token
+            tokens += self._value(start).lower().replace(b" ", b"").replace(b"\t", b"").split(b",")
+        return tokens
+
+    def has_token(self, name, token):
+        """
+        Check whether a comma separated header such as Connection contains a token
+        """
+        return token.lower().encode("latin-1") in self.tokens(name)
+
+    @property
+    def host(self):
+        """
+        The Host header without its port, lowercased, or "" if there is none
+        """
+        start = self._host_start
+        if start is None:
+            starts = self._starts("host")
+            start = starts[0] if starts else -1
+        if start == -1:
+            return ""
+        host = self._value(start)
+        if host.startswith(b"["):
+            host = host[:host.find(b"]") + 1]
+        else:
+            host = host.split(b":", 1)[0]
+        return host.decode("latin-1").lower()
+
+    @property
+    def start_line(self):
+        """
+        The three parts of the request line or status line, decoded on first use
+        """
+        if self._start_line is None:
+            self._start_line = [part.decode("latin-1") for part in self._match.groups(b"")[:3]]
+        return self._start_line
+
+    @property
+    def version(self):
+        # Without decoding the whole start line, as keep_alive needs only this part
+        return self._match.group(3 if self.is_request else 1).decode("latin-1")
+
+    @property
+    def is_request(self):
+        # A method is a token, which cannot contain the "/" of a status line's version
+        return not self.raw.startswith(b"HTTP/")
+
+    @property
+    def method(self):
+        return self.start_line[0]
+
+    @property
+    def target(self):
+        return self.start_line[1]
+
+    @property
+    def status_code(self):
+        return int(self.start_line[1])
+
+    def keep_alive(self):
+        """
+        Whether the sender of this message is willing to keep the connection open
+        """
+        tokens = self.tokens("connection")
+        if b"close" in tokens:
+            return False
+        if self.version == "HTTP/1.1":
+            return True
+        return b"keep-alive" in tokens
+
+
+def _malformed_head(raw, kind):
+    """
+    Return the error for a head that did not match its regular expression
+    """
+    # The start line and the terminating empty line also end in LF
+    if raw.count(b"\n") - 2 > MAX_HEADERS:
+        return HeadTooLarge("Too many header lines")
+    return HTTPFramingError(f"Malformed {kind} head")
+
+
+def parse_request_head(raw):
+    """
+    Parse a request head into an HTTPHead without decoding it as a whole
+
+    The request line and every header line are validated by one regular expression
+    match over the head bytes: the method and header names must be tokens and no
+    line may contain a bare CR, LF or NUL or start with whitespace.
+
+    :raises HTTPFramingError: If the request line or a header is malformed
+    :raises HeadTooLarge: If there are more than MAX_HEADERS header lines
+    """
+    match = _REQUEST_HEAD_HOST_FIRST.fullmatch(raw)
+    if match is not None:
+        host_start = match.start(4)
+    else:
+        match = _REQUEST_HEAD.fullmatch(raw)
+        if match is None:
+            raise _malformed_head(raw, "request")
+        host_start = None
+    # memchr, so much cheaper than excluding NUL in the expression
+    if 0 in raw:
+        raise HTTPFramingError("NUL in head")
+    request = HTTPHead(raw, match, host_start)
+    if host_start is None and request.count("host") > 1:
+        raise HTTPFramingError("Multiple Host headers")
+    return request
+
+
+def parse_response_head(raw):
+    """
+    Parse a response head into an HTTPHead
+
+    :raises HTTPFramingError: If the status line or a header is malformed
+    """
+    match = _RESPONSE_HEAD.fullmatch(raw)
+    if match is None:
+        raise _malformed_head(raw, "response")
+    if 0 in raw:
+        raise HTTPFramingError("NUL in head")
+    return HTTPHead(raw, match)
+
+
+def set_connection_header(raw, value):
+    """
+    Replace the hop-by-hop Connection and Keep-Alive headers of a head with one Connection header
+
+    :param raw: The head bytes including the terminating empty line
+    :param value: The new Connection header value, e.g. b"keep-alive" or b"close"
+    :return: The rewritten head bytes
+    """
+    lines = raw[:-len(HEAD_END)].split(b"\r\n")
+    kept = [lines[0]]
+    for line in lines[1:]:
+        name = line.split(b":", 1)[0].strip().lower()
+        if name not in (b"connection", b"keep-alive"):
+            kept.append(line)
+    kept.append(b"Connection: " + value)
+    return b"\r\n".join(kept) + HEAD_END
+
+
+class BodyFramer:
+    SIZE, DATA, DATA_END, TRAILER, DONE = range(5)
+
+    def __init__(self, length=None, chunked=False, until_close=False):
+        """
+        Incremental HTTP/1.1 body framing that finds where a message body ends
+
+        Bytes are passed through unchanged, the framer only tracks message boundaries,
+        so a chunked body is relayed as chunks.
+
+        :param length: The Content-Length of the body
+        :param chunked: Whether the body uses chunked transfer-encoding
+        :param until_close: Whether the body is delimited by the connection closing
+        """
+        self.length = length
+        self.chunked = chunked
+        self.until_close = until_close
+        self._remaining = length or 0
+        self._state = self.SIZE
+        self._line = bytearray()
+
+    @property
+    def done(self):
+        if self.until_close:
+            return False
+        if self.chunked:
+            return self._state == self.DONE
+        return self._remaining == 0
+
+    def feed(self, data, start=0, end=None):
+        """
+        Consume body bytes from data[start:end] without copying them
+
+        :return: How many of the bytes belong to this body, the rest belong to the next message
+        :raises HTTPFramingError: If a chunk header is malformed
+        """
+        if end is None:
+            end = len(data)
+        if self.until_close:
+            return end - start
+        if not self.chunked:
+            n = min(self._remaining, end - start)
+            self._remaining -= n
+            return n
+
+        pos = start
+        while pos < end and self._state != self.DONE:
+            if self._state == self.DATA:
+                n = min(self._remaining, end - pos)
+                pos += n
+                self._remaining -= n
+                if self._remaining == 0:
+                    self._state = self.DATA_END
+                    self._remaining = 2
+            elif self._state == self.DATA_END:
+                # The CRLF after the chunk data, which may arrive split over two reads
+                if data[pos] != b"\r\n"[2 - self._remaining]:
+                    raise HTTPFramingError("Chunk data not followed by CRLF")
+                pos += 1
+                self._remaining -= 1
+                if self._remaining == 0:
+                    self._state = self.SIZE
+            else:
+                newline = data.find(b"\n", pos, end)
+                line_end = end if newline == -1 else newline + 1
+                self._line += data[pos:line_end]
+                pos = line_end
+                if len(self._line) > MAX_CHUNK_LINE:
+                    raise HTTPFramingError("Chunk line too long")
+                if newline != -1:
+                    if not self._line.endswith(b"\r\n"):
+                        raise HTTPFramingError("Chunk line not ended by CRLF")
+                    self._end_line(bytes(self._line[:-2]))
+                    self._line.clear()
+        return pos - start
+
+    def _end_line(self, line):
+        if self._state == self.TRAILER:
+            if not line.strip():
+                self._state = self.DONE
+            return
+        match = _CHUNK_SIZE_LINE.fullmatch(line)
+        if match is None:
+            raise HTTPFramingError("Malformed chunk size")
+        size = int(match.group(1), 16)
+        if size == 0:
+            self._state = self.TRAILER
+        else:
+            self._state = self.DATA
+            self._remaining = size
+
+
+def _content_length(head):
+    """
+    Return the Content-Length of a head, or None if it has none
+
+    Repeated headers and comma separated lists are accepted only if every value is
+    the same, so whichever value the next hop reads frames the body alike.
+
+    :raises HTTPFramingError: If a value is not a number or the values differ
+    """
+    lengths = set()
+    for value in head.tokens("content-length"):
+        # bytes.isdigit only accepts ASCII digits
+        if not value.isdigit():
+            raise HTTPFramingError("Invalid Content-Length")
+        lengths.add(int(value))
+    if len(lengths) > 1:
+        raise HTTPFramingError("Conflicting Content-Length headers")
+    return lengths.pop() if lengths else None
+
+
+def _body_framing(head):
+    """
+    Return what frames the body of a head: CHUNKED, its Content-Length, OTHER_CODING
+    for another final transfer coding, or None if it has neither header
+
+    The headers are looked up once per head.
+
+    A request with both headers is rejected rather than forwarded (RFC 9112, 6.3): an
+    upstream that frames it by Content-Length would read the rest of the chunked body
+    as the next request on a pooled connection.
+
+    :raises HTTPFramingError: If the framing headers are invalid or ambiguous
+    """
+    if head._framing is not None:
+        return head._framing[0]
+    # The last coding of all Transfer-Encoding headers decides whether the body is chunked
+    codings = head.tokens("transfer-encoding")
+    if codings:
+        if head.is_request and head.count("content-length"):
+            raise HTTPFramingError("Both Transfer-Encoding and Content-Length")
+        framing = CHUNKED if codings[-1] == b"chunked" else OTHER_CODING
+    else:
+        framing = _content_length(head)
+    head._framing = (framing,)
+    return framing
+
+
+def _framer_from_headers(head, until_close):
+    framing = _body_framing(head)
+    if framing is CHUNKED:
+        return BodyFramer(chunked=True)
+    if framing is OTHER_CODING:
+        return BodyFramer(until_close=True) if until_close else None
+    if framing is not None:
+        return BodyFramer(length=framing)
+    return BodyFramer(until_close=True) if until_close else BodyFramer(length=0)
+
+
+def request_body_framer(request):
+    """
+    Build the framer for a request body from its Content-Length or Transfer-Encoding
+
+    :raises HTTPFramingError: If the body length cannot be determined or is ambiguous
+    """
+    framer = _framer_from_headers(request, until_close=False)
+    if framer is None:
+        raise HTTPFramingError("Unsupported Transfer-Encoding")
+    return framer
+
+
+def response_body_framer(response, request_method):
+    """
+    Build the framer for a response body, following the RFC 9112 message length rules
+    """
+    status = response.status_code
+    if request_method == "HEAD" or 100 <= status < 200 or status in (204, 304):
+        return BodyFramer(length=0)
+    return _framer_from_headers(response, until_close=True)
+
+
+def buffered_body_length(framer, buffer):
+    """
+    Return how many buffered bytes make up a complete request body, or None if the
+    body continues beyond the buffer
+
+    :param framer: The request's framer, which is left unfed for relaying the body
+    :raises RequestBodyError: If the buffered body is malformed
+    """
+    if not framer.chunked:
+        length = framer.length or 0
+        return length if len(buffer) >= length else None
+    scratch = BodyFramer(chunked=True)
+    try:
+        n = scratch.feed(buffer)
+    except HTTPFramingError as e:
+        raise RequestBodyError(str(e)) from None
+    return n if scratch.done else None
+
+
+def _take_head(buffer, end, max_size):
+    """
+    Take the head that ends at end out of buffer, copying it once
+    """
+    if end > max_size:
+        raise HeadTooLarge("Head too large")
+    with memoryview(buffer) as view:
+        head = view[:end].tobytes()
+    del buffer[:end]
+    return head
+
+
+def _head_from_read(data, buffer, max_size):
+    """
+    Return the head if one read into an empty buffer holds all of it, else None
+
+    This is the usual case. The head is returned without copying when nothing
+    follows it, and only the bytes after it go into buffer.
+    """
+    index = data.find(HEAD_END)
+    if index == -1:
+        return None
+    end = index + len(HEAD_END)
+    if end > max_size:
+        raise HeadTooLarge("Head too large")
+    if end == len(data):
+        return data
+    buffer += memoryview(data)[end:]
+    return data[:end]
+
+
+def read_head(sock, buffer, max_size=MAX_HEAD_SIZE):
+    """
+    Read from a socket until buffer holds a complete head, then take the head out of it
+
+    Bytes after the head stay in buffer for the body or the next pipelined message.
+
+    :param sock: The socket to read from
+    :param buffer: A bytearray with the bytes already read from this socket
+    :return: The head bytes, or None if the peer closed the connection before sending anything
+    :raises HeadTooLarge: If the head is larger than max_size
+    :raises HTTPFramingError: If the peer closed mid-head
+    """
+    searched = 0
+    while True:
+        index = buffer.find(HEAD_END, max(0, searched - 3))
+        if index != -1:
+            return _take_head(buffer, index + len(HEAD_END), max_size)
+        if len(buffer) > max_size:
+            raise HeadTooLarge("Head too large")
+        searched = len(buffer)
+        data = sock.recv(BUFFER_SIZE)
+        if not data:
+            if buffer:
+                raise HTTPFramingError("Connection closed mid-head")
+            return None
+        if not buffer:
+            head = _head_from_read(data, buffer, max_size)
+            if head is not None:
+                return head
+        buffer += data
+
+
+def relay_body(src, dst, buffer, framer, head=b""):
+    """
+    Stream a message body from one socket to another through a fixed-size buffer
+
+    Bytes already read from src are taken from buffer first. Bytes after the end of the
+    body are left in buffer. Because sendall blocks until the receiver drains its window,
+    a slow receiver applies backpressure to the sender instead of growing memory.
+
+    :param head: Bytes to send ahead of the body, such as the message head; they go out in
+        one write with the body bytes already in buffer, so a small message is one segment
+    :return: The number of body bytes relayed
+    :raises HTTPFramingError: If src closes before the body is complete
+    """
+    relayed = 0
+    if buffer and not framer.done:
+        n = framer.feed(buffer)
+        if n:
+            with memoryview(buffer) as view:
+                dst.sendall(head + view[:n] if head else view[:n])
+            head = b""
+            del buffer[:n]
+            relayed += n
+    if head:
+        dst.sendall(head)
+
+    chunk = bytearray(BUFFER_SIZE)
+    with memoryview(chunk) as view:
+        while not framer.done:
+            received = src.recv_into(chunk)
+            if not received:
+                if framer.until_close:
+                    break
+                raise HTTPFramingError("Connection closed mid-body")
+            n = framer.feed(chunk, 0, received)
+            dst.sendall(view[:n])
+            relayed += n
+            if n < received:
+                buffer += view[n:received]
+    return relayed
+
+
+async def async_read_head(reader, buffer, max_size=MAX_HEAD_SIZE, read_timeout=None):
+    """
+    The asyncio counterpart of read_head, reading from a StreamReader
+
+    :param read_timeout: Seconds to wait for each read, like a socket timeout
+    """
+    searched = 0
+    while True:
+        index = buffer.find(HEAD_END, max(0, searched - 3))
+        if index != -1:
+            return _take_head(buffer, index + len(HEAD_END), max_size)
+        if len(buffer) > max_size:
+            raise HeadTooLarge("Head too large")
+        searched = len(buffer)
+        data = await asyncio.wait_for(reader.read(BUFFER_SIZE), read_timeout)
+        if not data:
+            if buffer:
+                raise HTTPFramingError("Connection closed mid-head")
+            return None
+        if not buffer:
+            head = _head_from_read(data, buffer, max_size)
+            if head is not None:
+                return head
+        buffer += data
+
+
+async def async_relay_body(reader, writer, buffer, framer, read_timeout=None, head=b""):
+    """
+    The asyncio counterpart of relay_body; awaiting drain() after every write is the backpressure
+
+    :param read_timeout: Seconds to wait for each read, like a socket timeout
+    """
+    relayed = 0
+    if buffer and not framer.done:
+        n = framer.feed(buffer)
+        if n:
+            writer.write(head + buffer[:n])
+            head = b""
+            await writer.drain()
+            del buffer[:n]
+            relayed += n
+    if head:
+        writer.write(head)
+        await writer.drain()
+
+    while not framer.done:
+        data = await asyncio.wait_for(reader.read(BUFFER_SIZE), read_timeout)
+        if not data:
+            if framer.until_close:
+                break
+            raise HTTPFramingError("Connection closed mid-body")
+        n = framer.feed(data)
+        writer.write(data if n == len(data) else memoryview(data)[:n])
+        await writer.drain()
+        relayed += n
+        if n < len(data):
+            buffer += memoryview(data)[n:]
+    return relayed
+
@@ -1,44 +1,163 @@
+import argparse
+import copy
+import select
+import signal
 import socket
 import threading
 import time
 
+from http_framing import (
+    IDEMPOTENT_METHODS,
+    HTTPFramingError,
+    RequestBodyError,
+    buffered_body_length,
+    parse_request_head,
+    parse_response_head,
+    read_head,
+    relay_body,
+    request_body_framer,
+    response_body_framer,
+    set_connection_header,
+)
+from circuit_breaker import BREAKER_STATES, CLOSED, OutlierDetector
+from deadlines import FIRST_BYTE, TIMEOUT_KINDS, Deadline, DeadlineSocket, UpstreamTimeout
+from dns_cache import DNS_TTL, DNSCache, expand_upstream_groups
+from health_checker import HealthChecker
+from hedging import HEDGE_BUDGET_MIN, HEDGE_BUDGET_PERCENT, HEDGE_METHODS, LatencyWindow
+from lb_config import carry_over_servers, parse_upstream_groups, read_config_file
+from lb_metrics import MetricsServer
+from lb_stats import StatsRegistry, summarize
+from lb_threads import QUEUE_SIZE, THREADS, ConnectionThreadPool
+from response_cache import CACHE_SIZE, BodyCapture, ResponseCache
+from retry_budget import RETRIES, RETRY_BUDGET_MIN, RETRY_BUDGET_PERCENT, RetryBudget
+from routing import RoutingState, RoutingTable
+from schedulers import (ConsistentHashScheduler, LeastConnScheduler, LeastRequestScheduler, LeastTimeScheduler,
+                        SmoothWeightedRoundRobin, server_state)
+from upstream_pool import UpstreamConnectionPool, server_id
+
 
 ROUND_ROBIN = "round_robin"
 LEAST_TIME = "least_time"
-LOAD_BALANCING_ALGORITHMS = [ROUND_ROBIN, LEAST_TIME]
+CONSISTENT_HASH = "consistent_hash"
+LEAST_CONN = "least_conn"
+LEAST_REQUEST = "least_request"
+LOAD_BALANCING_ALGORITHMS = [ROUND_ROBIN, LEAST_TIME, CONSISTENT_HASH, LEAST_CONN, LEAST_REQUEST]
+
+SCHEDULERS = {
+    ROUND_ROBIN: SmoothWeightedRoundRobin,
+    LEAST_TIME: LeastTimeScheduler,
+    CONSISTENT_HASH: ConsistentHashScheduler,
+    LEAST_CONN: LeastConnScheduler,
+    LEAST_REQUEST: LeastRequestScheduler,
+}
+
+THREADS_ENGINE = "threads"
+ASYNCIO_ENGINE = "asyncio"
+ENGINES = [THREADS_ENGINE, ASYNCIO_ENGINE]
+
+# Listen backlog of the threads engine when none is configured
+DEFAULT_BACKLOG = 128
+# Seconds a client shed by a full connection queue is asked to wait before retrying
+SHED_RETRY_AFTER = 1
+# How often a thread waiting for a client's next request checks for queued connections
+IDLE_POLL_INTERVAL = 0.1
+
+
+# Upstream groups used when no configuration file is given
+DEFAULT_UPSTREAM_GROUPS = {
+    "round_robin.cn.edu": {
+        "algorithm": ROUND_ROBIN,
+        "servers": [
+            {"host": "127.0.0.1", "port": 8080, "weight": 1, "healthy": True, "timeout": 2},
+            {"host": "127.0.0.1", "port": 8081, "weight": 3, "healthy": True, "timeout": 2},
+            {"host": "domain.cn.edu", "port": 8082, "weight": 2, "healthy": True, "timeout": 3},
+        ]
+    },
+    "least_time.cn.edu": {
+        "algorithm": LEAST_TIME,
+        "hedge_percentile": 95,
+        "servers": [
+            {"host": "127.0.0.1", "port": 8083, "weight": 1, "healthy": True, "timeout": 2},
+            {"host": "127.0.0.1", "port": 8084, "weight": 1, "healthy": True, "timeout": 2},
+            {"host": "domain.cn.edu", "port": 8085, "weight": 1, "healthy": True, "timeout": 3},
+        ]
+    }
+}
 
 
 class HTTPLoadBalancer:
-    def __init__(self, lb_host='localhost', lb_port=8000):
+    def __init__(self, lb_host='localhost', lb_port=8000, engine=THREADS_ENGINE,
+                 pool_max_idle=8, pool_idle_timeout=30.0, pool_max_lifetime=300.0,
+                 client_idle_timeout=15.0, max_keepalive_requests=1000, admin_host='localhost', admin_port=0,
+                 config_path=None, dns_ttl=DNS_TTL, threads=THREADS, queue_size=QUEUE_SIZE, backlog=None,
+                 cache_size=CACHE_SIZE, upstream_groups=None, dns_records=None):
         """
         Initialize the HTTP load balancer
+
+        :param engine: "threads" for a pool of connection threads or "asyncio" for a single event loop
+        :param pool_max_idle: Idle keep-alive connections kept per upstream server
+        :param pool_idle_timeout: Seconds an idle upstream connection is kept
+        :param pool_max_lifetime: Seconds after which an upstream connection is retired
+        :param client_idle_timeout: Seconds a keep-alive client connection may wait for its next request
+        :param max_keepalive_requests: Requests served on one client connection before it is closed
+        :param admin_host: Address of the admin listener serving /metrics
+        :param admin_port: Port of the admin listener, 0 disables it
+        :param config_path: A JSON or YAML file with the upstream groups, reloaded on SIGHUP
+        :param dns_ttl: Seconds upstream host addresses are cached when the resolver reports no TTL
+        :param threads: Connection threads of the threads engine
+        :param queue_size: Accepted connections that may wait for a free thread before new ones are shed
+        :param backlog: Listen backlog, defaults to 128 for the threads engine and 4096 for asyncio
+        :param cache_size: Bytes of responses the response cache may hold, 0 disables it
+        :param upstream_groups: Upstream groups already parsed, e.g. by a worker's master, instead of reading config_path
+        :param dns_records: DNS answers to start the cache with, as returned by DNSCache.records, so the
+            hosts are not resolved again
+        :raises ConfigError: If the configuration file is invalid
+        :raises ValueError: If the thread pool has no threads or no queue
         """
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine: {engine}")
         self.lb_host = lb_host
         self.lb_port = lb_port
+        self.engine = engine
+        self.client_idle_timeout = client_idle_timeout
+        self.max_keepalive_requests = max_keepalive_requests
+        self.backlog = backlog
+        self.admin_host = admin_host
+        self.admin_port = admin_port
+        self.metrics_server = None
+        # Seconds to wait for requests in flight when the load balancer stops
+        self.drain_timeout = 0.0
         self.lb_socket = None
         self.running = False
         
-        # Upstream servers configuration
-        self.upstream_groups = {
-            "round_robin.cn.edu": {
-                "algorithm": ROUND_ROBIN,
-                "servers": [
-                    {"host": "127.0.0.1", "port": 8080, "weight": 1, "healthy": True, "timeout": 2},
-                    {"host": "127.0.0.1", "port": 8081, "weight": 3, "healthy": True, "timeout": 2},
-                    {"host": "domain.cn.edu", "port": 8082, "weight": 2, "healthy": True, "timeout": 3},
-                ]
-            },
-            "least_time.cn.edu": {
-                "algorithm": LEAST_TIME,
-                "servers": [
-                    {"host": "127.0.0.1", "port": 8083, "weight": 1, "healthy": True, "timeout": 2},
-                    {"host": "127.0.0.1", "port": 8084, "weight": 1, "healthy": True, "timeout": 2},
-                    {"host": "domain.cn.edu", "port": 8085, "weight": 1, "healthy": True, "timeout": 3},
-                ]
-            }
-        }
+        # Upstream servers configuration, from the configuration file if there is one
+        self.config_path = config_path
+        if upstream_groups is None and config_path:
+            upstream_groups = parse_upstream_groups(read_config_file(config_path), LOAD_BALANCING_ALGORITHMS)
+        elif upstream_groups is None:
+            upstream_groups = copy.deepcopy(DEFAULT_UPSTREAM_GROUPS)
+        self._reload_lock = threading.Lock()
+
+        # Upstream host names are resolved once here and refreshed in the background;
+        # every resolved address becomes a server entry of its own
+        self.dns = DNSCache(default_ttl=dns_ttl)
+        if dns_records:
+            self.dns.preload(dns_records)
+        self.configured_groups = upstream_groups
         
-        self.server_stats = {domain: {"total_requests": 0, "failed_requests": 0} for domain in self.upstream_groups}
+        self.stats = StatsRegistry()
+        self.outliers = OutlierDetector()
+        # Kept by group name, so a reload does not reset them
+        self.retry_budgets = {}
+        self.hedge_budgets = {}
+        self.hedge_latency = {}
+        self.response_cache = ResponseCache(cache_size)
+        self.routing = self.build_routing(expand_upstream_groups(upstream_groups, self.dns))
+        self.connection_pool = UpstreamConnectionPool(
+            max_idle=pool_max_idle, idle_timeout=pool_idle_timeout, max_lifetime=pool_max_lifetime, dns=self.dns
+        )
+        self.health_checker = HealthChecker(self)
+        self.thread_pool = ConnectionThreadPool(self.handle_http_request, threads, queue_size)
         self._threads = []     
         
     def start_load_balancer(self):
@@ -46,189 +165,622 @@ class HTTPLoadBalancer:
         Start the HTTP load balancer
         """
         try:
-            self.lb_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.lb_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.lb_socket.bind((self.lb_host, self.lb_port))
-            self.lb_socket.listen(10)
+            self.lb_socket = self.create_listener()
             self.running = True
             
-            print(f" HTTP Load Balancer started on {self.lb_host}:{self.lb_port}")
-            for domain, group in self.upstream_groups.items():
-                print(f" Domain: {domain}")
-                print(f"  Algorithm: {group['algorithm']}")
-                print(f"  Servers: {len(group['servers'])}")
-            print("=" * 50)
+            self.print_banner()
+            self.start_metrics_server()
+            if hasattr(signal, "SIGHUP"):
+                # Reload off the signal handler, which interrupts the accept loop
+                signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+                    target=self.reload_config, daemon=True, name="reload").start())
             
             health_thread = threading.Thread(target=self.monitor_health, daemon=True, name="health")
             health_thread.start()
             self._threads.append(health_thread)
 
+            dns_thread = threading.Thread(target=self.monitor_dns, daemon=True, name="dns")
+            dns_thread.start()
+            self._threads.append(dns_thread)
+
             # Accept HTTP connections
             command_thread = threading.Thread(target=self.handle_commands, daemon=True, name="command")
             command_thread.start()
             self._threads.append(command_thread)
 
-            while self.running:
-                try:
-                    self.lb_socket.settimeout(1.0)  
-                    client_socket, client_address = self.lb_socket.accept()
-                    t = threading.Thread(
-                        target=self.handle_http_request,
-                        args=(client_socket, client_address),
-                        daemon=True,
-                        name=f"client-{client_address[0]}:{client_address[1]}"
-                    )
-                    t.start()
-                    self._threads.append(t)
-                except socket.timeout:
-                    continue
-                except Exception as e:
-                    if self.running:
-                        print(f"Load balancer error: {e}")
+            self.serve_forever()
                         
         except Exception as e:
             print(f"Failed to start load balancer: {e}")
         finally:
             self.stop_load_balancer()
+
+    def create_listener(self, reuse_port=False):
+        """
+        Create the listening socket of the load balancer
+
+        :param reuse_port: Set SO_REUSEPORT so several worker processes can bind the same port
+        """
+        lb_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        lb_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            lb_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        lb_socket.bind((self.lb_host, self.lb_port))
+        lb_socket.listen(self.backlog or DEFAULT_BACKLOG)
+        return lb_socket
+
+    def start_metrics_server(self, snapshot_source=None):
+        """
+        Start the admin listener serving /metrics if an admin port is configured
+
+        :param snapshot_source: A function returning the statistics to export, defaults to stats_snapshot
+        """
+        if not self.admin_port:
+            return
+        self.metrics_server = MetricsServer(self, self.admin_host, self.admin_port, snapshot_source)
+        self.metrics_server.start()
+
+    def print_banner(self):
+        print(f" HTTP Load Balancer started on {self.lb_host}:{self.lb_port} (engine: {self.engine})")
+        for domain, group in self.upstream_groups.items():
+            print(f" Domain: {domain}")
+            print(f"  Algorithm: {group['algorithm']}")
+            print(f"  Servers: {len(group['servers'])}")
+        print("=" * 50)
+
+    def serve_forever(self):
+        """
+        Accept and handle client connections on lb_socket until the load balancer stops
+
+        The threads engine hands accepted connections to thread_pool. A connection that
+        finds its queue full is shed with a 503 right away, so a spike neither starts
+        unbounded threads nor leaves clients waiting in the listen backlog.
+        """
+        if self.engine == ASYNCIO_ENGINE:
+            from async_engine import AsyncioEngine
+            AsyncioEngine(self).run()
+            return
+
+        self.thread_pool.start()
+        while self.running:
+            try:
+                self.lb_socket.settimeout(1.0)  
+                client_socket, client_address = self.lb_socket.accept()
+                # A response head and body are separate writes; don't let Nagle hold the body back
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                if not self.thread_pool.submit(client_socket, client_address):
+                    self.shed_connection(client_socket)
+            except socket.timeout:
+                continue
+            except Exception as e:
+                if self.running:
+                    print(f"Load balancer error: {e}")
+
+        # Let requests in flight finish before returning
+        self.thread_pool.shutdown(self.drain_timeout)
+
+    def shed_connection(self, client_socket):
+        """
+        Answer a connection the thread pool has no room for with 503 and close it
+
+        This runs on the accept loop, so it never blocks: the request is not read and
+        the response is only sent if it fits into the socket's send buffer.
+        """
+        try:
+            client_socket.setblocking(False)
+            client_socket.send(self.build_error_response(
+                503, "Service Unavailable: Overloaded", retry_after=SHED_RETRY_AFTER
+            ))
+            client_socket.shutdown(socket.SHUT_WR)
+            # Discard what the client already sent, so that closing does not reset the
+            # connection before the client has read the response
+            while client_socket.recv(65536):
+                pass
+        except OSError:
+            pass
+        finally:
+            client_socket.close()
     
-    def select_upstream_server(self, domain: str):
+    @property
+    def upstream_groups(self):
+        return self.routing.upstream_groups
+
+    @property
+    def routing_table(self):
+        return self.routing.table
+
+    def build_routing(self, upstream_groups):
         """
-        Select an upstream server using the configured algorithm for the specified domain
+        Compile the routing table and create the scheduler of every upstream group
 
-        :param domain: The domain name to select the upstream server from
-        :return: The selected upstream server from upstream servers list
+        :return: A RoutingState to install as self.routing
+        :raises ValueError: If a route pattern is invalid
         """
-        if domain not in self.upstream_groups:
-            return None
-        
-        group = self.upstream_groups[domain]
-        algorithm = group["algorithm"]
-        servers = group["servers"]
+        table = RoutingTable(upstream_groups)
+        schedulers = {}
+        for domain, group in upstream_groups.items():
+            schedulers[domain] = SCHEDULERS[group["algorithm"]].from_group(group)
+        return RoutingState(upstream_groups, table, schedulers)
 
-        good_servers = [s for s in servers if s.get("healthy", True)]
-        if not good_servers:
-            return None
+    def reload_config(self):
+        """
+        Load the configuration file again and swap in the new routing state
 
+        Servers that are still configured keep their entries, and so their health,
+        statistics, health check history and pooled connections. The new routes and
+        schedulers are installed with a single assignment, so a request sees either
+        the old or the new state; requests in flight finish against their old upstream.
+
+        :return: Whether the new configuration was installed
+        """
+        if not self.config_path:
+            print("No configuration file to reload")
+            return False
+        with self._reload_lock:
+            try:
+                upstream_groups = parse_upstream_groups(
+                    read_config_file(self.config_path), LOAD_BALANCING_ALGORITHMS
+                )
+                # Fails on invalid routes before any live server entry is touched
+                RoutingTable(upstream_groups)
+            except ValueError as e:
+                print(f"Configuration not reloaded: {e}")
+                return False
+            self.configured_groups = upstream_groups
+            self._install_groups()
+        print(f"Configuration reloaded from {self.config_path}: {len(upstream_groups)} upstream groups")
+        return True
+
+    def refresh_targets(self, changed_hosts=()):
+        """
+        Rebuild the upstream servers from the cached DNS answers after addresses changed
+
+        Addresses that are still resolved keep their server entries, like servers that
+        stay configured across a reload; targets of vanished addresses are dropped.
+        """
+        with self._reload_lock:
+            self._install_groups()
+        if changed_hosts:
+            print(f"Upstream addresses changed for {', '.join(sorted(changed_hosts))}")
+
+    def _install_groups(self):
+        """
+        Expand configured_groups into one server per resolved address and install them
+
+        Must be called with _reload_lock held.
+        """
+        upstream_groups = expand_upstream_groups(self.configured_groups, self.dns)
+        server_ids = carry_over_servers(self.upstream_groups, upstream_groups)
+        self.routing = self.build_routing(upstream_groups)
+        self.connection_pool.retain(server_ids)
+        self.dns.retain({srv["host"] for grp in self.configured_groups.values() for srv in grp["servers"]})
+
+    def select_upstream_server(self, domain: str, exclude=None, routing=None, key=None):
+        """
+        Select an upstream server using the configured algorithm for the specified domain
+
+        :param domain: The name of the upstream group, as found by the routing table
+        :param exclude: Upstream servers that must not be selected
+        :param routing: The RoutingState the domain was looked up in, defaults to the current one
+        :param key: The request's key for the consistent hash algorithm, from the scheduler's request_key
+        :return: The selected upstream server from upstream servers list
+        """
         # Route incoming requests to the appropriate upstream server group based on the Host header
-        # Make sure to filter out unhealthy servers
-        # Use the configured algorithm for the specified domain
-        server = None
-        if algorithm == ROUND_ROBIN:
-            # TODO: Implement weights round robin algorithm
-            if not hasattr(self, f'rr_counter'):
-                setattr(self, f'rr_counter', 0)
-
-            counter = getattr(self, f'rr_counter')
-            total_weight = sum(s["weight"] for s in good_servers)
-
-            # Select server based on weighted round-robin
-            current_weight = 0
-            for s in good_servers:
-                current_weight += s["weight"]
-                if counter % total_weight < current_weight:
-                    server = s
-                    break
+        # The group's scheduler filters out unhealthy and ejected servers and applies its algorithm
+        scheduler = (routing or self.routing).schedulers.get(domain)
+        if scheduler is None:
+            return None
+        for server in self.outliers.poll(time.monotonic()):
+            print(f"Circuit breaker half-open for {self.connection_pool.server_id(server)}")
+            server_state(server).mark_healthy()
+            self.invalidate_schedulers(server)
 
-            # Increment counter and wrap at total_weight
-            counter = (counter + 1) % total_weight
-            setattr(self, f'rr_counter', counter)
-            
-            
-        elif algorithm == LEAST_TIME:
-            # Initialize response_time for servers that don't have it
-            for s in good_servers:
-                if "response_time" not in s:
-                    s["response_time"] = float('inf')
-
-            # Select server with minimum response time
-            server = min(good_servers, key=lambda s: s["response_time"])
-        
-        return server
+        exclude = list(exclude or [])
+        while True:
+            server = scheduler.select(exclude, key)
+            # A half-open server only takes a limited number of trial requests at a time
+            if server is None or self.outliers.allow(server):
+                return server
+            exclude.append(server)
         
     def handle_http_request(self, client_socket, client_address):
         """
-        Handle HTTP request from client
+        Handle HTTP requests from client
+
+        The connection stays open between requests until the client asks to close it,
+        it is idle for client_idle_timeout seconds or it has served max_keepalive_requests.
+        Pipelined requests are read from the same buffer one after another, so they are
+        answered in order. Between requests the connection is closed as soon as other
+        connections wait for a thread, see wait_for_request.
         """
+        client_buffer = bytearray()
+        served = 0
         try:
-            # Receive HTTP request
-            request_data = client_socket.recv(4096)
-            if not request_data:
-                return
-            
-            # Parse Host header to determine routing
-            request_str = request_data.decode('utf-8')
-            host_header = self.extract_host_header(request_str)
-
-            if not host_header:
-                self.send_error_response(client_socket, 400, "Bad Request: Missing Host header")
-                return
-
-            upstream_server = self.select_upstream_server(host_header)
-            if upstream_server is None:
-                if host_header in self.upstream_groups:
-                    self.send_error_response(client_socket, 503, "No Healthy Upstream")
-                else:
-                    self.send_error_response(client_socket, 404, "Domain Not Found")
-                return
-
-            # If there is the Host header routing failed, requests should be responed
-            # with a default response from the load balancer
-            # If routing has succeeded, forward the request to the upstream server
-            # If the upstream group has no healthy servers, the request should be responded
-            # with a 503 status code with message "No Healthy Upstream"
-            result = self.forward_http_request(client_socket, upstream_server, request_data)
-            upstream = result["upstream_server"]
-            if result:
-                if result.get("success"):
-                    upstream["response_time"] = result["response_time"]
-                    upstream["healthy"] = True
-                    if host_header in self.server_stats:
-                        self.server_stats[host_header]["total_requests"] += 1
-                else:
-                    if host_header in self.server_stats:
-                        self.server_stats[host_header]["failed_requests"] += 1
-                    upstream["healthy"] = False
+            while self.running:
+                # Receive the HTTP request head, the body is streamed while forwarding
+                try:
+                    if served and not self.wait_for_request(client_socket, client_buffer):
+                        return
+                    client_socket.settimeout(self.client_idle_timeout)
+                    request_head = read_head(client_socket, client_buffer)
+                    if not request_head:
+                        return
+                    request = parse_request_head(request_head)
+                    request_framer = request_body_framer(request)
+                except socket.timeout:
+                    return
+                except HTTPFramingError as e:
+                    self.send_error_response(client_socket, e.status, f"{e.reason}: {e}")
+                    return
+                # The timeout stays set while the request is forwarded: every read of the
+                # request body and write of the response waits at most client_idle_timeout
+
+                served += 1
+                # Tell the client up front when other connections already wait for a thread
+                keep_alive = (request.keep_alive() and served < self.max_keepalive_requests and self.running
+                              and not self.thread_pool.backlogged())
+                if not self.route_http_request(client_socket, request, request_framer, client_buffer, keep_alive,
+                                               client_address):
+                    return
 
+        except socket.timeout:
+            # The client stopped reading an error or cached response
+            pass
         except Exception as e:
             print(f"Error handling request from {client_address}: {e}")
             self.send_error_response(client_socket, 500, "Internal Server Error: " + str(e))
         finally:
             client_socket.close()
-    
-    def extract_host_header(self, request_str):
+
+    def wait_for_request(self, client_socket, client_buffer):
         """
-        Extract Host header from HTTP request
+        Wait until a keep-alive client starts sending its next request
+
+        The wait is cut into IDLE_POLL_INTERVAL slices, and between them the connection
+        is given up if connections are queued for a thread, so idle keep-alive clients
+        cannot hold every thread for client_idle_timeout while new ones wait. Closing
+        an idle connection is allowed at any time (RFC 9112, 9.8); the client opens a
+        new one for its next request.
+
+        :param client_buffer: Bytes already received, e.g. a pipelined request
+        :return: Whether request bytes are available; False if the client closed the
+            connection, stayed idle for client_idle_timeout or was given up
         """
-        host_header: str = ""
-        lines = request_str.split("\r\n")
-        for line in lines:
-            if line.lower().startswith("host:"):
-                host_header = line.split(":", 1)[1].strip().split(":")[0]
-                break
-        return host_header
+        if client_buffer:
+            return True
+        deadline = time.monotonic() + self.client_idle_timeout
+        while self.running:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            client_socket.settimeout(min(IDLE_POLL_INTERVAL, remaining))
+            try:
+                return bool(client_socket.recv(1, socket.MSG_PEEK))
+            except socket.timeout:
+                if self.thread_pool.backlogged():
+                    return False
+        return False
+
+    def route_http_request(self, client_socket, request, request_framer, client_buffer, keep_alive,
+                           client_address=None):
+        """
+        Route one request by its own Host header and forward it to the selected upstream server
+
+        :param request: The parsed request head (HTTPHead)
+        :param request_framer: The request's body framer, built once when its head was parsed
+        :param client_buffer: Bytes already received from the client after the request head
+        :param keep_alive: Whether the client connection may stay open after this request
+        :param client_address: The (host, port) of the client, for hashing by client IP
+        :return: Whether the client connection can serve another request
+        """
+        # Route by the Host header, without its port
+        host_header = request.host
+
+        if not host_header:
+            self.send_error_response(client_socket, 400, "Bad Request: Missing Host header")
+            return False
+
+        # An error answered without reading the request body cannot leave the connection reusable
+        keep_alive_on_error = keep_alive and request_framer.done
+
+        routing = self.routing
+        domain = routing.table.lookup(host_header, request.target)
+        if domain is None:
+            self.send_error_response(client_socket, 404, "Domain Not Found", keep_alive_on_error)
+            return keep_alive_on_error
+
+        # A cached response is served even if no upstream server is healthy
+        cache_key = self.response_cache.key(request, routing.upstream_groups[domain])
+        if cache_key is None:
+            return self.proxy_request(client_socket, request, request_framer, client_buffer, keep_alive, domain,
+                                      routing, client_address)
+        entry, fill = self.response_cache.lookup(cache_key)
+        if entry is not None:
+            return self.send_cached_response(client_socket, domain, entry, keep_alive)
+        try:
+            return self.proxy_request(client_socket, request, request_framer, client_buffer, keep_alive, domain,
+                                      routing, client_address, cache_key)
+        finally:
+            if fill is not None:
+                self.response_cache.release(cache_key, fill)
+
+    def proxy_request(self, client_socket, request, request_framer, client_buffer, keep_alive, domain, routing,
+                      client_address=None, cache_key=None):
+        """
+        Forward a routed request to a server of its group, retrying or hedging it as the group allows
+
+        :param request_framer: The request's body framer
+        :param domain: The name of the upstream group the request was routed to
+        :param routing: The RoutingState the domain was looked up in
+        :param client_address: The (host, port) of the client
+        :param cache_key: The response cache key of the request, if its response may be stored
+        :return: Whether the client connection can serve another request
+        """
+        keep_alive_on_error = keep_alive and request_framer.done
+        key = routing.schedulers[domain].request_key(request, client_address)
+        upstream_server = self.select_upstream_server(domain, routing=routing, key=key)
+        if upstream_server is None:
+            self.stats.record_request(domain, None, 503, 0.0, failed=True)
+            self.send_error_response(client_socket, 503, "No Healthy Upstream", keep_alive_on_error)
+            return keep_alive_on_error
+
+        # If there is the Host header routing failed, requests should be responed
+        # with a default response from the load balancer
+        # If routing has succeeded, forward the request to the upstream server
+        # If the upstream group has no healthy servers, the request should be responded
+        # with a 503 status code with message "No Healthy Upstream"
+        self.retry_budget(domain).record_request()
+        tried = []
+        hedge = self.hedge_for(domain, request, tried, routing, key)
+        while upstream_server is not None:
+            tried.append(upstream_server)
+            attempt = len(tried)
+            server_state(upstream_server).begin_request()
+            try:
+                result = self.forward_http_request(client_socket, upstream_server, request, request_framer,
+                                                   client_buffer, keep_alive, hedge, capture=cache_key is not None)
+            finally:
+                # A hedged copy of the attempt was counted in flight by select_hedge
+                for server in tried[attempt - 1:]:
+                    server_state(server).end_request()
+                    self.outliers.release(server)
+            hedge = None
+            upstream_server = self.select_retry_server(domain, request, result, tried, routing, key)
+            # Only the last attempt is the domain's response, earlier ones count for their server
+            self.record_forward_result(domain if upstream_server is None else None, result)
+
+        if cache_key is not None and result["success"]:
+            self.response_cache.store(cache_key, result["response"], result["body"], routing.upstream_groups[domain])
+        if not result["success"] and result["status_code"]:
+            self.send_error_response(client_socket, result["status_code"], self.upstream_error_message(result))
+        return result.get("keep_alive", False)
+
+    def send_cached_response(self, client_socket, domain, entry, keep_alive):
+        """
+        Answer a request from the response cache
+
+        :param entry: The CachedResponse found for the request
+        :return: Whether the client connection can serve another request
+        """
+        start_time = time.time()
+        data = entry.to_bytes(b"keep-alive" if keep_alive else b"close")
+        client_socket.sendall(data)
+        self.stats.record_request(domain, None, entry.status_code, time.time() - start_time, 0, len(data))
+        return keep_alive
+
+    def retry_budget(self, domain):
+        budget = self.retry_budgets.get(domain)
+        if budget is None:
+            budget = self.retry_budgets.setdefault(domain, RetryBudget())
+        return budget
+
+    def hedge_for(self, domain, request, tried, routing, key=None):
+        """
+        Decide whether a request is hedged and when
+
+        Groups that set "hedge_percentile" hedge their GET and HEAD requests: if the
+        first server has not sent a response head after that percentile of the group's
+        recent response head latencies, a second copy goes to the next server the
+        scheduler picks. "hedge_budget" (percent of the group's hedgeable requests,
+        default 10) with a floor of "hedge_budget_min" (1) per 10 seconds limits how
+        many requests are hedged.
+
+        :param tried: The servers the request is sent to; the hedged one is added to it
+        :param key: The request's key for the consistent hash algorithm
+        :return: (delay, select) where select returns the server for the second copy or
+            None, or None if the request is not hedged
+        """
+        group = routing.upstream_groups[domain]
+        percentile = group.get("hedge_percentile")
+        if percentile is None or request.method not in HEDGE_METHODS:
+            return None
+        budget = self.hedge_budgets.get(domain)
+        if budget is None:
+            budget = self.hedge_budgets.setdefault(domain, RetryBudget())
+        budget.record_request()
+        delay = self.hedge_window(domain).percentile(percentile)
+        if delay is None:
+            return None
+
+        def select_hedge():
+            server = self.select_upstream_server(domain, exclude=tried, routing=routing, key=key)
+            if server is None:
+                return None
+            if not budget.try_retry(group.get("hedge_budget", HEDGE_BUDGET_PERCENT),
+                                    group.get("hedge_budget_min", HEDGE_BUDGET_MIN)):
+                self.outliers.release(server)
+                self.stats.count(domain, None, "hedges_throttled")
+                return None
+            self.stats.count(domain, None, "hedges")
+            server_state(server).begin_request()
+            tried.append(server)
+            return server
+
+        return delay, select_hedge
+
+    def hedge_window(self, domain):
+        window = self.hedge_latency.get(domain)
+        if window is None:
+            window = self.hedge_latency.setdefault(domain, LatencyWindow())
+        return window
+
+    def select_retry_server(self, domain, request, result, tried, routing, key=None):
+        """
+        Choose another upstream server to retry a failed request on
+
+        A request is retried if no response byte reached the client, its body is still
+        buffered, and either it never reached the upstream server or its method is
+        idempotent. The group option "retries" (default 1) limits the retries per
+        request, and "retry_budget" (percent of the group's requests, default 20) with
+        a floor of "retry_budget_min" (3) per 10 seconds limits the retries of the group.
+
+        :param tried: The servers the request was already sent to
+        :param key: The request's key for the consistent hash algorithm, so a retry goes to
+            the next server on the ring
+        :return: The server to retry on, or None
+        """
+        if result["success"] or not result.get("retryable"):
+            return None
+        if result.get("sent") and request.method not in IDEMPOTENT_METHODS:
+            return None
+        group = routing.upstream_groups[domain]
+        if len(tried) > group.get("retries", RETRIES):
+            return None
+        server = self.select_upstream_server(domain, exclude=tried, routing=routing, key=key)
+        if server is None:
+            return None
+        if not self.retry_budget(domain).try_retry(group.get("retry_budget", RETRY_BUDGET_PERCENT),
+                                                   group.get("retry_budget_min", RETRY_BUDGET_MIN)):
+            self.outliers.release(server)
+            self.stats.count(domain, None, "retries_throttled")
+            return None
+        print(f"Retrying request for {domain} on {self.connection_pool.server_id(server)} "
+              f"after {result['server_id']} failed: {result.get('error')}")
+        self.stats.count(domain, None, "retries")
+        return server
     
-    def forward_http_request(self, client_socket, upstream_server, request_data):
+    def record_forward_result(self, domain, result):
+        """
+        Update statistics and the upstream server's circuit breaker after a forwarded request
+
+        Failing to get a response and 5xx responses count as failures for the breaker,
+        unless the request failed because of the client, e.g. a malformed body.
+
+        :param domain: The domain the request was routed by, None for an attempt that is retried
+        :param result: The dictionary returned by forward_http_request
+        """
+        if not result:
+            return
+        upstream = result["upstream_server"]
+        self.stats.record_request(
+            domain,
+            result["server_id"],
+            result.get("status_code"),
+            result.get("response_time", 0.0),
+            result.get("bytes_in", 0),
+            result.get("bytes_out", 0),
+            failed=not result.get("success"),
+        )
+        if result.get("success"):
+            self.observe_response_time(upstream, result["response_time"])
+            if domain in self.hedge_latency:
+                self.hedge_latency[domain].record(result["header_time"])
+            if result.get("hedge_won"):
+                self.stats.count(domain, None, "hedge_wins")
+        elif result.get("timeout"):
+            self.stats.count(None, result["server_id"], "timeouts_" + result["timeout"])
+        if result.get("client_error"):
+            return
+        failed = not result.get("success") or (result.get("status_code") or 0) >= 500
+        ejection = self.outliers.record(upstream, failed, self.routing.server_groups.get(id(upstream), []))
+        if ejection is not None:
+            print(f"Circuit breaker opened for {result['server_id']} for {ejection:.0f}s")
+            self.stats.count(None, result["server_id"], "ejections")
+            self.invalidate_schedulers(upstream)
+
+    def forward_http_request(self, client_socket, upstream_server, request, request_framer, client_buffer,
+                             keep_alive=False, hedge=None, capture=False):
         """
         Forward HTTP request to upstream server
         Returns response data and timing information for student use
 
+        The request body and the response are streamed through a bounded buffer, framed
+        by Content-Length or chunked transfer-encoding, so payloads of any size pass through.
+        If the upstream fails before the response starts, no error is sent to the client:
+        the result's status_code is the one to send, unless the request is retried.
+        Every wait for the upstream follows the server's Deadline.
+
         :param client_socket: The socket object for the client
         :param upstream_server: The upstream server to forward the request to
-        :param request_data: The request data to forward to the upstream server
-        :return: A dictionary containing the success, response_time, response_data, server_id, and upstream_server
+        :param request: The parsed request head (HTTPHead)
+        :param request_framer: The request's body framer, fed only when the body is streamed, which
+            is never retried
+        :param client_buffer: Bytes already received from the client after the request head
+        :param keep_alive: Whether the client connection may stay open after the response
+        :param hedge: The (delay, select) returned by hedge_for, to hedge a buffered request
+        :param capture: Keep a copy of a response body up to the response cache's object size limit
+        :return: A dictionary containing the success, response_time, header_time, status_code, bytes_in,
+            bytes_out, keep_alive, server_id, upstream_server and whether a hedged copy won, and with capture
+            the response head and body, or None if the body was too large; after a failure also the error,
+            which timeout ran out if one did, whether the request was sent and whether it can be retried,
+            and whether the client caused it with the reason phrase of its status code
         """
-        upstream_socket = None
+        primary = upstream_server
+        pooled = None
+        reusable = False
+        response_started = False
+        sent = False
+        replay = None
         start_time = time.time()
+        deadline = Deadline(upstream_server)
+        server_id = self.connection_pool.server_id(upstream_server)
 
         try:
-            upstream_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            upstream_socket.settimeout(upstream_server["timeout"])
-            upstream_socket.connect((upstream_server["host"], upstream_server["port"]))
-            
-            upstream_socket.send(request_data)
-            
-            response_data = upstream_socket.recv(4096)
-            client_socket.send(response_data)
+            upstream_head = set_connection_header(request.raw, b"keep-alive")
+
+            # A request whose body is already buffered can be replayed on a fresh connection
+            body_length = buffered_body_length(request_framer, client_buffer)
+            replay = None if body_length is None else upstream_head + bytes(client_buffer[:body_length])
+
+            if hedge is not None and replay is not None:
+                sent = True
+                upstream_server, pooled, upstream, upstream_buffer, response, header_time = self._hedged_exchange(
+                    upstream_server, replay, hedge
+                )
+                server_id = self.connection_pool.server_id(upstream_server)
+                bytes_in = len(replay)
+            else:
+                pooled = self.connection_pool.acquire(upstream_server, deadline=deadline)
+                sent = True
+                upstream = DeadlineSocket(pooled.conn, deadline)
+                try:
+                    upstream_buffer, response, bytes_in = self._send_request(
+                        upstream, upstream_head, replay, client_socket, client_buffer, request_framer
+                    )
+                except (ConnectionError, EOFError):
+                    if not pooled.reused or replay is None:
+                        raise
+                    # The upstream closed the idle connection just as we reused it
+                    self.connection_pool.release(pooled, False)
+                    pooled = self.connection_pool.acquire(upstream_server, fresh=True, deadline=deadline)
+                    upstream = DeadlineSocket(pooled.conn, deadline)
+                    upstream_buffer, response, bytes_in = self._send_request(
+                        upstream, upstream_head, replay, client_socket, client_buffer, request_framer
+                    )
+                header_time = time.time() - start_time
+            if replay is not None:
+                del client_buffer[:body_length]
+
+            response_framer = response_body_framer(response, request.method)
+            # A body delimited by the upstream closing can only be delimited the same way for the client
+            keep_alive = keep_alive and not response_framer.until_close
+            client_head = set_connection_header(response.raw, b"keep-alive" if keep_alive else b"close")
+            response_started = True
+            client = client_socket
+            if capture:
+                client = BodyCapture(client_socket, self.response_cache.max_object, skip=len(client_head))
+            bytes_out = len(client_head) + relay_body(upstream, client, upstream_buffer, response_framer, client_head)
+            reusable = response.keep_alive() and not response_framer.until_close and not upstream_buffer
             
             response_time = time.time() - start_time
             
@@ -236,83 +788,237 @@ class HTTPLoadBalancer:
             return {
                 "success": True,
                 "response_time": response_time,
-                "response_data": response_data,
-                "server_id": f"{upstream_server['host']}:{upstream_server['port']}",
-                "upstream_server": upstream_server
+                "header_time": header_time,
+                "hedge_won": upstream_server is not primary,
+                "status_code": response.status_code,
+                "bytes_in": bytes_in,
+                "bytes_out": bytes_out,
+                "keep_alive": keep_alive,
+                "server_id": server_id,
+                "upstream_server": upstream_server,
+                "response": response,
+                "body": client.data if capture else None,
             }
             
-        except socket.timeout:
-            print(f"Timeout connecting to upstream {upstream_server['host']}:{upstream_server['port']}")
-            self.send_error_response(client_socket, 504, "504 Gateway Timeout: " + str(e))
+        except RequestBodyError as e:
+            print(f"Bad request body for upstream {server_id}: {e}")
+            return {
+                "success": False,
+                "error": str(e),
+                "client_error": True,
+                "status_code": e.status,
+                "reason": e.reason,
+                "sent": sent,
+                "retryable": False,
+                "server_id": server_id,
+                "upstream_server": upstream_server
+            }
+        except socket.timeout as e:
+            # Only an UpstreamTimeout tells which timeout ran out; a stalled client has none
+            kind = getattr(e, "kind", None)
+            print(f"Timeout ({kind or 'client'}) on upstream {server_id}")
+            if kind is None:
+                return {
+                    "success": False,
+                    "error": f"Client stalled for {self.client_idle_timeout:g}s",
+                    "client_error": True,
+                    "status_code": None if response_started else 408,
+                    "reason": "Request Timeout",
+                    "sent": sent,
+                    "retryable": False,
+                    "server_id": server_id,
+                    "upstream_server": upstream_server
+                }
             return {
                 "success": False,
-                "error": "timeout",
-                "server_id": f"{upstream_server['host']}:{upstream_server['port']}",
+                "error": str(e) or "timeout",
+                "timeout": kind,
+                "status_code": None if response_started else 504,
+                "sent": sent,
+                "retryable": not response_started and (replay is not None or not sent),
+                "server_id": server_id,
                 "upstream_server": upstream_server
             }
         except Exception as e:
-            print(f"Error connecting to upstream {upstream_server['host']}:{upstream_server['port']}: {e}")
-            self.send_error_response(client_socket, 502, "502 Bad Gateway: " + str(e))
+            print(f"Error connecting to upstream {server_id}: {e}")
             return {
                 "success": False,
                 "error": str(e),
-                "server_id": f"{upstream_server['host']}:{upstream_server['port']}",
+                "status_code": None if response_started else 502,
+                "sent": sent,
+                "retryable": not response_started and (replay is not None or not sent),
+                "server_id": server_id,
                 "upstream_server": upstream_server
             }
         finally:
-            if upstream_socket:
-                upstream_socket.close()
-    
-    def monitor_health(self):
+            if pooled:
+                self.connection_pool.release(pooled, reusable)
+
+    def _send_request(self, upstream_socket, upstream_head, replay, client_socket, client_buffer, request_framer):
         """
-        Monitor upstream server health
+        Send one request on an upstream connection and read the response head
+
+        :param upstream_socket: The upstream connection wrapped in a DeadlineSocket
+        :param replay: The complete request bytes if the body was buffered, otherwise None
+            and the body is streamed from the client
+        :return: The bytes read after the response head, the parsed response head and
+            the number of request bytes sent
         """
-        while self.running:
+        if replay is not None:
+            upstream_socket.sendall(replay)
+            bytes_in = len(replay)
+        else:
+            upstream_socket.sendall(upstream_head)
+            bytes_in = len(upstream_head)
             try:
-                # Check the health of all upstream servers and update the health status
-                for domain, group in self.upstream_groups.items():
-                    for server in group["servers"]:
+                bytes_in += relay_body(client_socket, upstream_socket, client_buffer, request_framer)
+            except HTTPFramingError as e:
+                # Only the client's bytes are framed here, the upstream is just written to
+                raise RequestBodyError(str(e)) from None
 
-                        # Check health of each server
-                        server["healthy"] = self.check_server_health(server)
-            except Exception as e:
-                print(f"Health monitoring error: {e}, Backing off for 5 seconds")
-                time.sleep(5)
-            finally:
-                time.sleep(10)
+        upstream_buffer = bytearray()
+        return upstream_buffer, self._read_response_head(upstream_socket, upstream_buffer, client_socket), bytes_in
 
+    def _read_response_head(self, upstream_socket, upstream_buffer, client_socket=None):
+        """
+        Read the final response head, passing interim responses such as 100 Continue on
+        to the client, or dropping them if client_socket is None
+        """
+        while True:
+            response_head = read_head(upstream_socket, upstream_buffer)
+            if not response_head:
+                raise EOFError("Upstream closed the connection")
+            response = parse_response_head(response_head)
+            # Interim responses such as 100 Continue precede the final one
+            if response.status_code >= 200 or response.status_code == 101:
+                return response
+            if client_socket is not None:
+                client_socket.sendall(response_head)
 
-    def check_server_health(self, server):
+    def _hedged_exchange(self, primary, replay, hedge):
         """
-        Check if a server is healthy by making a health check request
+        Send a buffered request to the primary server and, if no response has arrived
+        after the hedge delay, a copy to a second server; the first response head wins
+        and the other connection is closed
+
+        Both connections are waited on with select in this thread. Interim responses
+        are dropped, since both servers might send them.
+
+        :param hedge: The (delay, select) returned by hedge_for
+        :return: The winning server, its PooledConnection and DeadlineSocket, the bytes read
+            after the response head, the response head and the seconds the winner took to answer
         """
+        delay, select_hedge = hedge
+        attempts = {}
+        last_error = None
         try:
-            health_request = (
-                "GET /healthz HTTP/1.1\r\n"
-                f"Host: {server['host']}\r\n"
-                "Connection: close\r\n"
-                "\r\n"
-            )
-            
-            health_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            health_socket.settimeout(server["timeout"])
-            health_socket.connect((server["host"], server["port"]))
-            health_socket.send(health_request.encode('utf-8'))
-            
-            response = health_socket.recv(1024).decode('utf-8')
-            health_socket.close()
-            
-            health_check_result: bool = False
+            self._start_attempt(attempts, primary, replay)
+            ready, _, _ = select.select(list(attempts), [], [], delay)
+            if not ready:
+                secondary = select_hedge()
+                if secondary is not None:
+                    try:
+                        self._start_attempt(attempts, secondary, replay)
+                    except OSError as e:
+                        print(f"Hedged request to {self.connection_pool.server_id(secondary)} failed: {e}")
 
-            if "200 OK" in response:
-                health_check_result = True
-            else:
-                health_check_result = False
-            return health_check_result
-                
+            while attempts:
+                now = time.monotonic()
+                for conn in [conn for conn, attempt in attempts.items() if now >= attempt["expires"]]:
+                    attempt = attempts.pop(conn)
+                    self.connection_pool.release(attempt["pooled"], False)
+                    last_error = UpstreamTimeout(attempt["kind"])
+                if not attempts:
+                    break
+                timeout = min(attempt["expires"] for attempt in attempts.values()) - now
+                ready, _, _ = select.select(list(attempts), [], [], timeout)
+                for conn in ready:
+                    attempt = attempts.pop(conn)
+                    upstream_buffer = bytearray()
+                    try:
+                        response = self._read_response_head(attempt["upstream"], upstream_buffer)
+                    except (OSError, EOFError, HTTPFramingError) as e:
+                        self.connection_pool.release(attempt["pooled"], False)
+                        last_error = e
+                        continue
+                    return (attempt["server"], attempt["pooled"], attempt["upstream"], upstream_buffer, response,
+                            time.monotonic() - attempt["started"])
+            raise last_error
+        finally:
+            # The losing connection is closed, which is all a cancel can do in HTTP/1.1
+            for attempt in attempts.values():
+                self.connection_pool.release(attempt["pooled"], False)
+
+    def _start_attempt(self, attempts, server, replay):
+        started = time.monotonic()
+        deadline = Deadline(server, started)
+        pooled = self.connection_pool.acquire(server, deadline=deadline)
+        upstream = DeadlineSocket(pooled.conn, deadline)
+        try:
+            upstream.sendall(replay)
+            wait, kind = deadline.timeout(FIRST_BYTE)
+        except OSError:
+            self.connection_pool.release(pooled, False)
+            raise
+        attempts[pooled.conn] = {
+            "server": server,
+            "pooled": pooled,
+            "upstream": upstream,
+            "started": started,
+            "expires": time.monotonic() + wait,
+            "kind": kind,
+        }
+    
+    def monitor_health(self):
+        """
+        Monitor upstream server health with the concurrent HealthChecker
+        """
+        try:
+            self.health_checker.run()
         except Exception as e:
-            print(f"Health check failed for {server['host']}:{server['port']}: {e}")
-            return False
+            print(f"Health monitoring error: {e}")
+
+    def monitor_dns(self, on_change=None):
+        """
+        Refresh the addresses of upstream hosts before their TTL runs out
+
+        :param on_change: Called with the hosts whose addresses changed, defaults to refresh_targets
+        """
+        try:
+            self.dns.run(lambda: self.running, on_change or self.refresh_targets)
+        except Exception as e:
+            print(f"DNS refresh error: {e}")
+
+    def set_server_health(self, server, healthy):
+        """
+        Mark an upstream server healthy or unhealthy, rebuilding the schedulers that use it
+        """
+        if server.get("healthy", True) == healthy:
+            return
+        server["healthy"] = healthy
+        if healthy:
+            server_state(server).mark_healthy()
+        self.invalidate_schedulers(server)
+
+    def invalidate_schedulers(self, server):
+        """
+        Make the schedulers that use an upstream server rebuild after its state changed
+        """
+        for scheduler in self.routing.server_schedulers.get(id(server), []):
+            scheduler.invalidate()
+
+    def observe_response_time(self, server, response_time):
+        """
+        Record how long an upstream server took to answer, used by the least time algorithm
+        """
+        server["response_time"] = server_state(server).observe(response_time)
+
+    def observe_probe_time(self, server, probe_time):
+        """
+        Record how long a health check took; the least time algorithm uses it only for
+        servers without recent proxied response times
+        """
+        server["response_time"] = server_state(server).observe_probe(probe_time)
     
     def handle_commands(self):
         """
@@ -320,6 +1026,7 @@ class HTTPLoadBalancer:
         """
         # LoadBalancer should support the following commands:
         # - list: list all upstream servers and their health status
+        # - reload: reload the configuration file
         # - quit: stop the load balancer
         while self.running:
             try:
@@ -336,51 +1043,148 @@ class HTTPLoadBalancer:
                 break
             elif cmd == "- list":
                 self.list_upstream_servers()
+            elif cmd == "- reload":
+                self.reload_config()
             else:
                 print(f"Unknown command: {cmd}.")
         
 
-    def list_upstream_servers(self):
+    def stats_snapshot(self):
+        """
+        Collect request statistics, response times and pool counters in a plain dict,
+        so that the numbers of several worker processes can be merged
+        """
+        stats = self.stats.snapshot()
+        servers = stats["servers"]
+        for grp in self.upstream_groups.values():
+            for srv in grp["servers"]:
+                breaker_state = srv["breaker"].state if "breaker" in srv else CLOSED
+                resp_t = srv.get("response_time")
+                if not isinstance(resp_t, (int, float)) or resp_t == float('inf'):
+                    resp_t = None
+                servers.setdefault(self.connection_pool.server_id(srv), {}).update({
+                    "response_time": resp_t,
+                    "inflight": server_state(srv).inflight,
+                    "pool": self.connection_pool.stats(srv),
+                    # Counts of processes per state, so that merged snapshots add up
+                    "breaker": {state: int(state == breaker_state) for state in BREAKER_STATES},
+                })
+        if self.engine == THREADS_ENGINE:
+            stats["connections"] = self.thread_pool.stats()
+        if self.response_cache.max_bytes:
+            stats["cache"] = self.response_cache.stats()
+        return stats
+
+    def list_upstream_servers(self, snapshot=None):
         """
         List upstream servers and their health status
+
+        :param snapshot: Statistics to show, as returned by stats_snapshot; defaults to this process
         """
+        if snapshot is None:
+            snapshot = self.stats_snapshot()
         print("Upstream Servers Status:")
         print("=" * 40)
+        connections = snapshot.get("connections")
+        if connections:
+            print("Connections: threads={0} busy={1} queued={2}/{3} accepted={4} shed={5}".format(
+                connections["threads"],
+                connections["busy"],
+                connections["queued"],
+                connections["queue_size"],
+                connections["accepted"],
+                connections["shed"],
+            ))
+            print()
+        cache = snapshot.get("cache")
+        if cache:
+            lookups = cache["hits"] + cache["misses"]
+            print("Cache: entries={0} size={1:.1f}/{2:.1f}MB hit_ratio={3} hits={4} misses={5} coalesced={6} "
+                  "evictions={7}".format(
+                      cache["entries"],
+                      cache["bytes"] / (1024 * 1024),
+                      cache["max_bytes"] / (1024 * 1024),
+                      f"{cache['hits'] / lookups:.1%}" if lookups else "-",
+                      cache["hits"],
+                      cache["misses"],
+                      cache["coalesced"],
+                      cache["evictions"],
+                  ))
+            print()
         for dom, grp in self.upstream_groups.items():
             algorithm = grp.get("algorithm", "?")
-            stat = self.server_stats.get(dom, {"total_requests": 0, "failed_requests": 0})
+            stat = summarize(snapshot["domains"].get(dom))
 
             print("Domain:", dom)
             print("Algorithm:", algorithm)
             print(
-                "  Requests: total={0} failed={1}".format(
-                    stat["total_requests"], stat["failed_requests"]
+                "  Requests: total={0} failed={1} in={2}B out={3}B {4}".format(
+                    stat["requests"],
+                    stat["failures"],
+                    stat["bytes_in"],
+                    stat["bytes_out"],
+                    " ".join(f"{cls}={count}" for cls, count in stat["status"].items() if count),
                 )
             )
+            print("  Latency: p50={0} p95={1} p99={2}".format(
+                format_seconds(stat["p50"]), format_seconds(stat["p95"]), format_seconds(stat["p99"])
+            ))
+            print("  Retries: {0} throttled={1}".format(
+                stat["counters"].get("retries", 0), stat["counters"].get("retries_throttled", 0)
+            ))
+            if grp.get("hedge_percentile") is not None:
+                print("  Hedges: fired={0} won={1} throttled={2}".format(
+                    stat["counters"].get("hedges", 0), stat["counters"].get("hedge_wins", 0),
+                    stat["counters"].get("hedges_throttled", 0)
+                ))
 
             for i, srv in enumerate(grp["servers"], start=1):
+                srv_stat = snapshot["servers"].get(server_id(srv), {})
+                srv_summary = summarize(srv_stat)
+
             # Resolve health status (keeps same behavior)
                 health_flag = srv.get("healthy", True)
                 health_state = "Healthy" if health_flag else "Unhealthy"
 
             # Resolve response time display
-                resp_t = srv.get("response_time")
-                if isinstance(resp_t, (int, float)):
-                    rt_str = "{:.4f}s".format(resp_t)
-                else:
-                    rt_str = "n/a"
+                rt_str = format_seconds(srv_stat.get("response_time"))
+
+                pool = srv_stat.get("pool", {})
+                # With worker processes, every state some worker's breaker is in
+                breaker = "/".join(state for state, count in srv_stat.get("breaker", {}).items() if count)
 
                 print(
-                    "    [{}] {}:{} weight={} timeout={} status={} last_rt={}".format(
+                    "    [{}] {}:{}{} weight={} timeout={} status={} avg_rt={} inflight={} pool: hit={} miss={} idle={}".format(
                         i,
                         srv["host"],
                         srv["port"],
+                        f" ({srv['address']})" if srv.get("address") else "",
                         srv.get("weight", 1),
                         srv.get("timeout", "?"),
                         health_state,
                         rt_str,
+                        srv_stat.get("inflight", 0),
+                        pool.get("hits", 0),
+                        pool.get("misses", 0),
+                        pool.get("idle", 0),
                     )
                 )
+                print(
+                    "        requests={} failed={} p50={} p99={} breaker={} ejections={}".format(
+                        srv_summary["requests"],
+                        srv_summary["failures"],
+                        format_seconds(srv_summary["p50"]),
+                        format_seconds(srv_summary["p99"]),
+                        breaker or CLOSED,
+                        srv_summary["counters"].get("ejections", 0),
+                    )
+                )
+                timeouts = " ".join(
+                    f"{kind}={srv_summary['counters'].get('timeouts_' + kind, 0)}" for kind in TIMEOUT_KINDS
+                    if srv_summary["counters"].get("timeouts_" + kind)
+                )
+                if timeouts:
+                    print(f"        timeouts: {timeouts}")
             print()
 
     def quit_load_balancer(self):
@@ -388,40 +1192,127 @@ class HTTPLoadBalancer:
         Quit the load balancer
         """
         self.running = False
-        if self.lb_socket:
+        # The asyncio engine owns the socket and closes it when its loop notices
+        if self.lb_socket and self.engine != ASYNCIO_ENGINE:
             try:
                 self.lb_socket.close()
             except Exception:
                 pass
         print("Shutting down load balancer...")
     
-    def send_error_response(self, client_socket, status: int, message: str = ""):
-        """Send HTTP error response to client"""
+    def build_error_response(self, status: int, message: str = "", keep_alive: bool = False,
+                             retry_after=None) -> bytes:
+        """Build an HTTP error response for the client"""
+        connection = "keep-alive" if keep_alive else "close"
+        retry = f"Retry-After: {retry_after}\r\n" if retry_after is not None else ""
         http_response = ( 
             f"HTTP/1.1 {status} {message}\r\n"
             "Content-Type: text/plain\r\n"
+            f"{retry}"
             f"Content-Length: {len(message)}\r\n"
-            "Connection: close\r\n"
+            f"Connection: {connection}\r\n"
             "\r\n"
             f"{message}"
         )
-        client_socket.send(http_response.encode('utf-8'))
+        return http_response.encode('utf-8')
+
+    def upstream_error_message(self, result):
+        """Return the message of the error response for a failed forward result"""
+        if result.get("client_error"):
+            return f"{result['reason']}: {result['error']}"
+        if result["status_code"] == 504:
+            return "504 Gateway Timeout"
+        return "502 Bad Gateway: " + result.get("error", "")
+
+    def send_error_response(self, client_socket, status: int, message: str = "", keep_alive: bool = False):
+        """Send HTTP error response to client"""
+        client_socket.sendall(self.build_error_response(status, message, keep_alive))
     
     def stop_load_balancer(self):
         """Stop the load balancer"""
         self.running = False
         if self.lb_socket:
             self.lb_socket.close()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        self.connection_pool.close_all()
         print("Load balancer stopped")
 
+def format_seconds(value):
+    if isinstance(value, (int, float)) and value != float('inf'):
+        return "{:.4f}s".format(value)
+    return "n/a"
+
+
 def main():
     """
     Main function to start the HTTP load balancer
     """
+    parser = argparse.ArgumentParser(description="HTTP load balancer")
+    parser.add_argument("--host", default="localhost", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument("--engine", choices=ENGINES, default=THREADS_ENGINE,
+                        help="Connection handling engine")
+    parser.add_argument("--pool-max-idle", type=int, default=8,
+                        help="Idle keep-alive connections kept per upstream server")
+    parser.add_argument("--pool-idle-timeout", type=float, default=30.0,
+                        help="Seconds an idle upstream connection is kept")
+    parser.add_argument("--pool-max-lifetime", type=float, default=300.0,
+                        help="Seconds after which an upstream connection is retired")
+    parser.add_argument("--keepalive-timeout", type=float, default=15.0,
+                        help="Seconds an idle keep-alive client connection is kept open")
+    parser.add_argument("--max-keepalive-requests", type=int, default=1000,
+                        help="Requests served on one client connection before it is closed")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Run N pre-forked worker processes sharing the port (0 = single process)")
+    parser.add_argument("--admin-host", default="localhost",
+                        help="Address of the admin listener serving /metrics")
+    parser.add_argument("--admin-port", type=int, default=0,
+                        help="Port of the admin listener serving /metrics (0 = disabled)")
+    parser.add_argument("--config", help="JSON or YAML file with the upstream groups, reloaded on SIGHUP")
+    parser.add_argument("--threads", type=int, default=THREADS,
+                        help="Connection threads of the threads engine")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE,
+                        help="Accepted connections that may wait for a free thread before new ones get 503")
+    parser.add_argument("--backlog", type=int,
+                        help="Listen backlog (default 128, or 4096 with --engine asyncio)")
+    parser.add_argument("--dns-ttl", type=float, default=DNS_TTL,
+                        help="Seconds upstream host addresses are cached when the resolver reports no TTL")
+    parser.add_argument("--cache-size", type=float, default=CACHE_SIZE / (1024 * 1024),
+                        help="Megabytes of responses the response cache may hold, 0 disables it")
+    args = parser.parse_args()
+
     print("HTTP LOAD BALANCER")
     print("=" * 60)
 
-    lb = HTTPLoadBalancer()
+    options = dict(
+        lb_host=args.host,
+        lb_port=args.port,
+        engine=args.engine,
+        pool_max_idle=args.pool_max_idle,
+        pool_idle_timeout=args.pool_idle_timeout,
+        pool_max_lifetime=args.pool_max_lifetime,
+        client_idle_timeout=args.keepalive_timeout,
+        max_keepalive_requests=args.max_keepalive_requests,
+        admin_host=args.admin_host,
+        admin_port=args.admin_port,
+        config_path=args.config,
+        dns_ttl=args.dns_ttl,
+        threads=args.threads,
+        queue_size=args.queue_size,
+        backlog=args.backlog,
+        cache_size=int(args.cache_size * 1024 * 1024),
+    )
+    try:
+        lb = HTTPLoadBalancer(**options)
+    except ValueError as e:
+        print(f"Invalid configuration: {e}")
+        return
+    if args.workers > 0:
+        from lb_workers import WorkerMaster
+        WorkerMaster(lb, args.workers, options).run()
+        return
+
     try:
         lb.start_load_balancer()
     except KeyboardInterrupt:
@@ -1,3 +1,6 @@
+import argparse
+import asyncio
+import math
 import socket
 import threading
 import time
@@ -5,29 +8,111 @@ import random
 from datetime import datetime
 
 
+THREADS_ENGINE = "threads"
+ASYNCIO_ENGINE = "asyncio"
+ENGINES = [THREADS_ENGINE, ASYNCIO_ENGINE]
+
+BACKLOG = 128
+# Seconds a keep-alive connection of the asyncio engine may wait for its next request
+KEEPALIVE_TIMEOUT = 60.0
+MAX_HEAD_SIZE = 64 * 1024
+# z-score of the 99th percentile of a normal distribution
+_Z99 = 2.326
+
+
+def parse_latency(spec):
+    """
+    Parse a latency profile into a function returning a delay in seconds
+
+    :param spec: "none", "fixed:MS", "normal:MEAN_MS,STDDEV_MS" or "long_tail:MEDIAN_MS,P99_MS",
+        a log-normal distribution with the given median and 99th percentile
+    :raises ValueError: If the profile is malformed
+    """
+    kind, _, args = spec.partition(":")
+    try:
+        values = [float(v) / 1000.0 for v in args.split(",")] if args else []
+    except ValueError:
+        raise ValueError(f"Invalid latency profile '{spec}'") from None
+    if any(v < 0 for v in values):
+        raise ValueError(f"Invalid latency profile '{spec}'")
+    if kind == "none" and not values:
+        return lambda: 0.0
+    if kind == "fixed" and len(values) == 1:
+        return lambda: values[0]
+    if kind == "normal" and len(values) == 2:
+        mean, stddev = values
+        return lambda: max(0.0, random.gauss(mean, stddev))
+    if kind == "long_tail" and len(values) == 2 and 0 < values[0] <= values[1]:
+        median, p99 = values
+        sigma = math.log(p99 / median) / _Z99
+        return lambda: random.lognormvariate(math.log(median), sigma)
+    raise ValueError(f"Invalid latency profile '{spec}'")
+
+
 class SimpleHTTPServer:
-    def __init__(self, host='localhost', port=8080, error_rate=0.0, timeout_rate=0.0, timeout_duration=10):
+    def __init__(self, host='localhost', port=8080, error_rate=0.0, timeout_rate=0.0, timeout_duration=10,
+                 engine=THREADS_ENGINE, latency="none", payload_size=0, quiet=False, backlog=BACKLOG):
+        """
+        A backend server for load balancer tests with simulated errors, timeouts and latency
+
+        The threads engine serves one request per connection on a thread of its own.
+        The asyncio engine serves all connections on one event loop, keeps them alive
+        between requests and sleeps without blocking, so that a stalled request costs
+        no thread and the backend keeps up with the balancer under load.
+
+        :param engine: THREADS_ENGINE or ASYNCIO_ENGINE
+        :param latency: The latency profile of requests to "/", see parse_latency
+        :param payload_size: Pad the body of "/" to this many bytes
+        :param quiet: Do not log every request
+        :param backlog: Listen backlog
+        """
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine '{engine}'")
         self.host = host
         self.port = port
         self.error_rate = error_rate
         self.timeout_rate = timeout_rate
         self.timeout_duration = timeout_duration
+        self.engine = engine
+        self.latency = latency
+        self.delay = parse_latency(latency)
+        self.payload_size = payload_size
+        self.quiet = quiet
+        self.backlog = backlog
         self.server_socket = None
         self.running = False
-        
+        self._loop = None
+        self._stopping = None
+
+    def log(self, message):
+        if not self.quiet:
+            print(message)
+
+    def print_banner(self):
+        print(f"HTTP Server started on {self.host}:{self.port} (engine: {self.engine})")
+        print(f"Error rate: {self.error_rate * 100}%")
+        print(f"Timeout rate: {self.timeout_rate * 100}%")
+        print(f"Timeout duration: {self.timeout_duration}s")
+        print(f"Latency: {self.latency}")
+        print("=" * 50)
+
     def start_server(self):
+        if self.engine == ASYNCIO_ENGINE:
+            try:
+                asyncio.run(self.serve_async())
+            except Exception as e:
+                print(f"Failed to start server: {e}")
+            finally:
+                self.stop_server()
+            return
         try:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
+            self.server_socket.listen(self.backlog)
             self.running = True
             
-            print(f"HTTP Server started on {self.host}:{self.port}")
-            print(f"Error rate: {self.error_rate * 100}%")
-            print(f"Timeout rate: {self.timeout_rate * 100}%")
-            print(f"Timeout duration: {self.timeout_duration}s")
-            print("=" * 50)
+            self.print_banner()
             
             while self.running:
                 try:
@@ -54,84 +139,116 @@ class SimpleHTTPServer:
             request_line = request.split('\n')[0]
             method, path, version = request_line.split()
             
-            print(f"{client_address[0]}:{client_address[1]} - {method} {path}")
+            self.log(f"{client_address[0]}:{client_address[1]} - {method} {path}")
             
-            if path == '/healthz':
-                response = self.handle_health_check()
-            elif path == '/':
-                response = self.handle_root()
-            else:
-                response = self.handle_404()
+            delay, response = self.plan_response(path)
+            if delay:
+                time.sleep(delay)
             
-            client_socket.send(response.encode('utf-8'))
+            client_socket.sendall(response.encode('utf-8'))
             
         except Exception as e:
             print(f"Error handling client {client_address}: {e}")
         finally:
             client_socket.close()
+
+    async def serve_async(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port,
+                                           backlog=self.backlog, reuse_address=True, limit=MAX_HEAD_SIZE)
+        self.running = True
+        self.print_banner()
+        async with server:
+            await self._stopping.wait()
+
+    async def handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info("peername")
+        try:
+            while self.running:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                    return
+                lines = head.decode('latin-1').split('\r\n')
+                method, path, version = lines[0].split()
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                # Bodies are read and dropped so the next request starts where it should
+                length = int(headers.get('content-length', '0'))
+                if length:
+                    await reader.readexactly(length)
+
+                self.log(f"{client_address[0]}:{client_address[1]} - {method} {path}")
+
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+                delay, response = self.plan_response(path)
+                if delay:
+                    await asyncio.sleep(delay)
+                status_line, rest = response.split('\r\n', 1)
+                connection_header = "keep-alive" if keep_alive else "close"
+                writer.write(f"{status_line}\r\nConnection: {connection_header}\r\n{rest}".encode('utf-8'))
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        except ValueError as e:
+            print(f"Error handling client {client_address}: {e}")
+        finally:
+            writer.close()
+
+    def plan_response(self, path):
+        """
+        Return the response to a request and how long to wait before sending it
+
+        :return: (delay in seconds, response)
+        """
+        if path == '/healthz':
+            return self.handle_health_check()
+        if path == '/':
+            return self.delay(), self.handle_root()
+        return 0.0, self.handle_404()
+
+    def make_response(self, status, body):
+        return (
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain\r\n"
+            f"Content-Length: {len(body.encode('utf-8'))}\r\n"
+            f"X-Server-ID: {self.port}\r\n"
+            "\r\n"
+            f"{body}"
+        )
     
     def handle_health_check(self):
+        """
+        :return: (delay in seconds, response) as plan_response does
+        """
         if random.random() < self.timeout_rate:
-            print(f"Health check timeout simulation (sleeping {self.timeout_duration}s)")
-            time.sleep(self.timeout_duration)
-            response = (
-                "HTTP/1.1 200 OK\r\n"
-                "Content-Type: text/plain\r\n"
-                "Content-Length: 2\r\n"
-                f"X-Server-ID: {self.port}\r\n"
-                "\r\n"
-                "OK"
-            )
-            print("Health check passed after timeout (200)")
-            return response
+            self.log(f"Health check timeout simulation (sleeping {self.timeout_duration}s)")
+            return self.timeout_duration, self.make_response("200 OK", "OK")
         
         if random.random() < self.error_rate:
-            response = (
-                "HTTP/1.1 502 Bad Gateway\r\n"
-                "Content-Type: text/plain\r\n"
-                "Content-Length: 13\r\n"
-                f"X-Server-ID: {self.port}\r\n"
-                "\r\n"
-                "Service Unavailable"
-            )
-            print("Health check failed (502)")
+            response = self.make_response("502 Bad Gateway", "Service Unavailable")
+            self.log("Health check failed (502)")
         else:
-            response = (
-                "HTTP/1.1 200 OK\r\n"
-                "Content-Type: text/plain\r\n"
-                "Content-Length: 2\r\n"
-                f"X-Server-ID: {self.port}\r\n"
-                "\r\n"
-                "OK"
-            )
-            print("Health check passed (200)")
+            response = self.make_response("200 OK", "OK")
+            self.log("Health check passed (200)")
         
-        return response
+        return 0.0, response
     
     def handle_root(self):
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         body = f"Hello from HTTP Server!\nTimestamp: {timestamp}\nPort: {self.port}"
-        
-        response = (
-            "HTTP/1.1 200 OK\r\n"
-            "Content-Type: text/plain\r\n"
-            f"Content-Length: {len(body)}\r\n"
-            f"X-Server-ID: {self.port}\r\n"
-            "\r\n"
-            f"{body}"
-        )
-        return response
+        if len(body) < self.payload_size:
+            body += "\n" + "x" * (self.payload_size - len(body) - 1)
+        return self.make_response("200 OK", body)
     
     def handle_404(self):
-        response = (
-            "HTTP/1.1 404 Not Found\r\n"
-            "Content-Type: text/plain\r\n"
-            "Content-Length: 13\r\n"
-            f"X-Server-ID: {self.port}\r\n"
-            "\r\n"
-            "Not Found"
-        )
-        return response
+        return self.make_response("404 Not Found", "Not Found")
     
     def set_error_rate(self, error_rate):
         self.error_rate = max(0.0, min(1.0, error_rate))
@@ -144,21 +261,55 @@ class SimpleHTTPServer:
     def set_timeout_duration(self, timeout_duration):
         self.timeout_duration = max(1.0, timeout_duration)
         print(f"Timeout duration set to {self.timeout_duration}s")
+
+    def set_latency(self, latency):
+        self.delay = parse_latency(latency)
+        self.latency = latency
+        print(f"Latency set to {self.latency}")
     
     def stop_server(self):
         self.running = False
         if self.server_socket:
             self.server_socket.close()
+        if self._loop is not None and not self._loop.is_closed():
+            try:
+                self._loop.call_soon_threadsafe(self._stopping.set)
+            except RuntimeError:
+                # The loop closed in the meantime
+                pass
         print("HTTP Server stopped")
 
 def main():
+    parser = argparse.ArgumentParser(description="Backend HTTP server for load balancer testing")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--error-rate", type=float, default=0.1, help="Share of failed health checks")
+    parser.add_argument("--timeout-rate", type=float, default=0.2, help="Share of stalled health checks")
+    parser.add_argument("--timeout-duration", type=float, default=8, help="Seconds a stalled health check takes")
+    parser.add_argument("--engine", choices=ENGINES, default=THREADS_ENGINE,
+                        help="threads: a thread per connection; asyncio: one event loop with keep-alive")
+    parser.add_argument("--latency", default="none",
+                        help="Latency of requests to /: none, fixed:MS, normal:MEAN_MS,STDDEV_MS "
+                             "or long_tail:MEDIAN_MS,P99_MS")
+    parser.add_argument("--payload-size", type=int, default=0, help="Pad the body of / to this many bytes")
+    parser.add_argument("--quiet", action="store_true", help="Do not log every request")
+    parser.add_argument("--backlog", type=int, default=BACKLOG, help="Listen backlog (default 128)")
+    args = parser.parse_args()
+    try:
+        parse_latency(args.latency)
+    except ValueError as e:
+        parser.error(str(e))
+
     print("=" * 50)
     print("SIMPLE HTTP SERVER")
     print("=" * 50)
     print("This server provides a /healthz endpoint for load balancer testing")
     print("=" * 50)
     
-    server = SimpleHTTPServer(port=8080, error_rate=0.1, timeout_rate=0.2, timeout_duration=8)
+    server = SimpleHTTPServer(host=args.host, port=args.port, error_rate=args.error_rate,
+                              timeout_rate=args.timeout_rate, timeout_duration=args.timeout_duration,
+                              engine=args.engine, latency=args.latency, payload_size=args.payload_size,
+                              quiet=args.quiet, backlog=args.backlog)
     
     try:
         server.start_server()
@@ -0,0 +1,136 @@
+import json
+import os
+
+from deadlines import TIMEOUT_OPTIONS
+from schedulers import parse_hash_key
+from upstream_pool import server_id
+
+
+# Keys of an upstream server entry that hold live state rather than configuration
+RUNTIME_KEYS = ("healthy", "response_time", "state", "breaker")
+
+SERVER_DEFAULTS = {"weight": 1, "timeout": 2}
+
+
+class ConfigError(ValueError):
+    """
+    Raised when a configuration file cannot be read or describes an invalid setup
+    """
+
+
+def read_config_file(path):
+    """
+    Read a JSON or, if PyYAML is installed, a YAML configuration file
+
+    :return: The parsed configuration dict
+    :raises ConfigError: If the file cannot be read or parsed
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+    except OSError as e:
+        raise ConfigError(f"Cannot read {path}: {e}")
+
+    if os.path.splitext(path)[1].lower() in (".yaml", ".yml"):
+        try:
+            import yaml
+        except ImportError:
+            raise ConfigError("YAML configuration files require PyYAML (pip install pyyaml)")
+        try:
+            config = yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise ConfigError(f"Invalid YAML in {path}: {e}")
+    else:
+        try:
+            config = json.loads(text)
+        except ValueError as e:
+            raise ConfigError(f"Invalid JSON in {path}: {e}")
+    if not isinstance(config, dict):
+        raise ConfigError(f"{path} must contain a mapping")
+    return config
+
+
+def parse_upstream_groups(config, algorithms):
+    """
+    Validate the "upstream_groups" section of a configuration and fill in defaults
+
+    :param config: The parsed configuration dict
+    :param algorithms: The names of the supported load balancing algorithms
+    :return: New upstream group dicts keyed by group name
+    :raises ConfigError: If a group or server is invalid
+    """
+    groups = config.get("upstream_groups")
+    if not isinstance(groups, dict) or not groups:
+        raise ConfigError("upstream_groups must be a non-empty mapping")
+
+    parsed = {}
+    for name, group in groups.items():
+        if not isinstance(group, dict):
+            raise ConfigError(f"Upstream group {name} must be a mapping")
+        if group.get("algorithm") not in algorithms:
+            raise ConfigError(f"Upstream group {name} has unknown algorithm {group.get('algorithm')!r}")
+        if "hash_key" in group:
+            try:
+                parse_hash_key(group["hash_key"])
+            except ValueError as e:
+                raise ConfigError(f"Upstream group {name}: {e}")
+        servers = group.get("servers")
+        if not isinstance(servers, list) or not servers:
+            raise ConfigError(f"Upstream group {name} needs a non-empty servers list")
+
+        parsed_servers = []
+        for server in servers:
+            if not isinstance(server, dict) or "host" not in server or not isinstance(server.get("port"), int):
+                raise ConfigError(f"Every server of {name} needs a host and an integer port")
+            entry = dict(SERVER_DEFAULTS)
+            # Timeouts set on the group apply to its servers that do not set their own
+            entry.update({k: group[k] for k in TIMEOUT_OPTIONS if k in group})
+            entry.update({k: v for k, v in server.items() if k not in RUNTIME_KEYS})
+            if not isinstance(entry["weight"], int) or entry["weight"] < 0:
+                raise ConfigError(f"Server {entry['host']}:{entry['port']} of {name} has an invalid weight")
+            for key in TIMEOUT_OPTIONS:
+                value = entry.get(key)
+                if key in entry and not (value is None and key == "request_timeout") and not _is_positive(value):
+                    raise ConfigError(f"Server {entry['host']}:{entry['port']} of {name} has an invalid {key}")
+            entry["healthy"] = True
+            parsed_servers.append(entry)
+
+        parsed_group = dict(group)
+        parsed_group["servers"] = parsed_servers
+        parsed[name] = parsed_group
+    return parsed
+
+
+def _is_positive(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0
+
+
+def carry_over_servers(old_groups, new_groups):
+    """
+    Keep the live server entries of servers that are still configured
+
+    A server that keeps its host, port and resolved address within the same group
+    keeps its entry: the new settings are written into it, so its health, moving
+    averages and in-flight count, and everything keyed by the entry such as health
+    check history, survive a reload. Requests in flight hold on to the entries they started with either way.
+
+    :return: The server_id of every server in new_groups
+    """
+    server_ids = set()
+    for name, group in new_groups.items():
+        old_servers = {}
+        for server in old_groups.get(name, {}).get("servers", []):
+            old_servers.setdefault((server["host"], server["port"], server.get("address")), server)
+
+        servers = []
+        for server in group["servers"]:
+            old = old_servers.pop((server["host"], server["port"], server.get("address")), None)
+            if old is not None:
+                for key in [k for k in old if k not in server and k not in RUNTIME_KEYS]:
+                    old.pop(key, None)
+                old.update({k: v for k, v in server.items() if k not in RUNTIME_KEYS})
+                server = old
+            servers.append(server)
+            server_ids.add(server_id(server))
+        group["servers"] = servers
+    return server_ids
@@ -0,0 +1,283 @@
+import socket
+import threading
+import time
+
+from deadlines import TIMEOUT_KINDS
+from http_framing import HTTPFramingError, parse_request_head, read_head
+from lb_stats import STATUS_CLASSES, LatencyHistogram
+from upstream_pool import server_id
+
+
+# Seconds a rendered /metrics page is reused, so frequent scrapes cost one render per interval
+METRICS_CACHE_TTL = 1.0
+# Upper bounds in seconds of the exported latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class _Writer:
+    def __init__(self):
+        """
+        Collects samples per metric family, because the exposition format wants
+        all samples of a family in one group after its HELP and TYPE lines
+        """
+        self.families = {}
+        self._family = None
+
+    def declare(self, name, kind, help_text):
+        if name not in self.families:
+            self.families[name] = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        self._family = self.families[name]
+
+    def sample(self, name, labels, value):
+        self._family.append(f"{name}{labels} {value}")
+
+    def histogram(self, name, labels, data):
+        histogram = LatencyHistogram.from_dict(data or {})
+        for bound, count in zip(LATENCY_BUCKETS, histogram.cumulative(LATENCY_BUCKETS)):
+            self.sample(name + "_bucket", _labels(**labels, le=bound), count)
+        self.sample(name + "_bucket", _labels(**labels, le="+Inf"), histogram.total)
+        self.sample(name + "_sum", _labels(**labels), histogram.sum)
+        self.sample(name + "_count", _labels(**labels), histogram.total)
+
+    def text(self):
+        return "\n".join(line for lines in self.families.values() for line in lines) + "\n"
+
+
+def _request_metrics(out, prefix, metrics, **labels):
+    counters = metrics.get("counters", {})
+    out.declare(prefix + "_requests_total", "counter", "Requests proxied by the load balancer")
+    out.sample(prefix + "_requests_total", _labels(**labels), counters.get("requests", 0))
+    out.declare(prefix + "_request_failures_total", "counter", "Requests that failed to get an upstream response")
+    out.sample(prefix + "_request_failures_total", _labels(**labels), counters.get("failures", 0))
+    out.declare(prefix + "_responses_total", "counter", "Responses sent to clients by status class")
+    for cls in STATUS_CLASSES:
+        out.sample(prefix + "_responses_total", _labels(**labels, code=cls), counters.get(cls, 0))
+    out.declare(prefix + "_received_bytes_total", "counter", "Request bytes sent to upstream servers")
+    out.sample(prefix + "_received_bytes_total", _labels(**labels), counters.get("bytes_in", 0))
+    out.declare(prefix + "_sent_bytes_total", "counter", "Response bytes sent to clients")
+    out.sample(prefix + "_sent_bytes_total", _labels(**labels), counters.get("bytes_out", 0))
+    out.declare(prefix + "_request_duration_seconds", "histogram", "Time from upstream selection to the end of the response")
+    out.histogram(prefix + "_request_duration_seconds", labels, metrics.get("latency"))
+
+
+def render_metrics(lb, snapshot):
+    """
+    Render the Prometheus text exposition of the load balancer
+
+    Request statistics, in-flight counts, pool, connection queue and cache counters come from the snapshot;
+    health flags and health check history come from lb itself.
+
+    :param lb: The HTTPLoadBalancer that runs the health checker
+    :param snapshot: Statistics as returned by stats_snapshot, possibly merged over workers
+    :return: The exposition text
+    """
+    out = _Writer()
+    connections = snapshot.get("connections")
+    if connections:
+        out.declare("lb_connection_threads", "gauge", "Connection threads by state")
+        busy = connections.get("busy", 0)
+        out.sample("lb_connection_threads", _labels(state="busy"), busy)
+        out.sample("lb_connection_threads", _labels(state="idle"), connections.get("threads", 0) - busy)
+        out.declare("lb_connection_queue_depth", "gauge", "Accepted connections waiting for a free thread")
+        out.sample("lb_connection_queue_depth", "", connections.get("queued", 0))
+        out.declare("lb_connection_queue_size", "gauge", "Connections the queue can hold before new ones are shed")
+        out.sample("lb_connection_queue_size", "", connections.get("queue_size", 0))
+        out.declare("lb_connections_total", "counter", "Accepted client connections by outcome")
+        for outcome in ("accepted", "shed"):
+            out.sample("lb_connections_total", _labels(outcome=outcome), connections.get(outcome, 0))
+
+    cache = snapshot.get("cache")
+    if cache:
+        out.declare("lb_cache_lookups_total", "counter",
+                    "Cacheable requests by result; hits / (hits + misses) is the hit ratio")
+        for result in ("hits", "misses", "coalesced"):
+            out.sample("lb_cache_lookups_total", _labels(result=result), cache.get(result, 0))
+        out.declare("lb_cache_stores_total", "counter", "Responses stored in the response cache")
+        out.sample("lb_cache_stores_total", "", cache.get("stores", 0))
+        out.declare("lb_cache_evictions_total", "counter", "Responses evicted to stay below the cache size")
+        out.sample("lb_cache_evictions_total", "", cache.get("evictions", 0))
+        out.declare("lb_cache_entries", "gauge", "Responses held by the response cache")
+        out.sample("lb_cache_entries", "", cache.get("entries", 0))
+        out.declare("lb_cache_bytes", "gauge", "Bytes of responses held by the response cache")
+        out.sample("lb_cache_bytes", "", cache.get("bytes", 0))
+        out.declare("lb_cache_max_bytes", "gauge", "Bytes the response cache may hold")
+        out.sample("lb_cache_max_bytes", "", cache.get("max_bytes", 0))
+
+    for domain in lb.upstream_groups:
+        metrics = snapshot["domains"].get(domain, {})
+        _request_metrics(out, "lb", metrics, domain=domain)
+        counters = metrics.get("counters", {})
+        out.declare("lb_retries_total", "counter", "Requests retried on another upstream server")
+        out.sample("lb_retries_total", _labels(domain=domain), counters.get("retries", 0))
+        out.declare("lb_retries_throttled_total", "counter", "Retries refused by the retry budget")
+        out.sample("lb_retries_throttled_total", _labels(domain=domain), counters.get("retries_throttled", 0))
+        out.declare("lb_hedges_total", "counter", "Hedged copies of slow requests sent to a second upstream server")
+        out.sample("lb_hedges_total", _labels(domain=domain), counters.get("hedges", 0))
+        out.declare("lb_hedge_wins_total", "counter", "Hedged requests answered first by the second upstream server")
+        out.sample("lb_hedge_wins_total", _labels(domain=domain), counters.get("hedge_wins", 0))
+        out.declare("lb_hedges_throttled_total", "counter", "Hedged copies refused by the hedge budget")
+        out.sample("lb_hedges_throttled_total", _labels(domain=domain), counters.get("hedges_throttled", 0))
+
+    for domain, group in lb.upstream_groups.items():
+        for server in group["servers"]:
+            labels = {"domain": domain, "server": server_id(server)}
+            srv_stat = snapshot["servers"].get(labels["server"], {})
+            _request_metrics(out, "lb_upstream", srv_stat, **labels)
+
+            out.declare("lb_upstream_healthy", "gauge", "Whether the upstream server is marked healthy")
+            out.sample("lb_upstream_healthy", _labels(**labels), 1 if server.get("healthy", True) else 0)
+            out.declare("lb_upstream_weight", "gauge", "Configured weight of the upstream server")
+            out.sample("lb_upstream_weight", _labels(**labels), server.get("weight", 1))
+            out.declare("lb_upstream_inflight", "gauge", "Requests in flight to the upstream server")
+            out.sample("lb_upstream_inflight", _labels(**labels), srv_stat.get("inflight", 0))
+            response_time = srv_stat.get("response_time")
+            if response_time is not None:
+                out.declare("lb_upstream_response_time_seconds", "gauge",
+                            "Moving average response time of the upstream server")
+                out.sample("lb_upstream_response_time_seconds", _labels(**labels), response_time)
+
+            out.declare("lb_upstream_breaker", "gauge",
+                        "Circuit breaker state of the upstream server, counted over worker processes")
+            for state, count in srv_stat.get("breaker", {}).items():
+                out.sample("lb_upstream_breaker", _labels(**labels, state=state), count)
+            out.declare("lb_upstream_ejections_total", "counter", "Times the circuit breaker ejected the upstream server")
+            out.sample("lb_upstream_ejections_total", _labels(**labels),
+                       srv_stat.get("counters", {}).get("ejections", 0))
+            out.declare("lb_upstream_timeouts_total", "counter",
+                        "Requests to the upstream server that ran out of a timeout, by timeout")
+            for kind in TIMEOUT_KINDS:
+                out.sample("lb_upstream_timeouts_total", _labels(**labels, kind=kind),
+                           srv_stat.get("counters", {}).get("timeouts_" + kind, 0))
+
+            pool = srv_stat.get("pool", {})
+            out.declare("lb_pool_connections", "gauge", "Upstream connections by state")
+            for state in ("idle", "active"):
+                out.sample("lb_pool_connections", _labels(**labels, state=state), pool.get(state, 0))
+            out.declare("lb_pool_acquires_total", "counter", "Upstream connection acquisitions by result")
+            for result in ("hits", "misses"):
+                out.sample("lb_pool_acquires_total", _labels(**labels, result=result), pool.get(result, 0))
+            out.declare("lb_pool_discarded_total", "counter", "Pooled connections discarded by reason")
+            for reason in ("stale", "expired"):
+                out.sample("lb_pool_discarded_total", _labels(**labels, reason=reason), pool.get(reason, 0))
+
+            health = lb.health_checker.history.get(id(server))
+            if health is not None:
+                out.declare("lb_health_checks_total", "counter", "Active health checks made")
+                out.sample("lb_health_checks_total", _labels(**labels), health.checks)
+                out.declare("lb_health_check_failures_total", "counter", "Active health checks that failed")
+                out.sample("lb_health_check_failures_total", _labels(**labels), health.failed_checks)
+                out.declare("lb_health_check_duration_seconds_total", "counter",
+                            "Total time spent in active health checks")
+                out.sample("lb_health_check_duration_seconds_total", _labels(**labels), health.total_duration)
+                if health.last_duration is not None:
+                    out.declare("lb_health_check_last_duration_seconds", "gauge",
+                                "Duration of the latest active health check")
+                    out.sample("lb_health_check_last_duration_seconds", _labels(**labels), health.last_duration)
+    return out.text()
+
+
+class MetricsServer:
+    def __init__(self, lb, host='localhost', port=9000, snapshot_source=None, cache_ttl=METRICS_CACHE_TTL):
+        """
+        Admin listener serving GET /metrics in the Prometheus text format
+
+        It runs on its own port and thread, apart from the proxy listener. A rendered
+        page is cached for cache_ttl seconds and shared by concurrent scrapes, so
+        scraping does not add work to the proxy threads beyond one snapshot per interval.
+
+        :param lb: The HTTPLoadBalancer to report on
+        :param snapshot_source: A function returning the statistics snapshot, defaults to lb.stats_snapshot
+        :param cache_ttl: Seconds a rendered page is reused
+        """
+        self.lb = lb
+        self.host = host
+        self.port = port
+        self.snapshot_source = snapshot_source or lb.stats_snapshot
+        self.cache_ttl = cache_ttl
+        self.server_socket = None
+        self.running = False
+        self._cached = (0.0, b"")
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Bind the admin port and serve it on a daemon thread
+        """
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(16)
+        self.running = True
+        print(f" Metrics available on http://{self.host}:{self.port}/metrics")
+        thread = threading.Thread(target=self.serve_forever, daemon=True, name="metrics")
+        thread.start()
+        return thread
+
+    def serve_forever(self):
+        while self.running:
+            try:
+                client_socket, client_address = self.server_socket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.handle_client, args=(client_socket,), daemon=True,
+                             name="metrics-client").start()
+
+    def render(self):
+        """
+        Return the exposition bytes, rendering them at most once per cache_ttl
+        """
+        with self._lock:
+            rendered_at, body = self._cached
+            if time.monotonic() - rendered_at >= self.cache_ttl:
+                body = render_metrics(self.lb, self.snapshot_source()).encode("utf-8")
+                self._cached = (time.monotonic(), body)
+            return body
+
+    def handle_client(self, client_socket):
+        try:
+            client_socket.settimeout(5.0)
+            head = read_head(client_socket, bytearray())
+            if head is None:
+                return
+            request = parse_request_head(head)
+            path = request.target.split("?", 1)[0]
+            if request.method != "GET":
+                self.send_response(client_socket, 405, "Method Not Allowed", b"Method Not Allowed")
+            elif path == "/metrics":
+                self.send_response(client_socket, 200, "OK", self.render(), CONTENT_TYPE)
+            else:
+                self.send_response(client_socket, 404, "Not Found", b"Not Found")
+        except HTTPFramingError:
+            self.send_response(client_socket, 400, "Bad Request", b"Bad Request")
+        except Exception as e:
+            print(f"Error serving metrics: {e}")
+        finally:
+            client_socket.close()
+
+    def send_response(self, client_socket, status, reason, body, content_type="text/plain"):
+        head = (
+            f"HTTP/1.1 {status} {reason}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n"
+            "\r\n"
+        )
+        try:
+            client_socket.sendall(head.encode("latin-1") + body)
+        except OSError:
+            pass
+
+    def stop(self):
+        self.running = False
+        if self.server_socket:
+            self.server_socket.close()
@@ -0,0 +1,256 @@
+import itertools
+import threading
+
+
+# Latency histogram layout: values in microseconds, 2**SUB_BITS linear buckets per
+# power of two, which keeps every bucket within 12.5% of its value like an HDR histogram
+SUB_BITS = 3
+SUB_COUNT = 1 << SUB_BITS
+MAX_BUCKET = 200
+# Number of independently locked shards that request threads are spread over
+SHARDS = 16
+
+STATUS_CLASSES = ("1xx", "2xx", "3xx", "4xx", "5xx")
+
+
+def bucket_index(microseconds):
+    value = max(0, int(microseconds))
+    shift = max(0, value.bit_length() - SUB_BITS - 1)
+    return min(MAX_BUCKET - 1, shift * SUB_COUNT + (value >> shift))
+
+
+def bucket_bounds(index):
+    """
+    Return the [lower, upper) range of a bucket in microseconds
+    """
+    shift = max(0, index // SUB_COUNT - 1)
+    lower = (index - shift * SUB_COUNT) << shift
+    return lower, lower + (1 << shift)
+
+
+class LatencyHistogram:
+    def __init__(self):
+        """
+        Log-linear latency histogram with a fixed number of buckets
+        """
+        self.counts = [0] * MAX_BUCKET
+        self.total = 0
+        self.sum = 0.0
+
+    def record(self, seconds):
+        self.counts[bucket_index(seconds * 1e6)] += 1
+        self.total += 1
+        self.sum += seconds
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            if count:
+                self.counts[i] += count
+        self.total += other.total
+        self.sum += other.sum
+
+    def percentile(self, percent):
+        """
+        Return the latency in seconds below which the given percent of samples fall
+        """
+        if not self.total:
+            return None
+        rank = percent / 100.0 * self.total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                lower, upper = bucket_bounds(i)
+                return (lower + upper) / 2 / 1e6
+        return None
+
+    def cumulative(self, bounds):
+        """
+        Count the samples at or below each bound in seconds, for exporting coarser buckets
+
+        A bucket is counted under a bound only when it lies entirely below it.
+        """
+        counts = []
+        for bound in bounds:
+            limit = bound * 1e6
+            counts.append(sum(count for i, count in enumerate(self.counts)
+                              if count and bucket_bounds(i)[1] <= limit))
+        return counts
+
+    def to_dict(self):
+        return {
+            "buckets": {str(i): count for i, count in enumerate(self.counts) if count},
+            "count": self.total,
+            "sum": self.sum,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        for i, count in data.get("buckets", {}).items():
+            histogram.counts[int(i)] += count
+        histogram.total = data.get("count", 0)
+        histogram.sum = data.get("sum", 0.0)
+        return histogram
+
+
+class RequestMetrics:
+    def __init__(self):
+        """
+        Counters and latency histogram of one domain or upstream server
+        """
+        self.counters = {}
+        self.latency = LatencyHistogram()
+
+    def add(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other):
+        for name, value in other.counters.items():
+            self.add(name, value)
+        self.latency.merge(other.latency)
+
+    def to_dict(self):
+        return {"counters": dict(self.counters), "latency": self.latency.to_dict()}
+
+
+class _Shard:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.domains = {}
+        self.servers = {}
+
+
+class StatsRegistry:
+    def __init__(self, shards=SHARDS):
+        """
+        Request statistics per domain and per upstream server
+
+        Writers are spread over independently locked shards, one chosen per thread,
+        so concurrent requests rarely contend on a lock and counts never drift.
+        Readers merge all shards into a snapshot.
+        """
+        self._shards = [_Shard() for _ in range(shards)]
+        self._next_shard = itertools.count()
+        self._local = threading.local()
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._shards[next(self._next_shard) % len(self._shards)]
+            self._local.shard = shard
+        return shard
+
+    @staticmethod
+    def _metrics(table, key):
+        metrics = table.get(key)
+        if metrics is None:
+            metrics = table[key] = RequestMetrics()
+        return metrics
+
+    def record_request(self, domain, server_id, status, duration, bytes_in=0, bytes_out=0, failed=False):
+        """
+        Record one proxied request
+
+        :param domain: The domain, or None to record an attempt of the upstream server only
+        :param status: The HTTP status sent to the client, or None if no response was sent
+        :param duration: Seconds from selecting the upstream to the end of the response
+        """
+        shard = self._shard()
+        with shard.lock:
+            targets = []
+            if domain is not None:
+                targets.append(self._metrics(shard.domains, domain))
+            if server_id is not None:
+                targets.append(self._metrics(shard.servers, server_id))
+            for metrics in targets:
+                metrics.add("requests")
+                if failed:
+                    metrics.add("failures")
+                if status:
+                    metrics.add(STATUS_CLASSES[min(4, max(0, status // 100 - 1))])
+                metrics.add("bytes_in", bytes_in)
+                metrics.add("bytes_out", bytes_out)
+                if not failed:
+                    metrics.latency.record(duration)
+
+    def count(self, domain, server_id, name, value=1):
+        """
+        Add to a named counter of a domain and, if given, of an upstream server
+        """
+        shard = self._shard()
+        with shard.lock:
+            if domain is not None:
+                self._metrics(shard.domains, domain).add(name, value)
+            if server_id is not None:
+                self._metrics(shard.servers, server_id).add(name, value)
+
+    def snapshot(self):
+        """
+        Merge all shards into {"domains": {...}, "servers": {...}} of plain dicts
+        """
+        domains = {}
+        servers = {}
+        for shard in self._shards:
+            with shard.lock:
+                for table, merged in ((shard.domains, domains), (shard.servers, servers)):
+                    for key, metrics in table.items():
+                        self._metrics(merged, key).merge(metrics)
+        return {
+            "domains": {key: metrics.to_dict() for key, metrics in domains.items()},
+            "servers": {key: metrics.to_dict() for key, metrics in servers.items()},
+        }
+
+
+def merge_snapshots(snapshots, averaged=("response_time",)):
+    """
+    Merge snapshot dicts from several processes
+
+    Numbers are summed recursively, except the keys in averaged, whose values are
+    averaged over the snapshots that have one.
+    """
+    merged = {}
+    samples = {}
+    for snapshot in snapshots:
+        _merge_into(merged, snapshot, averaged, samples, ())
+    for path, values in samples.items():
+        target = merged
+        for key in path[:-1]:
+            target = target[key]
+        target[path[-1]] = sum(values) / len(values)
+    return merged
+
+
+def _merge_into(merged, data, averaged, samples, path):
+    for key, value in data.items():
+        if key in averaged:
+            merged.setdefault(key, None)
+            if value is not None:
+                samples.setdefault(path + (key,), []).append(value)
+        elif isinstance(value, dict):
+            _merge_into(merged.setdefault(key, {}), value, averaged, samples, path + (key,))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            merged[key] = merged.get(key, 0) + value
+        else:
+            merged[key] = value
+
+
+def summarize(metrics):
+    """
+    Turn a RequestMetrics dict into the numbers shown to users
+
+    :return: Requests, failures, bytes, status classes and p50/p95/p99 latency in seconds
+    """
+    counters = metrics.get("counters", {}) if metrics else {}
+    latency = LatencyHistogram.from_dict(metrics.get("latency", {})) if metrics else LatencyHistogram()
+    summary = {
+        "requests": counters.get("requests", 0),
+        "failures": counters.get("failures", 0),
+        "bytes_in": counters.get("bytes_in", 0),
+        "bytes_out": counters.get("bytes_out", 0),
+        "status": {cls: counters.get(cls, 0) for cls in STATUS_CLASSES},
+    }
+    for percent in (50, 95, 99):
+        summary[f"p{percent}"] = latency.percentile(percent)
+    summary["counters"] = counters
+    return summary
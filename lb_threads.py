@@ -0,0 +1,99 @@
+import queue
+import threading
+import time
+
+
+# Defaults of the threads engine
+THREADS = 64
+QUEUE_SIZE = 128
+
+
+class ConnectionThreadPool:
+    def __init__(self, handler, threads=THREADS, queue_size=QUEUE_SIZE):
+        """
+        A fixed number of threads serving client connections from a bounded queue
+
+        Accepted connections wait in the queue until a thread is free. When the queue
+        is full, submit refuses the connection instead of blocking the accept loop or
+        starting another thread, so the caller can shed it.
+
+        :param handler: Called with the arguments passed to submit, on a pool thread
+        :param threads: The number of threads
+        :param queue_size: Connections that may wait for a free thread, at least 1
+        """
+        if threads < 1 or queue_size < 1:
+            raise ValueError("The thread pool needs at least one thread and one queue slot")
+        self.handler = handler
+        self.threads = threads
+        self.queue_size = queue_size
+        self.counters = {"accepted": 0, "shed": 0}
+        self.busy = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        for i in range(self.threads):
+            thread = threading.Thread(target=self._run, daemon=True, name=f"conn-{i}")
+            thread.start()
+            self._workers.append(thread)
+
+    def submit(self, *args):
+        """
+        Queue a connection for the next free thread
+
+        :return: Whether it was queued; False if the queue is full
+        """
+        try:
+            self._queue.put_nowait(args)
+        except queue.Full:
+            with self._lock:
+                self.counters["shed"] += 1
+            return False
+        with self._lock:
+            self.counters["accepted"] += 1
+        return True
+
+    def backlogged(self):
+        """
+        Whether connections are waiting for a free thread
+        """
+        return not self._queue.empty()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["busy"] = self.busy
+        stats.update(threads=self.threads, queued=self._queue.qsize(), queue_size=self.queue_size)
+        return stats
+
+    def _run(self):
+        while True:
+            args = self._queue.get()
+            if args is None:
+                return
+            with self._lock:
+                self.busy += 1
+            try:
+                self.handler(*args)
+            except Exception as e:
+                print(f"Connection handler error: {e}")
+            finally:
+                with self._lock:
+                    self.busy -= 1
+
+    def shutdown(self, timeout=0.0):
+        """
+        Let the threads finish the queued connections, then stop them
+
+        :param timeout: Seconds to wait for the threads before returning
+        """
+        deadline = time.monotonic() + timeout
+        for _ in self._workers:
+            try:
+                self._queue.put(None, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                break
+        for thread in self._workers:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        self._workers = []
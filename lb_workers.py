@@ -0,0 +1,383 @@
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+from lb_stats import merge_snapshots
+from upstream_pool import server_id
+
+
+# How often workers pick up health changes and report their statistics
+HEALTH_SYNC_INTERVAL = 0.5
+STATS_REPORT_INTERVAL = 1.0
+
+
+class SharedHealth:
+    def __init__(self, lb, context):
+        """
+        Health flags and check latencies of every upstream server in shared memory
+
+        The master creates the arrays of each generation and passes them to its workers,
+        so the master's health checker writes values that all workers of the generation
+        read. A worker builds its own server entries, so values are matched by server id.
+
+        :param lb: The master's HTTPLoadBalancer, whose upstream servers get a slot each
+        :param context: The multiprocessing context the workers are started with
+        """
+        # The entries of this generation: a reload or DNS change may install new
+        # ones in the master before the next arrays are created
+        self._servers = [srv for grp in lb.upstream_groups.values() for srv in grp["servers"]]
+        self._history = lb.health_checker.history
+        self.server_ids = [server_id(srv) for srv in self._servers]
+        size = max(1, len(self._servers))
+        self._flags = context.RawArray("b", size)
+        # The latency of the last passed check, and the number of checks it was found by
+        self._probes = context.RawArray("d", size)
+        self._checks = context.RawArray("i", size)
+        # The check counts a worker has already passed on, by server id
+        self._applied = {}
+
+    def __getstate__(self):
+        # The master's server entries and check history stay in the master
+        state = dict(self.__dict__)
+        state.update(_servers=[], _history={})
+        return state
+
+    def publish(self):
+        """
+        Write the master's health flags and check latencies into shared memory
+        """
+        for i, srv in enumerate(self._servers):
+            self._flags[i] = 1 if srv.get("healthy", True) else 0
+            check = self._history.get(id(srv))
+            if check is not None and check.failures == 0 and check.last_duration is not None:
+                self._probes[i] = check.last_duration
+                self._checks[i] = check.checks
+
+    def apply(self, lb):
+        """
+        Copy the shared health flags into the upstream server entries of a worker and
+        pass on the latency of every check it has not seen yet
+        """
+        index = {sid: i for i, sid in enumerate(self.server_ids)}
+        for grp in lb.upstream_groups.values():
+            for srv in grp["servers"]:
+                sid = server_id(srv)
+                i = index.get(sid)
+                if i is None:
+                    continue
+                healthy = bool(self._flags[i])
+                if srv.get("healthy", True) != healthy:
+                    lb.set_server_health(srv, healthy)
+                checks = self._checks[i]
+                if checks and checks != self._applied.get(sid):
+                    self._applied[sid] = checks
+                    lb.observe_probe_time(srv, self._probes[i])
+
+
+def run_worker(index, options, upstream_groups, dns_records, health, listener, report, drain_timeout):
+    """
+    Build a load balancer from the master's configuration and serve on it until SIGTERM
+
+    This is the target of a worker process.
+
+    :param options: The HTTPLoadBalancer arguments the master was started with
+    :param upstream_groups: The master's configured upstream groups
+    :param dns_records: The master's DNS answers, so the worker expands the same servers
+    :param health: The SharedHealth of the worker's generation
+    :param listener: The listening socket shared by all workers, or None to bind one with SO_REUSEPORT
+    :param report: The Connection statistics are sent to the master through
+    """
+    from http_load_balancer import HTTPLoadBalancer
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    try:
+        lb = HTTPLoadBalancer(**options, upstream_groups=upstream_groups, dns_records=dns_records)
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(lb, "running", False))
+        lb.lb_socket = listener or lb.create_listener(reuse_port=True)
+        lb.drain_timeout = drain_timeout
+        lb.running = True
+        health.apply(lb)
+    except Exception as e:
+        print(f"Worker {index} failed: {e}")
+        raise SystemExit(1)
+
+    threading.Thread(target=_sync_worker, args=(lb, health, report), daemon=True, name="worker-sync").start()
+    try:
+        lb.serve_forever()
+    finally:
+        lb.running = False
+        lb.connection_pool.close_all()
+        report.close()
+
+
+def _sync_worker(lb, health, report):
+    """
+    Apply shared health flags and report statistics to the master
+    """
+    last_report = 0.0
+    while lb.running:
+        health.apply(lb)
+        if time.time() - last_report >= STATS_REPORT_INTERVAL:
+            last_report = time.time()
+            try:
+                report.send(lb.stats_snapshot())
+            except OSError:
+                return
+        time.sleep(HEALTH_SYNC_INTERVAL)
+
+
+class WorkerMaster:
+    def __init__(self, lb, workers, options, drain_timeout=30.0):
+        """
+        Pre-fork master that runs the load balancer in several worker processes
+
+        Workers are forked by multiprocessing's fork server, a process without threads,
+        and not by the master: a fork copies only the forking thread, so a lock that
+        one of the master's health, DNS or statistics threads held at that moment
+        (stdout, a scheduler's, the DNS cache's) would stay locked in the worker forever.
+        Each worker builds its load balancer from the master's options, configuration
+        and DNS answers.
+
+        Every worker binds lb_port with SO_REUSEPORT, so the kernel spreads connections
+        across them; where SO_REUSEPORT is missing they accept on one shared socket.
+        The master does not serve clients. It runs the health checker and shares its
+        results through SharedHealth, restarts crashed workers, performs graceful reloads
+        and merges the statistics that workers report through pipes for '- list' and /metrics.
+        Round-robin schedulers stay per worker: each one follows the weights, so the
+        traffic spread by the kernel over all workers follows them too.
+
+        :param lb: A configured HTTPLoadBalancer that has not been started
+        :param workers: The number of worker processes
+        :param options: The arguments lb was created with, which the workers are created with too
+        :param drain_timeout: Seconds a stopping worker waits for requests in flight
+        """
+        self.lb = lb
+        self.workers = workers
+        self.options = options
+        self.context = None
+        self.drain_timeout = drain_timeout
+        self.generation = 0
+        self.children = {}
+        self.snapshots = {}
+        self.retired = {"domains": {}, "servers": {}}
+        self.health = None
+        self.listener = None
+        self.running = False
+        self._reload_requested = False
+        self._lock = threading.Lock()
+
+    def run(self):
+        """
+        Start the workers and supervise them until the master is stopped
+        """
+        if "forkserver" not in multiprocessing.get_all_start_methods():
+            raise RuntimeError("Worker processes require the forkserver start method")
+        self.context = multiprocessing.get_context("forkserver")
+        self.running = True
+        self.lb.running = True
+
+        if not hasattr(socket, "SO_REUSEPORT"):
+            self.listener = self.lb.create_listener()
+
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+
+        self.lb.print_banner()
+        print(f" Workers: {self.workers} (master pid {os.getpid()})")
+        self.lb.start_metrics_server(self.aggregate_snapshot)
+
+        self.health = SharedHealth(self.lb, self.context)
+        self.health.publish()
+        for target, name in ((self.lb.monitor_health, "health"),
+                             (self.monitor_dns, "dns"),
+                             (self.publish_health, "health-publish"),
+                             (self.handle_commands, "command")):
+            threading.Thread(target=target, daemon=True, name=name).start()
+
+        for index in range(self.workers):
+            self.spawn_worker(index)
+
+        try:
+            while self.running:
+                self.reap_workers()
+                if self._reload_requested:
+                    self._reload_requested = False
+                    self.reload()
+                time.sleep(0.2)
+        finally:
+            self.shutdown()
+
+    def spawn_worker(self, index):
+        """
+        Start one worker process of the current generation
+        """
+        reader, writer = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=run_worker, name=f"worker-{index}", daemon=True,
+            args=(index, self.options, self.lb.configured_groups, self.lb.dns.records(), self.health,
+                  self.listener, writer, self.drain_timeout),
+        )
+        process.start()
+        writer.close()
+        pid = process.pid
+        with self._lock:
+            self.children[pid] = {"index": index, "generation": self.generation, "started": time.time(),
+                                  "process": process}
+        threading.Thread(target=self._read_snapshots, args=(pid, reader), daemon=True,
+                         name=f"stats-{pid}").start()
+        print(f"Started worker {index} (pid {pid})")
+
+    def _read_snapshots(self, pid, reader):
+        with reader:
+            while True:
+                try:
+                    snapshot = reader.recv()
+                except (EOFError, OSError):
+                    break
+                with self._lock:
+                    self.snapshots[pid] = snapshot
+
+        # Keep the counters of exited workers in the global totals
+        with self._lock:
+            snapshot = self.snapshots.pop(pid, None)
+            if snapshot is not None:
+                for srv_stat in snapshot["servers"].values():
+                    srv_stat["inflight"] = 0
+                    srv_stat.setdefault("pool", {}).update(idle=0, active=0)
+                self.retired = merge_snapshots([self.retired, snapshot])
+
+    def aggregate_snapshot(self):
+        """
+        Merge the latest statistics of all workers, including exited ones
+        """
+        with self._lock:
+            snapshots = [self.retired] + list(self.snapshots.values())
+        return merge_snapshots(snapshots)
+
+    def monitor_dns(self):
+        """
+        Refresh upstream addresses in the master and start a new generation of workers
+        when they change, since workers share health flags by server position
+        """
+        def addresses_changed(hosts):
+            print(f"Upstream addresses changed for {', '.join(sorted(hosts))}")
+            self._reload_requested = True
+
+        self.lb.monitor_dns(addresses_changed)
+
+    def publish_health(self):
+        while self.running:
+            self.health.publish()
+            time.sleep(HEALTH_SYNC_INTERVAL)
+
+    def reap_workers(self):
+        """
+        Collect exited workers and restart the ones of the current generation
+        """
+        with self._lock:
+            exited = [(pid, info) for pid, info in self.children.items() if info["process"].exitcode is not None]
+            for pid, _ in exited:
+                del self.children[pid]
+        for pid, info in exited:
+            status = info["process"].exitcode
+            info["process"].close()
+            if not self.running or info["generation"] != self.generation:
+                continue
+            print(f"Worker {info['index']} (pid {pid}) exited with status {status}, restarting")
+            # Back off a little when a worker crashes right after starting
+            if time.time() - info["started"] < 1.0:
+                time.sleep(1.0)
+            self.spawn_worker(info["index"])
+
+    def reload(self):
+        """
+        Gracefully replace all workers: start a new generation, then let the old one
+        stop accepting and finish its requests in flight
+
+        With a configuration file the master reloads it first, and the new generation
+        is forked with the new configuration; an invalid file leaves the workers running.
+        Either way the new generation gets the current DNS answers.
+        """
+        if self.lb.config_path:
+            if not self.lb.reload_config():
+                return
+        else:
+            self.lb.refresh_targets()
+        with self._lock:
+            old = [pid for pid, info in self.children.items() if info["generation"] == self.generation]
+        self.generation += 1
+        self.health = SharedHealth(self.lb, self.context)
+        self.health.publish()
+        print(f"Reloading: starting worker generation {self.generation}")
+        for index in range(self.workers):
+            self.spawn_worker(index)
+        # Give the new workers a moment to bind before the old ones stop accepting
+        time.sleep(0.5)
+        for pid in old:
+            self._signal(pid, signal.SIGTERM)
+
+    def shutdown(self):
+        """
+        Stop all workers, waiting for them to drain
+        """
+        self.running = False
+        self.lb.running = False
+        with self._lock:
+            processes = [info["process"] for info in self.children.values()]
+        for process in processes:
+            self._signal(process.pid, signal.SIGTERM)
+        deadline = time.time() + self.drain_timeout + 5
+        for process in processes:
+            process.join(max(0.0, deadline - time.time()))
+            if process.exitcode is None:
+                self._signal(process.pid, signal.SIGKILL)
+        if self.listener:
+            self.listener.close()
+        if self.lb.metrics_server:
+            self.lb.metrics_server.stop()
+        print("Load balancer stopped")
+
+    def _signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _handle_stop(self, signum, frame):
+        self.running = False
+
+    def _handle_reload(self, signum, frame):
+        self._reload_requested = True
+
+    def handle_commands(self):
+        """
+        Handle master commands; '- list' shows the merged numbers of all workers
+        """
+        while self.running:
+            try:
+                cmd = input("lb> ")
+            except (EOFError, KeyboardInterrupt):
+                # Without a terminal the master is controlled by signals
+                return
+
+            if not cmd:
+                continue
+
+            if cmd == "- quit":
+                self.running = False
+                break
+            elif cmd == "- list":
+                self.lb.list_upstream_servers(self.aggregate_snapshot())
+            elif cmd == "- reload":
+                self._reload_requested = True
+            elif cmd == "- workers":
+                with self._lock:
+                    for pid, info in sorted(self.children.items(), key=lambda item: item[1]["index"]):
+                        print(f"  worker {info['index']} pid={pid} generation={info['generation']}")
+            else:
+                print(f"Unknown command: {cmd}.")
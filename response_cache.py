@@ -0,0 +1,314 @@
+import asyncio
+import collections
+import email.utils
+import threading
+import time
+
+from http_framing import HEAD_END, response_body_framer
+
+
+# Defaults of the response cache; a size of 0 disables it
+CACHE_SIZE = 64 * 1024 * 1024
+CACHE_MAX_OBJECT = 1024 * 1024
+# Seconds a request waits for another request's fetch of the same response
+CACHE_COALESCE_TIMEOUT = 5.0
+# Statuses that may be cached when the response gives a lifetime (RFC 9110, section 15.1)
+CACHEABLE_STATUSES = frozenset((200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501))
+# Headers of a stored response that are set again when it is served
+_STRIPPED_HEADERS = (b"age", b"connection", b"keep-alive")
+
+
+class CachedResponse:
+    def __init__(self, head, body, status_code, lifetime, age):
+        """
+        A stored response: its head without hop-by-hop and Age headers and its body as
+        it was framed on the wire, so a chunked body is replayed as chunks
+
+        :param lifetime: Seconds the response is fresh for, counted from when it was sent
+        :param age: The age the upstream reported in its Age header
+        """
+        self.head = head
+        self.body = body
+        self.status_code = status_code
+        self.size = len(head) + len(body)
+        self.stored_at = time.monotonic()
+        self.age = age
+        self.expires = self.stored_at + lifetime - age
+
+    def to_bytes(self, connection):
+        """
+        Return the response to send, with a Connection header and its current Age
+
+        :param connection: The Connection header value, b"keep-alive" or b"close"
+        """
+        age = self.age + int(time.monotonic() - self.stored_at)
+        extra = b"\r\nAge: %d\r\nConnection: %s" % (age, connection)
+        return self.head[:-len(HEAD_END)] + extra + HEAD_END + self.body
+
+
+class _Fill:
+    def __init__(self):
+        """
+        A fetch in progress that other requests for the same key wait for
+        """
+        self.event = threading.Event()
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def finish(self):
+        with self._lock:
+            self.event.set()
+            futures, self._futures = self._futures, []
+        for loop, future in futures:
+            loop.call_soon_threadsafe(_resolve, future)
+
+    def wait(self, timeout):
+        self.event.wait(timeout)
+
+    async def async_wait(self, timeout):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if self.event.is_set():
+                return
+            self._futures.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class BodyCapture:
+    def __init__(self, dst, limit, skip=0):
+        """
+        Passes a response body on to the client and keeps a copy of up to limit bytes
+
+        It has the sendall of a socket and the write and drain of a StreamWriter, so it
+        can stand in for the client in relay_body and async_relay_body.
+
+        :param dst: The client socket or StreamWriter
+        :param limit: The largest body kept; data is None once the body grew past it
+        :param skip: Leading bytes that are passed on but not kept, i.e. the head given to relay_body
+        """
+        self.dst = dst
+        self.limit = limit
+        self.skip = skip
+        self.data = bytearray()
+
+    def _keep(self, data):
+        if self.skip:
+            skipped = min(self.skip, len(data))
+            data = data[skipped:]
+            self.skip -= skipped
+        if self.data is not None:
+            if len(self.data) + len(data) > self.limit:
+                self.data = None
+            else:
+                self.data += data
+
+    def sendall(self, data):
+        self.dst.sendall(data)
+        self._keep(data)
+
+    def write(self, data):
+        self.dst.write(data)
+        self._keep(data)
+
+    async def drain(self):
+        await self.dst.drain()
+
+
+class ResponseCache:
+    def __init__(self, max_bytes=CACHE_SIZE, max_object=CACHE_MAX_OBJECT):
+        """
+        A shared in-memory cache of upstream responses to GET requests, evicting the
+        least recently used responses to stay below max_bytes
+
+        A group enables it with "cache". Responses are keyed by the Host, the request
+        target and the values of the group's "cache_key_headers", and are stored when
+        their Cache-Control max-age or s-maxage, or their Expires header, gives them a
+        lifetime, or else for "cache_ttl" seconds if the group sets it. Responses that
+        are private, no-store, no-cache, set cookies or vary on headers outside the
+        key are not stored, and an expired response is fetched again rather than
+        revalidated. Concurrent misses of one key are coalesced: the first request
+        fetches the response while the others wait for it.
+
+        :param max_bytes: Bytes of heads and bodies the cache may hold
+        :param max_object: The largest response that is stored
+        """
+        self.max_bytes = max_bytes
+        self.max_object = min(max_object, max_bytes)
+        self.size = 0
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "stores": 0, "evictions": 0}
+        self._entries = collections.OrderedDict()
+        self._fills = {}
+        self._lock = threading.Lock()
+
+    def key(self, request, group):
+        """
+        Return the cache key of a request, or None if the request bypasses the cache
+        """
+        if not self.max_bytes or not group.get("cache") or request.method != "GET":
+            return None
+        if request.get("authorization") is not None or request.get("transfer-encoding") is not None:
+            return None
+        if request.get("content-length", "0") != "0":
+            return None
+        tokens = request.tokens("cache-control")
+        if b"no-store" in tokens or b"no-cache" in tokens or request.has_token("pragma", "no-cache"):
+            return None
+        headers = tuple(request.get(name) for name in group.get("cache_key_headers", ()))
+        return request.host, request.target, headers
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() >= entry.expires:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry
+
+    def _claim(self, key):
+        """
+        Return the _Fill of a key and whether the caller is the one to fetch it
+        """
+        with self._lock:
+            fill = self._fills.get(key)
+            if fill is None:
+                fill = self._fills[key] = _Fill()
+                self.counters["misses"] += 1
+                return fill, True
+            self.counters["coalesced"] += 1
+            return fill, False
+
+    def lookup(self, key, timeout=CACHE_COALESCE_TIMEOUT):
+        """
+        Find a fresh response, waiting for a fetch of the same key already in progress
+
+        :return: (entry, fill): the cached response, or None and the fill to pass to
+            release after the fetch, which is None if a coalesced wait found nothing
+        """
+        entry = self._get(key)
+        if entry is not None:
+            return entry, None
+        fill, leader = self._claim(key)
+        if leader:
+            return None, fill
+        fill.wait(timeout)
+        return self._after_wait(key), None
+
+    async def async_lookup(self, key, timeout=CACHE_COALESCE_TIMEOUT):
+        """
+        The asyncio counterpart of lookup, waiting without blocking the event loop
+        """
+        entry = self._get(key)
+        if entry is not None:
+            return entry, None
+        fill, leader = self._claim(key)
+        if leader:
+            return None, fill
+        await fill.async_wait(timeout)
+        return self._after_wait(key), None
+
+    def _after_wait(self, key):
+        entry = self._get(key)
+        if entry is None:
+            # The response was not cacheable; fetch it without waiting again
+            with self._lock:
+                self.counters["misses"] += 1
+        return entry
+
+    def release(self, key, fill):
+        with self._lock:
+            if self._fills.get(key) is fill:
+                del self._fills[key]
+        fill.finish()
+
+    def store(self, key, response, body, group, request_method="GET"):
+        """
+        Store a response if it may be cached
+
+        :param response: The parsed response head
+        :param body: The body bytes as framed on the wire, or None if it was too large
+        :return: Whether the response was stored
+        """
+        if body is None or response.status_code not in CACHEABLE_STATUSES:
+            return False
+        if response_body_framer(response, request_method).until_close:
+            return False
+        lifetime = freshness_lifetime(response, group)
+        if not lifetime or lifetime <= 0 or response.get("set-cookie") is not None:
+            return False
+        key_headers = {name.lower() for name in group.get("cache_key_headers", ())}
+        for name in response.tokens("vary"):
+            if name and name.decode("latin-1") not in key_headers:
+                return False
+        try:
+            age = max(0, int(response.get("age", "0")))
+        except ValueError:
+            age = 0
+        if age >= lifetime:
+            return False
+
+        lines = response.raw[:-len(HEAD_END)].split(b"\r\n")
+        head = b"\r\n".join(
+            [lines[0]] + [line for line in lines[1:] if line.split(b":", 1)[0].strip().lower() not in _STRIPPED_HEADERS]
+        ) + HEAD_END
+        entry = CachedResponse(head, bytes(body), response.status_code, lifetime, age)
+        if entry.size > self.max_object:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self.size += entry.size
+            self.counters["stores"] += 1
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.counters["evictions"] += 1
+        return True
+
+    def _remove(self, key):
+        self.size -= self._entries.pop(key).size
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats.update(entries=len(self._entries), bytes=self.size, max_bytes=self.max_bytes)
+        return stats
+
+
+def freshness_lifetime(response, group):
+    """
+    Return the seconds a response stays fresh in a shared cache, or None if it must not be stored
+    """
+    tokens = response.tokens("cache-control")
+    if b"no-store" in tokens or b"no-cache" in tokens or b"private" in tokens:
+        return None
+    for directive in (b"s-maxage=", b"max-age="):
+        for token in tokens:
+            if token.startswith(directive):
+                try:
+                    return int(token[len(directive):].strip(b'"'))
+                except ValueError:
+                    return None
+    expires = response.get("expires")
+    if expires is not None:
+        try:
+            expires_at = email.utils.parsedate_to_datetime(expires).timestamp()
+            date = response.get("date")
+            sent_at = email.utils.parsedate_to_datetime(date).timestamp() if date else time.time()
+        except (TypeError, ValueError):
+            # An invalid Expires means already expired
+            return None
+        return expires_at - sent_at
+    return group.get("cache_ttl")
@@ -0,0 +1,56 @@
+import collections
+import math
+import threading
+import time
+
+
+# Defaults for groups that do not set their own retry options
+RETRIES = 1
+RETRY_BUDGET_PERCENT = 20
+RETRY_BUDGET_MIN = 3
+RETRY_BUDGET_WINDOW = 10.0
+
+
+class RetryBudget:
+    def __init__(self, window=RETRY_BUDGET_WINDOW):
+        """
+        Limits the retries of an upstream group to a share of its traffic
+
+        Requests and retries are counted in one-second buckets over a sliding window.
+        A retry is allowed while the retries in the window stay below the given
+        percentage of the requests in it, or below a small minimum, so that a quiet
+        group can still retry while a failing busy one cannot multiply its load.
+
+        :param window: Seconds of traffic the budget is computed over
+        """
+        self.window = window
+        # [second, requests, retries] per second of the window
+        self._buckets = collections.deque()
+        self._lock = threading.Lock()
+
+    def _bucket(self, now):
+        second = math.floor(now)
+        if not self._buckets or self._buckets[-1][0] != second:
+            self._buckets.append([second, 0, 0])
+            while self._buckets[0][0] <= now - self.window:
+                self._buckets.popleft()
+        return self._buckets[-1]
+
+    def record_request(self):
+        with self._lock:
+            self._bucket(time.monotonic())[1] += 1
+
+    def try_retry(self, percent=RETRY_BUDGET_PERCENT, minimum=RETRY_BUDGET_MIN):
+        """
+        Take one retry from the budget
+
+        :return: Whether the retry is allowed
+        """
+        with self._lock:
+            bucket = self._bucket(time.monotonic())
+            requests = sum(b[1] for b in self._buckets)
+            retries = sum(b[2] for b in self._buckets)
+            if retries >= max(minimum, requests * percent / 100.0):
+                return False
+            bucket[2] += 1
+            return True
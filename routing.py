@@ -0,0 +1,168 @@
+WILDCARD_PREFIX = "*."
+
+
+def split_route(pattern):
+    """
+    Split a route pattern such as "*.cn.edu/api" into its host and path prefix parts
+
+    :return: The lowercased host pattern and the path prefix, "/" if the pattern has none
+    """
+    host, sep, path = pattern.partition("/")
+    return host.strip().lower(), "/" + path
+
+
+def path_segments(target):
+    """
+    Return the segments of a request target's path, ignoring the query and empty segments
+
+    Absolute-form targets such as "http://host/path" are reduced to their path.
+    """
+    if "://" in target:
+        target = "/" + target.split("://", 1)[1].partition("/")[2]
+    path = target.partition("?")[0]
+    return [segment for segment in path.split("/") if segment]
+
+
+class PathTrie:
+    def __init__(self):
+        """
+        Longest-prefix match of request paths by whole segments
+
+        "/api" matches "/api" and "/api/users" but not "/apix". The root prefix "/"
+        matches every path.
+        """
+        self._root = ({}, [None])
+
+    def insert(self, prefix, value):
+        children, slot = self._root
+        for segment in path_segments(prefix):
+            children, slot = children.setdefault(segment, ({}, [None]))
+        slot[0] = value
+
+    def longest_match(self, segments):
+        """
+        Return the value of the longest prefix of the path segments, or None
+        """
+        children, slot = self._root
+        best = slot[0]
+        for segment in segments:
+            node = children.get(segment)
+            if node is None:
+                break
+            children, slot = node
+            if slot[0] is not None:
+                best = slot[0]
+        return best
+
+
+class RoutingTable:
+    def __init__(self, upstream_groups):
+        """
+        Compiled routes from Host and path to upstream group
+
+        Every upstream group is reachable through its key and the patterns in its
+        optional "routes" list. A pattern is a host with an optional path prefix:
+        "api.cn.edu", "api.cn.edu/v2" or "*.cn.edu/static". Exact hosts are looked up
+        in a dict; wildcard hosts live in a trie of reversed labels, so "*.cn.edu" is
+        found by walking "edu", "cn"; each host has a path trie. A lookup costs
+        O(length of host + length of path) however many routes there are.
+
+        The most specific host wins: an exact host before the longest wildcard suffix.
+        A less specific host is only tried when the more specific one has no route for
+        the path.
+
+        :param upstream_groups: The upstream groups keyed by their name
+        """
+        self.exact = {}
+        self._wildcards = ({}, [None])
+        self.routes = []
+        for name, group in upstream_groups.items():
+            for pattern in [name] + list(group.get("routes", [])):
+                self.add(pattern, name)
+
+    def add(self, pattern, group_name):
+        """
+        Add a route pattern for an upstream group
+
+        :raises ValueError: If the pattern has a misplaced wildcard or an empty host
+        """
+        host, prefix = split_route(pattern)
+        if host.startswith(WILDCARD_PREFIX):
+            labels = host[len(WILDCARD_PREFIX):].split(".")
+            if "*" in host[len(WILDCARD_PREFIX):] or not all(labels):
+                raise ValueError(f"Invalid wildcard route: {pattern}")
+            children, slot = self._wildcards
+            for label in reversed(labels):
+                children, slot = children.setdefault(label, ({}, [None]))
+            if slot[0] is None:
+                slot[0] = PathTrie()
+            paths = slot[0]
+        else:
+            if not host or "*" in host:
+                raise ValueError(f"Invalid route: {pattern}")
+            paths = self.exact.setdefault(host, PathTrie())
+        paths.insert(prefix, group_name)
+        self.routes.append((pattern, group_name))
+
+    def _host_candidates(self, host):
+        """
+        Return the path tries that apply to a host, most specific first
+        """
+        candidates = []
+        exact = self.exact.get(host)
+        if exact is not None:
+            candidates.append(exact)
+        # A wildcard only covers subdomains, so the host's first label is never walked
+        labels = host.split(".")
+        children, slot = self._wildcards
+        wildcards = []
+        for label in reversed(labels[1:]):
+            node = children.get(label)
+            if node is None:
+                break
+            children, slot = node
+            if slot[0] is not None:
+                wildcards.append(slot[0])
+        candidates.extend(reversed(wildcards))
+        return candidates
+
+    def lookup(self, host, target="/"):
+        """
+        Find the upstream group for a request
+
+        :param host: The request's Host without port, lowercased
+        :param target: The request target
+        :return: The name of the upstream group, or None if no route matches
+        """
+        candidates = self._host_candidates(host)
+        if not candidates:
+            return None
+        segments = path_segments(target)
+        for paths in candidates:
+            group_name = paths.longest_match(segments)
+            if group_name is not None:
+                return group_name
+        return None
+
+
+class RoutingState:
+    def __init__(self, upstream_groups, table, schedulers):
+        """
+        Everything a request needs to choose an upstream server, built together and
+        installed with one assignment so that a reload swaps it atomically
+
+        :param upstream_groups: The upstream groups keyed by name
+        :param table: The RoutingTable compiled from the groups
+        :param schedulers: The Scheduler of every group, keyed by group name
+        """
+        self.upstream_groups = upstream_groups
+        self.table = table
+        self.schedulers = schedulers
+        # The schedulers to invalidate when a server's health changes, and the groups
+        # a server belongs to
+        self.server_schedulers = {}
+        self.server_groups = {}
+        for name, group in upstream_groups.items():
+            for server in group["servers"]:
+                self.server_schedulers.setdefault(id(server), []).append(schedulers[name])
+                self.server_groups.setdefault(id(server), []).append(group)
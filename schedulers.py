@@ -0,0 +1,499 @@
+import bisect
+import hashlib
+import heapq
+import itertools
+import random
+import threading
+import time
+import weakref
+
+from circuit_breaker import is_ejected
+from upstream_pool import server_id
+
+
+# Weight of a new sample in the response time moving average
+EWMA_ALPHA = 0.3
+# Seconds without a proxied response after which health check latency feeds the average
+PROBE_SAMPLE_AGE = 30.0
+# Seconds over which a new or recovered server ramps up to its full share
+SLOW_START = 10.0
+# Groups larger than this use power-of-two-choices unless configured otherwise
+P2C_THRESHOLD = 8
+# Points on the hash ring per unit of weight, and the request value hashed by default
+HASH_VNODES = 160
+HASH_KEY = "client_ip"
+
+
+class ServerState:
+    def __init__(self, alpha=EWMA_ALPHA):
+        """
+        Live load and latency of one upstream server, shared by every group that uses it
+
+        :param alpha: Weight of a new sample in the exponentially weighted moving average
+        """
+        self.alpha = alpha
+        self.ewma = None
+        # When the last proxied response time was observed
+        self.observed_at = None
+        self.inflight = 0
+        self.healthy_since = time.monotonic()
+        # The smooth weighted round robin's current weight, kept across scheduler rebuilds
+        self.current_weight = 0
+        self._lock = threading.Lock()
+        # Schedulers told about every change of inflight; a replaced one drops out by itself
+        self._watchers = weakref.WeakSet()
+
+    def watch(self, scheduler):
+        """
+        Have scheduler.load_changed(state) called whenever inflight changes
+        """
+        with self._lock:
+            self._watchers.add(scheduler)
+
+    def begin_request(self):
+        with self._lock:
+            self.inflight += 1
+            watchers = list(self._watchers) if self._watchers else ()
+        for scheduler in watchers:
+            scheduler.load_changed(self)
+
+    def end_request(self):
+        with self._lock:
+            self.inflight -= 1
+            watchers = list(self._watchers) if self._watchers else ()
+        for scheduler in watchers:
+            scheduler.load_changed(self)
+
+    def observe(self, response_time):
+        """
+        Fold a response time measurement into the moving average
+        """
+        with self._lock:
+            self.observed_at = time.monotonic()
+            self._fold(response_time)
+        return self.ewma
+
+    def observe_probe(self, probe_time, max_age=PROBE_SAMPLE_AGE):
+        """
+        Fold a health check's latency into the moving average while the server has had
+        no proxied response for max_age seconds, e.g. a new or idle server
+
+        A probe is a tiny request, so it would pull the average of a busy server below
+        what its real requests take; an idle server's average would never change otherwise.
+        """
+        with self._lock:
+            if self.observed_at is None or time.monotonic() - self.observed_at >= max_age:
+                self._fold(probe_time)
+        return self.ewma
+
+    def _fold(self, sample):
+        if self.ewma is None:
+            self.ewma = sample
+        else:
+            self.ewma += self.alpha * (sample - self.ewma)
+
+    def mark_healthy(self):
+        """
+        Restart the slow start period after the server recovered
+        """
+        self.healthy_since = time.monotonic()
+
+
+def server_state(server):
+    """
+    Return the ServerState of an upstream server entry, creating it on first use
+    """
+    state = server.get("state")
+    if state is None:
+        state = server.setdefault("state", ServerState())
+    return state
+
+
+class Scheduler:
+    def __init__(self, servers):
+        """
+        Base class of the per-group server selection strategies
+
+        Subclasses keep whatever state they precompute from the healthy servers and
+        rebuild it lazily after invalidate() is called on a health or weight change.
+        Servers ejected by their circuit breaker do not count as healthy.
+
+        :param servers: The "servers" list of an upstream group
+        """
+        self.servers = servers
+        self._lock = threading.Lock()
+        self._dirty = True
+
+    @classmethod
+    def from_group(cls, group):
+        """
+        Create the scheduler of an upstream group, reading its algorithm options
+        """
+        return cls(group["servers"])
+
+    def invalidate(self):
+        """
+        Mark the precomputed state stale, it is rebuilt on the next selection
+        """
+        self._dirty = True
+
+    def healthy_servers(self):
+        return [s for s in self.servers if s.get("healthy", True) and not is_ejected(s)]
+
+    def _ensure_built(self):
+        if self._dirty:
+            with self._lock:
+                if self._dirty:
+                    self._dirty = False
+                    self._rebuild()
+
+    def _rebuild(self):
+        pass
+
+    def request_key(self, request, client_address):
+        """
+        Return the value a request is placed by, for schedulers that place requests
+        consistently, or None
+
+        :param request: The parsed request head
+        :param client_address: The (host, port) of the client connection
+        """
+        return None
+
+    def select(self, exclude=None, key=None):
+        """
+        Select an upstream server
+
+        :param exclude: Servers that must not be returned, e.g. ones that already failed
+        :param key: The value returned by request_key
+        :return: The selected server entry, or None if no healthy server is available
+        """
+        raise NotImplementedError
+
+
+def _is_excluded(server, exclude):
+    return exclude is not None and any(server is e for e in exclude)
+
+
+class SmoothWeightedRoundRobin(Scheduler):
+    """
+    Smooth weighted round robin as in nginx: on every pick each server's current
+    weight grows by its weight and the largest one is picked and reduced by the total,
+    which interleaves the servers instead of sending bursts to the heaviest one.
+
+    The current weights are kept in the servers' ServerState, so a rebuild after a
+    health or weight change, and a new scheduler after a reload or DNS change that
+    keeps the server entries, continue the sequence where it stopped instead of
+    starting over at the heaviest server. A pick costs O(n) in the healthy servers
+    and no memory beyond them, but it scans them all with the scheduler's lock held,
+    so concurrent picks for one group run one after another. That suits groups of
+    tens of servers; a precomputed cycle would make a pick O(1), at the price of
+    memory growing with the sum of the weights and of restarting the cycle on every
+    rebuild.
+    """
+
+    def __init__(self, servers):
+        super().__init__(servers)
+        self._healthy = []
+
+    def _rebuild(self):
+        self._healthy = [(s, server_state(s)) for s in self.healthy_servers() if s.get("weight", 1) > 0]
+
+    def select(self, exclude=None, key=None):
+        self._ensure_built()
+        best = None
+        total = 0
+        with self._lock:
+            # Excluded servers sit this pick out, as nginx skips servers a request already tried
+            for server, state in self._healthy:
+                if _is_excluded(server, exclude):
+                    continue
+                weight = server.get("weight", 1)
+                state.current_weight += weight
+                total += weight
+                if best is None or state.current_weight > best[1].current_weight:
+                    best = (server, state)
+            if best is None:
+                return None
+            best[1].current_weight -= total
+        return best[0]
+
+
+class LeastTimeScheduler(Scheduler):
+    """
+    Latency-aware selection by expected completion time
+
+    A server's cost is the EWMA of its response time multiplied by one plus its
+    requests in flight, so a server that is already busy looks slower. Servers
+    without a measurement are assumed to be as fast as the group average, and a
+    server in its slow start period has its cost inflated until it has been healthy
+    for "slow_start" seconds. Large groups use power-of-two-random-choices: two random
+    servers are compared instead of scanning them all, which is cheap and keeps
+    concurrent requests from herding onto the same server.
+    """
+
+    def __init__(self, servers, slow_start=SLOW_START, power_of_two=None):
+        """
+        :param slow_start: Seconds for a new or recovered server to ramp up
+        :param power_of_two: Force power-of-two-choices on or off, by default it is
+            used for groups with more than P2C_THRESHOLD servers
+        """
+        super().__init__(servers)
+        self.slow_start = slow_start
+        if power_of_two is None:
+            power_of_two = len(servers) > P2C_THRESHOLD
+        self.power_of_two = power_of_two
+        self._healthy = []
+        for server in servers:
+            server_state(server)
+
+    @classmethod
+    def from_group(cls, group):
+        return cls(group["servers"], group.get("slow_start", SLOW_START), group.get("power_of_two"))
+
+    def _rebuild(self):
+        self._healthy = self.healthy_servers()
+
+    def cost(self, server, default_latency, now):
+        state = server_state(server)
+        latency = state.ewma if state.ewma is not None else default_latency
+        cost = latency * (state.inflight + 1)
+        if self.slow_start > 0:
+            warmed = (now - state.healthy_since) / self.slow_start
+            if warmed < 1:
+                cost /= max(warmed, 0.1)
+        return cost
+
+    def select(self, exclude=None, key=None):
+        self._ensure_built()
+        good_servers = self._healthy
+        if exclude:
+            good_servers = [s for s in good_servers if not _is_excluded(s, exclude)]
+        if not good_servers:
+            return None
+        if len(good_servers) == 1:
+            return good_servers[0]
+
+        if self.power_of_two:
+            candidates = random.sample(good_servers, 2)
+        else:
+            candidates = good_servers
+        measured = [server_state(s).ewma for s in candidates if server_state(s).ewma is not None]
+        default_latency = sum(measured) / len(measured) if measured else 1.0
+        now = time.monotonic()
+        return min(candidates, key=lambda s: self.cost(s, default_latency, now))
+
+
+class LeastConnScheduler(Scheduler):
+    """
+    Least connections: the server with the fewest requests in flight per unit of
+    weight, as in nginx, with ties taken in turn
+
+    The healthy servers are kept in an indexed binary min-heap ordered by their load.
+    Each ServerState reports every change of its in-flight count, which moves that
+    one server up or down the heap in O(log n), so selection reads the top instead
+    of scanning the group. Excluded servers are skipped by walking the heap in order.
+    """
+
+    def __init__(self, servers):
+        super().__init__(servers)
+        # Entries are [load, turn, server, state, start]; turn breaks ties in favor of
+        # the server picked longest ago and start is kept for LeastRequestScheduler
+        self._heap = []
+        self._position = {}
+        self._turns = itertools.count()
+        self._clock = 0.0
+        for server in servers:
+            server_state(server).watch(self)
+
+    def load(self, entry):
+        return entry[3].inflight / entry[2].get("weight", 1)
+
+    def picked(self, entry):
+        # The next tie goes to another server
+        entry[1] = next(self._turns)
+
+    def _rebuild(self):
+        heap = []
+        for server in self.healthy_servers():
+            if server.get("weight", 1) > 0:
+                entry = [0, next(self._turns), server, server_state(server), self._clock]
+                entry[0] = self.load(entry)
+                heap.append(entry)
+        heap.sort(key=lambda entry: entry[:2])
+        self._heap = heap
+        self._position = {id(entry[3]): i for i, entry in enumerate(heap)}
+
+    def load_changed(self, state):
+        with self._lock:
+            i = self._position.get(id(state))
+            if i is not None:
+                entry = self._heap[i]
+                entry[0] = self.load(entry)
+                self._sift(i)
+
+    def _sift(self, i):
+        heap = self._heap
+        while i > 0 and heap[i][:2] < heap[(i - 1) // 2][:2]:
+            i = self._swap(i, (i - 1) // 2)
+        while True:
+            smallest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(heap) and heap[child][:2] < heap[smallest][:2]:
+                    smallest = child
+            if smallest == i:
+                return
+            i = self._swap(i, smallest)
+
+    def _swap(self, i, j):
+        heap = self._heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self._position[id(heap[i][3])] = i
+        self._position[id(heap[j][3])] = j
+        return j
+
+    def select(self, exclude=None, key=None):
+        self._ensure_built()
+        with self._lock:
+            heap = self._heap
+            if not heap:
+                return None
+            index = 0
+            if exclude:
+                # Visit the heap in order through a frontier of candidate indexes
+                frontier = [(heap[0][:2], 0)]
+                index = None
+                while frontier:
+                    _, i = heapq.heappop(frontier)
+                    if not _is_excluded(heap[i][2], exclude):
+                        index = i
+                        break
+                    for child in (2 * i + 1, 2 * i + 2):
+                        if child < len(heap):
+                            heapq.heappush(frontier, (heap[child][:2], child))
+                if index is None:
+                    return None
+            entry = heap[index]
+            self.picked(entry)
+            self._sift(index)
+            return entry[2]
+
+
+class LeastRequestScheduler(LeastConnScheduler):
+    """
+    Weighted least request as in Envoy: earliest deadline first scheduling on the
+    effective weight weight / (in flight + 1)
+
+    Each server's deadline is the virtual time of its last pick plus (in flight + 1) /
+    weight, and the earliest one is picked. An idle group is therefore shared in
+    proportion to the weights, while a server holding many requests has its next
+    turn pushed back until they finish.
+    """
+
+    def load(self, entry):
+        return entry[4] + (entry[3].inflight + 1) / entry[2].get("weight", 1)
+
+    def picked(self, entry):
+        super().picked(entry)
+        self._clock = entry[4] = entry[0]
+        entry[0] = self.load(entry)
+
+
+def parse_hash_key(hash_key):
+    """
+    Split a "hash_key" option into its kind and header or cookie name
+
+    :raises ValueError: If the option is not "client_ip", "path", "header:<name>" or "cookie:<name>"
+    """
+    kind, _, name = str(hash_key).partition(":")
+    name = name.strip()
+    if kind not in ("client_ip", "path", "header", "cookie") or (kind in ("header", "cookie")) != bool(name):
+        raise ValueError(f"Unknown hash_key {hash_key!r}")
+    return kind, name.lower() if kind == "header" else name
+
+
+def _ring_hash(value):
+    return int.from_bytes(hashlib.md5(value.encode("utf-8", "surrogateescape")).digest()[:4], "little")
+
+
+class ConsistentHashScheduler(Scheduler):
+    """
+    Consistent hashing on a ketama ring, so that requests with the same key keep
+    reaching the same server and backend caches stay warm
+
+    Every server gets "hash_vnodes" points per unit of weight on a 32-bit ring, four
+    from each MD5 digest of "<server id>-<n>" as in libketama, so the ring depends
+    only on the configured servers and not on their order. A request goes to the
+    owner of the first point at or after the hash of its key, found by bisection.
+
+    The points are hashed and sorted once. When a server's health changes, the ring
+    of healthy servers is rebuilt by filtering that sorted list, without hashing or
+    sorting again, and only the keys of the server that left or came back move: about
+    1/N of them. The key is taken from the request by "hash_key": "client_ip" (the
+    default), "path", "header:<name>" or "cookie:<name>"; a request without that
+    header or cookie is placed by its client IP.
+    """
+
+    def __init__(self, servers, vnodes=HASH_VNODES, hash_key=HASH_KEY):
+        """
+        :param vnodes: Points on the ring per unit of server weight
+        :param hash_key: Which request value is hashed
+        """
+        super().__init__(servers)
+        self.key_kind, self.key_name = parse_hash_key(hash_key)
+        points = []
+        for index, server in enumerate(servers):
+            sid = server_id(server)
+            for n in range((vnodes * server.get("weight", 1) + 3) // 4):
+                digest = hashlib.md5(f"{sid}-{n}".encode("utf-8", "surrogateescape")).digest()
+                points.extend((int.from_bytes(digest[i:i + 4], "little"), index) for i in range(0, 16, 4))
+        points.sort()
+        self._points = points
+        self._ring = ([], [])
+
+    @classmethod
+    def from_group(cls, group):
+        return cls(group["servers"], group.get("hash_vnodes", HASH_VNODES), group.get("hash_key", HASH_KEY))
+
+    def _rebuild(self):
+        healthy = {id(s) for s in self.healthy_servers()}
+        hashes = []
+        owners = []
+        for point, index in self._points:
+            server = self.servers[index]
+            if id(server) in healthy:
+                hashes.append(point)
+                owners.append(server)
+        self._ring = (hashes, owners)
+
+    def request_key(self, request, client_address):
+        if self.key_kind == "path":
+            return request.target.split("?", 1)[0]
+        if self.key_kind == "header":
+            value = request.get(self.key_name)
+            if value:
+                return value
+        elif self.key_kind == "cookie":
+            for cookie in (request.get("cookie") or "").split(";"):
+                name, _, value = cookie.strip().partition("=")
+                if name == self.key_name and value:
+                    return value
+        return client_address[0] if client_address else None
+
+    def select(self, exclude=None, key=None):
+        self._ensure_built()
+        hashes, owners = self._ring
+        if not hashes:
+            return None
+        if key is None:
+            position = random.randrange(len(hashes))
+        else:
+            position = bisect.bisect_left(hashes, _ring_hash(key)) % len(hashes)
+        if not exclude:
+            return owners[position]
+        # Walk on around the ring to the next server that was not excluded
+        for offset in range(len(hashes)):
+            server = owners[(position + offset) % len(hashes)]
+            if not _is_excluded(server, exclude):
+                return server
+        return None
@@ -1,74 +1,356 @@
+import argparse
+import json
+import multiprocessing
+import socket
 import sys
 import time
 import threading
 import signal
+from urllib.parse import parse_qs, urlsplit
+
+from http_server import ENGINES, THREADS_ENGINE, SimpleHTTPServer, parse_latency
+
+
+# The fleet started when neither a file nor a count is given
+DEFAULT_FLEET = [
+    {"port": 8080, "error_rate": 0.0, "timeout_rate": 0.0},   # 0% error rate, 0% timeout rate
+    {"port": 8081, "error_rate": 0.0, "timeout_rate": 0.0},   # 0% error rate, 0% timeout rate
+    {"port": 8082, "error_rate": 0.1, "timeout_rate": 0.2},   # 10% error rate, 20% timeout rate
+    {"port": 8083, "error_rate": 0.05, "timeout_rate": 0.1},  # 5% error rate, 10% timeout rate
+    {"port": 8084, "error_rate": 0.0, "timeout_rate": 0.3},   # 0% error rate, 30% timeout rate
+    {"port": 8085, "error_rate": 0.0, "timeout_rate": 0.0},   # 0% error rate, 0% timeout rate
+]
+BACKEND_DEFAULTS = {
+    "host": "0.0.0.0",
+    "error_rate": 0.0,
+    "timeout_rate": 0.0,
+    "timeout_duration": 5,
+    "engine": THREADS_ENGINE,
+    "latency": "none",
+    "payload_size": 0,
+    "quiet": False,
+}
+CONTROL_PORT = 8079
+READY_TIMEOUT = 10.0
+# Settings the control channel may change on a running backend, and their types
+CONTROL_SETTINGS = {"error_rate": float, "timeout_rate": float, "timeout_duration": float, "latency": str}
+
+
+def parse_fleet(data):
+    """
+    Validate a fleet description and return its backends with the defaults filled in
+
+    :param data: {"defaults": {...}, "servers": [{"port": 8080, ...}, ...]}; every server
+        option may be set in "defaults", and "port" is required
+    :raises ValueError: If a backend is invalid or two share a port
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("servers"), list) or not data["servers"]:
+        raise ValueError('The fleet needs a non-empty "servers" list')
+    defaults = dict(BACKEND_DEFAULTS, **data.get("defaults", {}))
+    backends = []
+    ports = set()
+    for entry in data["servers"]:
+        backend = dict(defaults, **entry)
+        unknown = set(backend) - set(BACKEND_DEFAULTS) - {"port"}
+        if unknown:
+            raise ValueError(f"Unknown backend options: {', '.join(sorted(unknown))}")
+        port = backend.get("port")
+        if not isinstance(port, int) or not 0 < port < 65536:
+            raise ValueError(f"Invalid backend port {port!r}")
+        if port in ports:
+            raise ValueError(f"Port {port} is used by two backends")
+        ports.add(port)
+        for name in ("error_rate", "timeout_rate"):
+            if not 0.0 <= backend[name] <= 1.0:
+                raise ValueError(f"Backend {port} has an invalid {name}")
+        if backend["engine"] not in ENGINES:
+            raise ValueError(f"Backend {port} has an unknown engine '{backend['engine']}'")
+        parse_latency(backend["latency"])
+        backends.append(backend)
+    return backends
+
+
+def run_backend(backend, control):
+    """
+    Run one backend server in the calling process
+
+    A thread applies the settings sent through the control pipe to the running server
+    and answers with its current settings.
+
+    :param backend: A backend entry returned by parse_fleet
+    :param control: The child end of the backend's multiprocessing Pipe
+    """
+    server = SimpleHTTPServer(
+        host=backend["host"], port=backend["port"], error_rate=backend["error_rate"],
+        timeout_rate=backend["timeout_rate"], timeout_duration=backend["timeout_duration"],
+        engine=backend["engine"], latency=backend["latency"], payload_size=backend["payload_size"],
+        quiet=backend["quiet"],
+    )
+
+    def apply_settings():
+        while True:
+            try:
+                settings = control.recv()
+            except (EOFError, OSError):
+                return
+            for name, value in settings.items():
+                getattr(server, "set_" + name)(value)
+            control.send({name: getattr(server, name) for name in CONTROL_SETTINGS})
+
+    threading.Thread(target=apply_settings, daemon=True, name="control").start()
+    # The manager stops its backends; they do not inherit its signal handlers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    server.start_server()
 
 
 class ServerManager:
-    def __init__(self):
-        self.processes = []
+    def __init__(self, backends=None, control_port=CONTROL_PORT):
+        """
+        Starts a fleet of backend servers, one process each, and changes their fault
+        settings at runtime
+
+        :param backends: The backends returned by parse_fleet, defaults to DEFAULT_FLEET
+        :param control_port: Port of the control channel, 0 to run without it
+        """
+        self.backends = backends or parse_fleet({"servers": DEFAULT_FLEET})
+        self.control_port = control_port
+        self.processes = {}
+        self.controls = {}
+        self.control_socket = None
         self.running = True
-        
-    def start_server(self, port, error_rate, timeout_rate, timeout_duration, server_id):
-        try:
-            print(f"Starting HTTP Server {server_id} on port {port} (error rate: {error_rate*100}%, timeout rate: {timeout_rate*100}%)")
-            
-            from http_server import SimpleHTTPServer
-            server = SimpleHTTPServer(host='0.0.0.0', port=port, error_rate=error_rate, timeout_rate=timeout_rate, timeout_duration=timeout_duration)
-            server.start_server()
-            
-        except Exception as e:
-            print(f"Error starting server {server_id}: {e}")
-    
-    def start_all_servers(self):
-        servers = [
-            (8080, 0.0, 0.0, 5, 0),   # 0% error rate, 0% timeout rate
-            (8081, 0.0, 0.0, 5, 1),   # 0% error rate, 0% timeout rate
-            (8082, 0.1, 0.2, 5, 2),   # 10% error rate, 20% timeout rate
-            (8083, 0.05, 0.1, 5, 3),  # 5% error rate, 10% timeout rate
-            (8084, 0.0, 0.3, 5, 4),   # 0% error rate, 30% timeout rate
-            (8085, 0.0, 0.0, 5, 5),   # 0% error rate, 0% timeout rate
-        ]
-        
-        for port, error_rate, timeout_rate, timeout_duration, server_id in servers:
-            server_thread = threading.Thread(
-                target=self.start_server,
-                args=(port, error_rate, timeout_rate, timeout_duration, server_id),
-                daemon=True
-            )
-            server_thread.start()
-            time.sleep(1)
-        
-        print("All HTTP servers started!")
+        self._lock = threading.Lock()
+
+    def start_server(self, backend):
+        port = backend["port"]
+        print(f"Starting HTTP Server on port {port} (error rate: {backend['error_rate']*100}%, "
+              f"timeout rate: {backend['timeout_rate']*100}%, latency: {backend['latency']}, "
+              f"engine: {backend['engine']})")
+        parent_end, child_end = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=run_backend, args=(backend, child_end), daemon=True,
+                                          name=f"backend-{port}")
+        process.start()
+        child_end.close()
+        self.processes[port] = process
+        self.controls[port] = parent_end
+
+    def start_all_servers(self, ready_timeout=READY_TIMEOUT):
+        """
+        Start every backend at once and wait until each one answers /healthz
+
+        :return: Whether all backends became ready within ready_timeout seconds
+        """
+        started = time.monotonic()
+        for backend in self.backends:
+            self.start_server(backend)
+        pending = self.wait_ready(ready_timeout)
+        if pending:
+            print(f"Backends not ready: {', '.join(map(str, sorted(pending)))}")
+            return False
+
+        print(f"All {len(self.backends)} HTTP servers ready in {time.monotonic() - started:.2f}s")
+        if self.control_port:
+            self.start_control_server()
         print("You can now start the load balancer")
         print("=" * 50)
-    
+        return True
+
+    def wait_ready(self, timeout):
+        """
+        Poll the /healthz endpoints of the backends until all have answered
+
+        Any HTTP response counts, since a backend with an error rate may answer 502; a
+        check that stalls because of the timeout rate is given up and tried again.
+
+        :return: The ports of the backends that are not ready
+        """
+        deadline = time.monotonic() + timeout
+        pending = {backend["port"] for backend in self.backends}
+        while pending and time.monotonic() < deadline:
+            for port in list(pending):
+                if not self.processes[port].is_alive():
+                    print(f"Backend {port} exited")
+                    return pending
+                if probe_health(port):
+                    pending.discard(port)
+            if pending:
+                time.sleep(0.05)
+        return pending
+
+    def set_settings(self, port, settings):
+        """
+        Change the fault settings of a running backend
+
+        :param settings: Values of CONTROL_SETTINGS by name
+        :return: The backend's settings after the change
+        :raises KeyError: If no backend runs on the port
+        """
+        with self._lock:
+            control = self.controls[port]
+            control.send(settings)
+            return control.recv()
+
+    def start_control_server(self):
+        self.control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.control_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.control_socket.bind(("localhost", self.control_port))
+        self.control_socket.listen(16)
+        print(f"Control channel on http://localhost:{self.control_port}/servers")
+        threading.Thread(target=self.serve_control, daemon=True, name="control").start()
+
+    def serve_control(self):
+        while self.running:
+            try:
+                client_socket, client_address = self.control_socket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.handle_control, args=(client_socket,), daemon=True).start()
+
+    def handle_control(self, client_socket):
+        """
+        GET /servers lists the backends and their settings; POST /servers/<port>?error_rate=0.5
+        changes the settings given in the query of one backend and returns them
+        """
+        try:
+            client_socket.settimeout(5.0)
+            head = b""
+            while b"\r\n\r\n" not in head and len(head) < 8192:
+                data = client_socket.recv(4096)
+                if not data:
+                    return
+                head += data
+            method, target = head.split(b"\r\n", 1)[0].decode("latin-1").split()[:2]
+            url = urlsplit(target)
+            parts = url.path.strip("/").split("/")
+            if method == "GET" and parts == ["servers"]:
+                body = {str(b["port"]): self.set_settings(b["port"], {}) for b in self.backends}
+                self.send_control_response(client_socket, 200, "OK", body)
+            elif method == "POST" and len(parts) == 2 and parts[0] == "servers" and parts[1].isdigit():
+                query = parse_qs(url.query)
+                settings = {name: kind(query[name][-1]) for name, kind in CONTROL_SETTINGS.items() if name in query}
+                if "latency" in settings:
+                    parse_latency(settings["latency"])
+                unknown = set(query) - set(CONTROL_SETTINGS)
+                if unknown:
+                    self.send_control_response(client_socket, 400, "Bad Request",
+                                               {"error": f"unknown settings: {', '.join(sorted(unknown))}"})
+                else:
+                    body = self.set_settings(int(parts[1]), settings)
+                    self.send_control_response(client_socket, 200, "OK", body)
+            else:
+                self.send_control_response(client_socket, 404, "Not Found", {"error": "not found"})
+        except KeyError:
+            self.send_control_response(client_socket, 404, "Not Found", {"error": "no backend on that port"})
+        except ValueError as e:
+            self.send_control_response(client_socket, 400, "Bad Request", {"error": str(e)})
+        except Exception as e:
+            print(f"Control channel error: {e}")
+        finally:
+            client_socket.close()
+
+    def send_control_response(self, client_socket, status, reason, body):
+        body = json.dumps(body).encode("utf-8")
+        head = (
+            f"HTTP/1.1 {status} {reason}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n"
+            "\r\n"
+        )
+        try:
+            client_socket.sendall(head.encode("latin-1") + body)
+        except OSError:
+            pass
+
+    def stop_all_servers(self):
+        self.running = False
+        if self.control_socket:
+            self.control_socket.close()
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join(2.0)
+
     def signal_handler(self, signum, frame):
         print("\nShutting down servers...")
         self.running = False
         sys.exit(0)
 
+
+def probe_health(port, timeout=0.5):
+    """
+    Return whether the backend on port answers GET /healthz with any HTTP response
+    """
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=timeout) as sock:
+            sock.sendall(b"GET /healthz HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+            return sock.recv(16).startswith(b"HTTP/")
+    except OSError:
+        return False
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Start a fleet of backend servers for load balancer testing")
+    parser.add_argument("--config", help='JSON fleet file: {"defaults": {...}, "servers": [{"port": 8080, ...}]}')
+    parser.add_argument("--count", type=int, help="Start this many identical backends instead of the default six")
+    parser.add_argument("--base-port", type=int, default=8080, help="Port of the first backend with --count")
+    parser.add_argument("--error-rate", type=float, help="Share of failed health checks")
+    parser.add_argument("--timeout-rate", type=float, help="Share of stalled health checks")
+    parser.add_argument("--timeout-duration", type=float, help="Seconds a stalled health check takes")
+    parser.add_argument("--engine", choices=ENGINES, help="Engine of the backends (default threads)")
+    parser.add_argument("--latency", help="Latency profile of the backends, see http_server.py --help")
+    parser.add_argument("--payload-size", type=int, help="Body size of / in bytes")
+    parser.add_argument("--quiet", action="store_true", default=None, help="Do not log every request")
+    parser.add_argument("--control-port", type=int, default=CONTROL_PORT,
+                        help="Port of the control channel (default 8079, 0 to disable)")
+    parser.add_argument("--ready-timeout", type=float, default=READY_TIMEOUT,
+                        help="Seconds to wait for the backends to answer /healthz")
+    args = parser.parse_args()
+
+    # Options given on the command line override the defaults of the file or the built-in fleet
+    overrides = {name: value for name, value in (
+        ("error_rate", args.error_rate), ("timeout_rate", args.timeout_rate),
+        ("timeout_duration", args.timeout_duration), ("engine", args.engine), ("latency", args.latency),
+        ("payload_size", args.payload_size), ("quiet", args.quiet),
+    ) if value is not None}
+    try:
+        if args.config:
+            with open(args.config) as f:
+                fleet = json.load(f)
+        elif args.count:
+            fleet = {"servers": [{"port": args.base_port + i} for i in range(args.count)]}
+        else:
+            fleet = {"servers": DEFAULT_FLEET}
+        fleet = dict(fleet, defaults=dict(fleet.get("defaults", {}), **overrides))
+        if overrides:
+            fleet["servers"] = [{k: v for k, v in s.items() if k not in overrides} for s in fleet["servers"]]
+        backends = parse_fleet(fleet)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
     print("=" * 60)
     print("HTTP SERVER MANAGER - LOAD BALANCER SETUP")
     print("=" * 60)
     print("This script starts multiple HTTP servers for load balancer testing")
     print("=" * 60)
-    
-    manager = ServerManager()
+
+    manager = ServerManager(backends, args.control_port)
     signal.signal(signal.SIGINT, manager.signal_handler)
     signal.signal(signal.SIGTERM, manager.signal_handler)
-    
+
     try:
-        manager.start_all_servers()
-        
+        if not manager.start_all_servers(args.ready_timeout):
+            return 1
+
         while manager.running:
             time.sleep(1)
-            
+
     except KeyboardInterrupt:
         print("\nServer manager stopped by user")
     except Exception as e:
         print(f"Server manager error: {e}")
+    finally:
+        manager.stop_all_servers()
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -376,6 +376,295 @@ class LoadBalancerTester:
             print(f"❌ Load distribution test failed: {e}")
             return False
     
+    def test_dns_resolver_cache(self):
+        try:
+            print("=" * 50)
+            print("Testing DNS resolver cache with a stub resolver...")
+
+            from dns_cache import DNSCache, expand_upstream_groups
+            from lb_config import carry_over_servers
+
+            # A local stub resolver, so the test needs no network
+            answers = {"svc.test": (["10.0.0.2", "10.0.0.1"], 60)}
+            calls = []
+
+            def stub_resolver(host):
+                calls.append(host)
+                if host not in answers:
+                    raise OSError(f"NXDOMAIN {host}")
+                return answers[host]
+
+            cache = DNSCache(resolver=stub_resolver, min_ttl=0.0, negative_ttl=0.0)
+            results = []
+
+            addresses = cache.lookup("svc.test")
+            cache.lookup("svc.test")
+            cache.lookup("127.0.0.1")
+            results.append(addresses == ["10.0.0.1", "10.0.0.2"] and calls == ["svc.test"])
+            print(f"  Cached lookup: {addresses}, resolver calls: {len(calls)}")
+
+            groups = {"svc.cn.edu": {"algorithm": "round_robin", "servers": [
+                {"host": "svc.test", "port": 80, "weight": 2, "timeout": 2, "healthy": True},
+                {"host": "127.0.0.1", "port": 81, "weight": 1, "timeout": 2, "healthy": True},
+            ]}}
+            live = expand_upstream_groups(groups, cache)
+            targets = [(srv["host"], srv.get("address"), srv["weight"]) for srv in live["svc.cn.edu"]["servers"]]
+            results.append(targets == [("svc.test", "10.0.0.1", 2), ("svc.test", "10.0.0.2", 2), ("127.0.0.1", None, 1)])
+            print(f"  Balancing targets: {targets}")
+
+            # Nothing is refreshed before the TTL runs out
+            results.append(cache.refresh_due() == set())
+
+            # An expired answer is refreshed and the change reported
+            answers["svc.test"] = (["10.0.0.2", "10.0.0.3"], 0)
+            cache._records["svc.test"].refresh_at = 0.0
+            changed = cache.refresh_due()
+            results.append(changed == {"svc.test"} and cache.lookup("svc.test") == ["10.0.0.2", "10.0.0.3"])
+            print(f"  Changed after refresh: {sorted(changed)}")
+
+            # The target of an address that is still resolved keeps its live entry
+            kept = live["svc.cn.edu"]["servers"][1]
+            refreshed = expand_upstream_groups(groups, cache)
+            carry_over_servers(live, refreshed)
+            results.append(kept in refreshed["svc.cn.edu"]["servers"]
+                           and len(refreshed["svc.cn.edu"]["servers"]) == 3)
+
+            # A failed refresh keeps serving the last good answer
+            del answers["svc.test"]
+            results.append(cache.refresh_due() == set() and cache.lookup("svc.test") == ["10.0.0.2", "10.0.0.3"])
+            results.append(cache.lookup("missing.test") == [])
+
+            if all(results):
+                print("✅ DNS resolver cache test passed")
+                return True
+            print(f"❌ DNS resolver cache test failed: {results}")
+            return False
+
+        except Exception as e:
+            print(f"❌ DNS resolver cache test failed: {e}")
+            return False
+
+    def test_consistent_hash_redistribution(self):
+        try:
+            print("=" * 50)
+            print("Testing consistent hash key redistribution...")
+
+            from schedulers import ConsistentHashScheduler
+
+            servers = [{"host": "127.0.0.1", "port": 9000 + i, "weight": 1, "healthy": True} for i in range(5)]
+            keys = [f"10.0.{i // 256}.{i % 256}" for i in range(20000)]
+            results = []
+
+            scheduler = ConsistentHashScheduler(servers)
+            before = {key: scheduler.select(key=key)["port"] for key in keys}
+            shares = [list(before.values()).count(srv["port"]) / len(keys) for srv in servers]
+            print(f"  Key shares: {[f'{share:.1%}' for share in shares]}")
+            results.append(all(abs(share - 1 / len(servers)) < 0.05 for share in shares))
+
+            # Only the keys of a server that goes down move, spread over the others
+            servers[2]["healthy"] = False
+            scheduler.invalidate()
+            after = {key: scheduler.select(key=key)["port"] for key in keys}
+            moved = [key for key in keys if before[key] != after[key]]
+            print(f"  Keys moved when 1 of 5 servers went down: {len(moved) / len(keys):.1%}")
+            results.append(all(before[key] == servers[2]["port"] for key in moved))
+            results.append(abs(len(moved) / len(keys) - 1 / 5) < 0.05)
+            results.append(len({after[key] for key in moved}) == 4)
+
+            # Its keys come back when it recovers
+            servers[2]["healthy"] = True
+            scheduler.invalidate()
+            results.append(all(scheduler.select(key=key)["port"] == before[key] for key in keys))
+
+            # A new server only takes keys, about 1/N of them
+            grown = ConsistentHashScheduler(servers + [{"host": "127.0.0.1", "port": 9005, "weight": 1}])
+            moved = [key for key in keys if grown.select(key=key)["port"] != before[key]]
+            print(f"  Keys moved when a 6th server was added: {len(moved) / len(keys):.1%}")
+            results.append(all(grown.select(key=key)["port"] == 9005 for key in moved))
+            results.append(abs(len(moved) / len(keys) - 1 / 6) < 0.05)
+
+            # A retry that excludes the chosen server goes to the next one on the ring
+            first = scheduler.select(key=keys[0])
+            results.append(scheduler.select(exclude=[first], key=keys[0]) is not first)
+
+            if all(results):
+                print("✅ Consistent hash redistribution test passed")
+                return True
+            print(f"❌ Consistent hash redistribution test failed: {results}")
+            return False
+
+        except Exception as e:
+            print(f"❌ Consistent hash redistribution test failed: {e}")
+            return False
+
+    def test_least_time_probe_latency(self):
+        try:
+            print("=" * 50)
+            print("Testing health check latency in least time...")
+
+            from http_load_balancer import HTTPLoadBalancer
+            from schedulers import PROBE_SAMPLE_AGE, LeastTimeScheduler, server_state
+
+            groups = {"svc.cn.edu": {"algorithm": "least_time", "servers": [
+                {"host": "127.0.0.1", "port": 9000 + i, "weight": 1, "timeout": 2, "healthy": True} for i in range(3)
+            ]}}
+            lb = HTTPLoadBalancer(upstream_groups=groups)
+            busy, idle, new = lb.upstream_groups["svc.cn.edu"]["servers"]
+            scheduler = LeastTimeScheduler([busy, idle, new], slow_start=0)
+            results = []
+
+            # Both answered proxied requests in 50ms, but idle's last one was long ago
+            lb.observe_response_time(busy, 0.05)
+            lb.observe_response_time(idle, 0.05)
+            server_state(idle).observed_at -= PROBE_SAMPLE_AGE
+            before = scheduler.cost(idle, 1.0, time.monotonic())
+
+            for server in (busy, idle, new):
+                lb.health_checker.record(server, True, 2.0)
+            after = scheduler.cost(idle, 1.0, time.monotonic())
+            print(f"  Idle server cost: {before:.3f} -> {after:.3f}")
+            results.append(after > before)
+
+            # A probe does not move a server with recent proxied response times
+            print(f"  Busy server EWMA: {server_state(busy).ewma:.3f}")
+            results.append(server_state(busy).ewma == 0.05)
+
+            # A server without any samples starts from its check latency
+            print(f"  New server EWMA: {server_state(new).ewma}")
+            results.append(server_state(new).ewma == 2.0)
+            results.append(scheduler.select() is busy)
+
+            if all(results):
+                print("✅ Least time probe latency test passed")
+                return True
+            print(f"❌ Least time probe latency test failed: {results}")
+            return False
+
+        except Exception as e:
+            print(f"❌ Least time probe latency test failed: {e}")
+            return False
+
+    def test_chunk_size_validation(self):
+        try:
+            print("=" * 50)
+            print("Testing chunk size validation...")
+
+            from http_framing import BodyFramer, HTTPFramingError
+
+            # Sizes int(size, 16) would take; -6 used to loop forever in the framer
+            bad_sizes = [b"-6", b"0x3", b"1_0", b"+3", b" 3"]
+            results = []
+
+            for size in bad_sizes:
+                body = size + b"\r\nabc\r\n0\r\n\r\n"
+                outcome = []
+
+                def frame():
+                    try:
+                        BodyFramer(chunked=True).feed(body)
+                        outcome.append("accepted")
+                    except HTTPFramingError:
+                        outcome.append("rejected")
+
+                # A framer that hangs must fail the test rather than the test run
+                worker = threading.Thread(target=frame, daemon=True)
+                worker.start()
+                worker.join(2)
+                print(f"  Framer, size {size!r}: {outcome[0] if outcome else 'hung'}")
+                results.append(outcome == ["rejected"])
+
+                try:
+                    client_socket = socket.create_connection((self.lb_host, self.lb_port), timeout=5)
+                    client_socket.sendall(b"POST / HTTP/1.1\r\nHost: round_robin.cn.edu\r\n"
+                                          b"Transfer-Encoding: chunked\r\n\r\n" + body)
+                    response = client_socket.recv(4096)
+                    client_socket.close()
+                    status = response.split(b"\r\n", 1)[0].decode("latin-1")
+                except Exception as e:
+                    status = f"Error - {e}"
+                print(f"  Load balancer, size {size!r}: {status}")
+                results.append(status.startswith("HTTP/1.1 400"))
+
+            framer = BodyFramer(chunked=True)
+            framer.feed(b"3;name=value\r\nabc\r\n0\r\n\r\n")
+            results.append(framer.done)
+
+            if all(results):
+                print("✅ Chunk size validation test passed")
+                return True
+            print(f"❌ Chunk size validation test failed: {results}")
+            return False
+
+        except Exception as e:
+            print(f"❌ Chunk size validation test failed: {e}")
+            return False
+
+    def test_asyncio_request_bodies(self):
+        try:
+            print("=" * 50)
+            print("Testing request bodies on the asyncio engine...")
+
+            import asyncio
+            from async_engine import AsyncioEngine
+            from http_load_balancer import HTTPLoadBalancer
+
+            head = b"POST / HTTP/1.1\r\nHost: svc.cn.edu\r\n"
+            cases = [(f"Chunk size {size!r}", head + b"Transfer-Encoding: chunked\r\n\r\n" + size + b"\r\nabc\r\n0\r\n\r\n",
+                      "400") for size in [b"-6", b"0x3", b"1_0", b"+3", b" 3"]]
+            cases.append(("Stalled body", head + b"Content-Length: 10\r\n\r\nabc", "408"))
+            cases.append(("Complete body", head + b"Content-Length: 3\r\n\r\nabc", "200"))
+            outcome = []
+
+            async def backend(reader, writer):
+                await reader.readuntil(b"\r\n\r\n")
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+                await writer.drain()
+                writer.close()
+
+            async def send(port, data):
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(data)
+                status = await reader.readline()
+                writer.close()
+                return status.decode("latin-1").strip()
+
+            async def run():
+                upstream = await asyncio.start_server(backend, "127.0.0.1", 0)
+                groups = {"svc.cn.edu": {"algorithm": "round_robin", "servers": [
+                    {"host": "127.0.0.1", "port": upstream.sockets[0].getsockname()[1], "weight": 1, "timeout": 5,
+                     "healthy": True},
+                ]}}
+                lb = HTTPLoadBalancer(engine="asyncio", client_idle_timeout=1.0, upstream_groups=groups)
+                lb.running = True
+                engine = AsyncioEngine(lb)
+                engine.pool.loop = asyncio.get_running_loop()
+                server = await asyncio.start_server(engine.handle_client, "127.0.0.1", 0)
+                port = server.sockets[0].getsockname()[1]
+                for name, request, expected in cases:
+                    start = time.time()
+                    status = await send(port, request)
+                    print(f"  {name}: {status} after {time.time() - start:.1f}s")
+                    outcome.append(status.startswith(f"HTTP/1.1 {expected}") and time.time() - start < 3)
+                lb.running = False
+                server.close()
+                upstream.close()
+
+            # A framer that hangs blocks the whole event loop, so the loop runs in a thread of its own
+            worker = threading.Thread(target=asyncio.run, args=(run(),), daemon=True)
+            worker.start()
+            worker.join(20)
+            results = outcome if len(outcome) == len(cases) else [False]
+
+            if all(results):
+                print("✅ Asyncio request body test passed")
+                return True
+            print(f"❌ Asyncio request body test failed: {results}")
+            return False
+
+        except Exception as e:
+            print(f"❌ Asyncio request body test failed: {e}")
+            return False
+
     def run_comprehensive_test(self):
         print("=" * 60)
         
@@ -389,6 +678,11 @@ class LoadBalancerTester:
         test_results.append(("Error Handling", self.test_error_handling()))
         test_results.append(("Concurrent Routing", self.test_concurrent_routing()))
         test_results.append(("Load Distribution", self.test_load_distribution()))
+        test_results.append(("DNS Resolver Cache", self.test_dns_resolver_cache()))
+        test_results.append(("Consistent Hash Redistribution", self.test_consistent_hash_redistribution()))
+        test_results.append(("Least Time Probe Latency", self.test_least_time_probe_latency()))
+        test_results.append(("Chunk Size Validation", self.test_chunk_size_validation()))
+        test_results.append(("Asyncio Request Bodies", self.test_asyncio_request_bodies()))
         
         print("\n" + "=" * 60)
         print("TEST RESULTS:")
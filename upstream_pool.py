@@ -0,0 +1,233 @@
+import asyncio
+import collections
+import socket
+import threading
+import time
+
+from deadlines import CONNECT, Deadline, UpstreamTimeout
+from dns_cache import target_address
+
+
+def server_id(server):
+    """
+    Return the id of an upstream server entry in pools and statistics: "host:port",
+    followed by "/address" for a target expanded from a host name
+    """
+    if server.get("address"):
+        return f"{server['host']}:{server['port']}/{server['address']}"
+    return f"{server['host']}:{server['port']}"
+
+
+class PooledConnection:
+    def __init__(self, conn, server_id):
+        """
+        A connection to an upstream server together with its pool bookkeeping
+
+        :param conn: A socket, or a (reader, writer) pair for the asyncio pool
+        :param server_id: The server_id of the upstream server
+        """
+        self.conn = conn
+        self.server_id = server_id
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.requests = 0
+        self.reused = False
+
+
+class UpstreamConnectionPool:
+    def __init__(self, max_idle=8, idle_timeout=30.0, max_lifetime=300.0, dns=None):
+        """
+        Per-upstream pool of persistent HTTP/1.1 keep-alive connections
+
+        :param max_idle: The number of idle connections kept per upstream server
+        :param idle_timeout: Seconds an idle connection may wait in the pool
+        :param max_lifetime: Seconds after which a connection is retired regardless of use
+        :param dns: The DNSCache that hosts without a resolved address are looked up in
+        """
+        self.max_idle = max_idle
+        self.dns = dns
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self._idle = collections.defaultdict(collections.deque)
+        self._counters = collections.defaultdict(
+            lambda: {"hits": 0, "misses": 0, "stale": 0, "expired": 0, "active": 0}
+        )
+        self._lock = threading.Lock()
+
+    server_id = staticmethod(server_id)
+
+    def _take_idle(self, server_id):
+        """
+        Pop the most recently used idle connection that is still usable
+        """
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                idle = self._idle[server_id]
+                if not idle:
+                    return None
+                pooled = idle.pop()
+            if now - pooled.last_used > self.idle_timeout or now - pooled.created_at > self.max_lifetime:
+                self._count(server_id, "expired")
+                self._close(pooled)
+            elif self._is_stale(pooled):
+                self._count(server_id, "stale")
+                self._close(pooled)
+            else:
+                return pooled
+
+    def _count(self, server_id, counter, delta=1):
+        with self._lock:
+            self._counters[server_id][counter] += delta
+
+    def acquire(self, server, fresh=False, deadline=None):
+        """
+        Get a connection to the upstream server, reusing an idle one when possible
+
+        :param server: The upstream server entry from upstream_groups
+        :param fresh: Skip the idle connections and always open a new one
+        :param deadline: The Deadline of the request, whose connect timeout applies to a new connection
+        :return: A PooledConnection whose reused flag tells whether it came from the pool
+        :raises UpstreamTimeout: If connecting times out
+        """
+        server_id = self.server_id(server)
+        pooled = None if fresh else self._take_idle(server_id)
+        if pooled is not None:
+            pooled.reused = True
+            self._count(server_id, "hits")
+        else:
+            self._count(server_id, "misses")
+            pooled = PooledConnection(self._connect(server, deadline or Deadline(server)), server_id)
+        self._count(server_id, "active")
+        return pooled
+
+    def release(self, pooled, reusable):
+        """
+        Return a connection after a request, keeping it only if it can serve another one
+
+        :param pooled: The PooledConnection returned by acquire
+        :param reusable: Whether the response left the connection in a clean keep-alive state
+        """
+        self._count(pooled.server_id, "active", -1)
+        pooled.requests += 1
+        pooled.last_used = time.monotonic()
+        if reusable and pooled.last_used - pooled.created_at < self.max_lifetime:
+            with self._lock:
+                idle = self._idle[pooled.server_id]
+                if len(idle) < self.max_idle:
+                    pooled.reused = False
+                    idle.append(pooled)
+                    return
+        self._close(pooled)
+
+    def stats(self, server):
+        """
+        Pool counters for one upstream server
+        """
+        server_id = self.server_id(server)
+        with self._lock:
+            counters = dict(self._counters[server_id])
+            counters["idle"] = len(self._idle[server_id])
+        return counters
+
+    def retain(self, server_ids):
+        """
+        Close the idle connections of servers that are no longer configured
+
+        :param server_ids: The server_id of every server that is still configured
+        """
+        with self._lock:
+            removed = [server_id for server_id in self._idle if server_id not in server_ids]
+            idle = [pooled for server_id in removed for pooled in self._idle.pop(server_id)]
+        for pooled in idle:
+            self._close(pooled)
+
+    def close_all(self):
+        """
+        Close every idle connection
+        """
+        with self._lock:
+            idle = [pooled for conns in self._idle.values() for pooled in conns]
+            self._idle.clear()
+        for pooled in idle:
+            self._close(pooled)
+
+    def _connect(self, server, deadline):
+        upstream_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            upstream_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            seconds, kind = deadline.timeout(CONNECT)
+            upstream_socket.settimeout(seconds)
+            try:
+                upstream_socket.connect((target_address(server, self.dns), server["port"]))
+            except socket.timeout:
+                raise UpstreamTimeout(kind) from None
+        except Exception:
+            upstream_socket.close()
+            raise
+        return upstream_socket
+
+    def _is_stale(self, pooled):
+        """
+        An idle connection is stale if the upstream closed it or sent unsolicited bytes
+        """
+        upstream_socket = pooled.conn
+        timeout = upstream_socket.gettimeout()
+        try:
+            # A socket with a timeout would wait for readability before peeking
+            upstream_socket.setblocking(False)
+            data = upstream_socket.recv(1, socket.MSG_PEEK)
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            return True
+        finally:
+            upstream_socket.settimeout(timeout)
+        # Either the upstream closed the connection (b"") or sent bytes nobody asked for
+        return True
+
+    def _close(self, pooled):
+        try:
+            pooled.conn.close()
+        except OSError:
+            pass
+
+
+class AsyncUpstreamPool(UpstreamConnectionPool):
+    """
+    The same pool for the asyncio engine, holding (reader, writer) stream pairs
+
+    Set loop to the event loop that owns the streams, so that connections closed from
+    another thread, e.g. by a configuration reload, are closed on that loop.
+    """
+    loop = None
+
+    async def acquire(self, server, fresh=False, deadline=None):
+        server_id = self.server_id(server)
+        pooled = None if fresh else self._take_idle(server_id)
+        if pooled is not None:
+            pooled.reused = True
+            self._count(server_id, "hits")
+        else:
+            self._count(server_id, "misses")
+            seconds, kind = (deadline or Deadline(server)).timeout(CONNECT)
+            try:
+                conn = await asyncio.wait_for(
+                    asyncio.open_connection(target_address(server, self.dns), server["port"]), seconds
+                )
+            except asyncio.TimeoutError:
+                raise UpstreamTimeout(kind) from None
+            pooled = PooledConnection(conn, server_id)
+        self._count(server_id, "active")
+        return pooled
+
+    def _is_stale(self, pooled):
+        reader, writer = pooled.conn
+        return reader.at_eof() or writer.is_closing()
+
+    def _close(self, pooled):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(pooled.conn[1].close)
+        else:
+            pooled.conn[1].close()
+